@@ -1,5 +1,8 @@
 # blog/serializers.py
 from rest_framework import serializers
+
+from flow_project.fieldsets import SparseFieldsetSerializer
+
 from .models import Tag, BlogPost
 
 class TagSerializer(serializers.ModelSerializer):
@@ -7,7 +10,7 @@ class TagSerializer(serializers.ModelSerializer):
         model = Tag
         fields = ['name', 'slug']
 
-class BlogPostListSerializer(serializers.ModelSerializer):
+class BlogPostListSerializer(SparseFieldsetSerializer):
     # Para devolver los tags como una lista de strings (nombres)
     tags = serializers.StringRelatedField(many=True)
     # Formatear la fecha a ISO 8601 (solo fecha o fecha y hora)
@@ -22,7 +25,7 @@ class BlogPostListSerializer(serializers.ModelSerializer):
             'excerpt', 'image_url', 'image_alt', 'data_ai_hint', 'tags', 'additional_image_urls', 'video_urls' 
         ]
 
-class BlogPostDetailSerializer(serializers.ModelSerializer):
+class BlogPostDetailSerializer(SparseFieldsetSerializer):
     tags = serializers.StringRelatedField(many=True)
     date = serializers.DateTimeField(format="%Y-%m-%dT%H:%M:%SZ", read_only=True)
     # Si usas ForeignKey para autor:
@@ -44,4 +47,10 @@ class BlogPostDetailSerializer(serializers.ModelSerializer):
     # def get_author_display(self, obj):
     #     if obj.author_user:
     #         return obj.author_user.get_full_name() or obj.author_user.username
-    #     return obj.author_name
\ No newline at end of file
+    #     return obj.author_name
+
+# Presets de ?fields= (ver flow_project/fieldsets.py)
+BLOG_POST_FIELD_PRESETS = {
+    'card': ['id', 'slug', 'title', 'date', 'author_name', 'excerpt', 'image_url', 'image_alt', 'tags'], # Sin listas de medios
+    'full': BlogPostDetailSerializer.Meta.fields,
+}
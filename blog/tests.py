@@ -1,3 +1,38 @@
 from django.test import TestCase
+from django.utils import timezone
 
-# Create your tests here.
+from .models import BlogPost, Tag
+
+
+class BlogConditionalGetTests(TestCase):
+    def setUp(self):
+        self.post = BlogPost.objects.create(title="Cultivo de ostra", date=timezone.now(), author_name="Equipo", excerpt="...", content="<p>...</p>")
+
+    def test_list_and_detail_answer_304_until_a_post_changes(self):
+        for url in ('/api/blog/posts/', f'/api/blog/posts/{self.post.slug}/'):
+            response = self.client.get(url)
+            etag = response.headers['ETag']
+            self.assertIn('Last-Modified', response.headers)
+            with self.assertNumQueries(1): # Solo la consulta de los validadores
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+            self.post.excerpt = "Nuevo resumen"
+            self.post.save()
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_unpublishing_changes_list_etag(self):
+        etag = self.client.get('/api/blog/posts/').headers['ETag']
+        BlogPost.objects.filter(pk=self.post.pk).update(is_published=False) # Sin tocar updated_at
+        self.assertEqual(self.client.get('/api/blog/posts/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class BlogSparseFieldsetTests(TestCase):
+    def test_card_preset_drops_media_and_prefetches_tags(self):
+        tag = Tag.objects.create(name="Hongos")
+        for i in range(3):
+            post = BlogPost.objects.create(title=f"Post {i}", date=timezone.now(), author_name="Equipo", excerpt="...", content="<p>...</p>", video_urls=['https://v/1'])
+            post.tags.add(tag)
+        with self.assertNumQueries(3): # Validadores, artículos y tags (sin una consulta por artículo)
+            posts = self.client.get('/api/blog/posts/?fields=card').json()
+        self.assertNotIn('video_urls', posts[0])
+        self.assertEqual(posts[0]['tags'], ["Hongos"])
@@ -1,21 +1,44 @@
+from django.db.models import Count, Max
 from rest_framework import generics
+
+from flow_project.conditional import ConditionalGetMixin
+from flow_project.fieldsets import SparseFieldsetsMixin
+
 from .models import BlogPost
-from .serializers import BlogPostListSerializer, BlogPostDetailSerializer
+from .serializers import BLOG_POST_FIELD_PRESETS, BlogPostListSerializer, BlogPostDetailSerializer
 
-class BlogPostListView(generics.ListAPIView):
+class BlogPostListView(ConditionalGetMixin, SparseFieldsetsMixin, generics.ListAPIView):
     """
     Devuelve una lista de todos los artículos del blog publicados.
     Considera añadir paginación aquí si la lista es larga.
+    Los validadores (ETag / Last-Modified) salen de una sola consulta de agregado:
+    el último updated_at y la cantidad de publicados (que cambia al borrar o
+    despublicar). Cambios solo en un Tag no tocan updated_at de los artículos.
+    ?fields=card deja fuera las listas de medios (ver flow_project/fieldsets.py).
     """
     queryset = BlogPost.objects.filter(is_published=True).order_by('-date')
     serializer_class = BlogPostListSerializer
+    field_presets = BLOG_POST_FIELD_PRESETS
     # pagination_class = TuClaseDePaginacion (ej. PageNumberPagination)
 
-class BlogPostDetailView(generics.RetrieveAPIView):
+    def get_validators(self, request, *args, **kwargs):
+        stats = BlogPost.objects.filter(is_published=True).aggregate(last_updated=Max('updated_at'), total=Count('id'))
+        if stats['last_updated'] is None:
+            return '"blog-empty"', None
+        return f'"blog-{stats["total"]}-{stats["last_updated"].timestamp():.6f}"', stats['last_updated']
+
+class BlogPostDetailView(ConditionalGetMixin, SparseFieldsetsMixin, generics.RetrieveAPIView):
     """
     Devuelve los detalles de un artículo específico por su slug.
-    Solo artículos publicados.
+    Solo artículos publicados. Validadores a partir de su updated_at.
     """
     queryset = BlogPost.objects.filter(is_published=True)
     serializer_class = BlogPostDetailSerializer
-    lookup_field = 'slug' # Para buscar por slug en la URL
\ No newline at end of file
+    lookup_field = 'slug' # Para buscar por slug en la URL
+    field_presets = BLOG_POST_FIELD_PRESETS
+
+    def get_validators(self, request, *args, **kwargs):
+        updated_at = self.get_queryset().filter(slug=kwargs['slug']).values_list('updated_at', flat=True).first()
+        if updated_at is None:
+            return None, None # No existe: que el 404 lo responda la vista
+        return f'"post-{updated_at.timestamp():.6f}"', updated_at
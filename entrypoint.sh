@@ -12,8 +12,14 @@ echo "Recolectando archivos estáticos..." # <--- LÍNEA NUEVA
 python manage.py collectstatic --noinput  # <--- LÍNEA NUEVA
 
 
-# Iniciar Gunicorn (el comando que ya teníamos)
-# Usamos 'exec' para que Gunicorn reemplace este script y se convierta en el proceso principal (PID 1),
+# Iniciar el servidor
+# Usamos 'exec' para que el servidor reemplace este script y se convierta en el proceso principal (PID 1),
 # lo cual es importante para que maneje correctamente las señales del sistema (como cuando Render lo detiene).
+# SERVER_MODE=asgi sirve con uvicorn (usar junto a PAYMENTS_ASYNC_VIEWS=True); por defecto, Gunicorn (WSGI).
+if [ "$SERVER_MODE" = "asgi" ]; then
+    echo "Iniciando Uvicorn (ASGI)..."
+    exec uvicorn flow_project.asgi:application --host 0.0.0.0 --port 8000 --workers "${WEB_CONCURRENCY:-2}" --log-level=debug
+fi
+
 echo "Iniciando Gunicorn..."
 exec gunicorn flow_project.wsgi:application --bind 0.0.0.0:8000 --log-level=debug --access-logfile=- --error-logfile=-
\ No newline at end of file
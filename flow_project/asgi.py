@@ -5,6 +5,13 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+Modo ASGI del proyecto: con PAYMENTS_ASYNC_VIEWS=True las vistas de pago que
+esperan a Flow/n8n pasan a ser async (payments/async_views.py). Para servirlo:
+
+    uvicorn flow_project.asgi:application --host 0.0.0.0 --port 8000 --workers 2
+
+o SERVER_MODE=asgi en entrypoint.sh.
 """
 
 import os
@@ -0,0 +1,34 @@
+# flow_project/conditional.py
+"""
+GET condicional (ETag / Last-Modified) para las vistas públicas de lectura.
+
+La vista calcula sus validadores con algo barato (una versión en la caché o
+una consulta de agregado) en get_validators(). Si coinciden con el
+If-None-Match / If-Modified-Since de la petición se responde 304 sin armar
+el queryset ni serializar nada. Las respuestas 200 llevan los mismos
+validadores, más Cache-Control: no-cache para que navegadores y CDN guarden la
+respuesta pero la revaliden cada vez en vez de suponerla vigente.
+"""
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+
+class ConditionalGetMixin:
+    def get_validators(self, request, *args, **kwargs):
+        """Devuelve (etag, last_modified): etag entre comillas o None, last_modified datetime o None."""
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request, *args, **kwargs)
+        last_modified = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            if etag and not response.has_header('ETag'): # La vista puede fijar el de lo que sirvió de verdad
+                response.headers['ETag'] = etag
+            if last_modified:
+                response.headers['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, no_cache=True)
+        return response
@@ -0,0 +1,69 @@
+# flow_project/fieldsets.py
+"""
+Campos a pedido (?fields=) para las vistas de lectura de productos y blog.
+
+?fields= recibe una lista separada por comas de campos del serializer y/o
+presets con nombre de la vista (ej. ?fields=card, ?fields=card,description).
+Se recorta el serializer y también la consulta: only() con las columnas
+pedidas y prefetch_related solo para las relaciones many-to-many que se
+piden. Así, un listado en grilla no lee ni serializa descripciones largas
+ni listas de medios. Sin ?fields= se responde con todos los campos, como
+siempre.
+"""
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+
+
+class SparseFieldsetSerializer(serializers.ModelSerializer):
+    """ModelSerializer que acepta fields=(...) para quedarse solo con esos campos."""
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class SparseFieldsetsMixin:
+    field_presets = {} # nombre -> campos del serializer
+    sparse_required_fields = () # Columnas que la vista siempre necesita (ej. las del orden de la paginación)
+
+    def get_requested_fields(self):
+        """Campos pedidos en ?fields=, en el orden del serializer, o None para todos. ValidationError (400) si hay uno desconocido."""
+        if not hasattr(self, '_requested_fields'):
+            self._requested_fields = self._parse_requested_fields()
+        return self._requested_fields
+
+    def _parse_requested_fields(self):
+        raw = self.request.query_params.get('fields') if self.request else None
+        if not raw:
+            return None
+        available = list(self.get_serializer_class().Meta.fields)
+        requested = set()
+        for token in filter(None, (token.strip() for token in raw.split(','))):
+            if token in self.field_presets:
+                requested.update(self.field_presets[token])
+            elif token in available:
+                requested.add(token)
+            else:
+                raise ValidationError({'fields': f"Campo o preset desconocido: '{token}'. Presets: {', '.join(self.field_presets)}."})
+        fields = tuple(name for name in available if name in requested)
+        return None if len(fields) == len(available) else fields
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        fields = self.get_requested_fields()
+        opts = queryset.model._meta
+        model_fields = {field.name: field for field in opts.get_fields()}
+        names = fields or self.get_serializer_class().Meta.fields
+
+        many_to_many = [name for name in names if name in model_fields and model_fields[name].many_to_many]
+        if many_to_many:
+            queryset = queryset.prefetch_related(*many_to_many)
+        if fields is not None:
+            columns = {name for name in fields if name in model_fields and model_fields[name].concrete and not model_fields[name].many_to_many}
+            queryset = queryset.only(*(columns | set(self.sparse_required_fields) | {opts.pk.name}))
+        return queryset
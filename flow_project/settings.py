@@ -84,8 +84,36 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': DB_MOUNT_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Las transacciones toman el lock de escritura al empezar (BEGIN IMMEDIATE) y
+            # esperan hasta 'timeout' segundos: con webhook y callback a la vez, una
+            # transacción diferida falla con "database is locked" al intentar escribir.
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': int(os.getenv('SQLITE_TIMEOUT', '20')),
+        },
+    }
+}
+
+# --- Caché ---
+# Por defecto LocMemCache (una caché por proceso). Para compartirla entre los workers
+# de gunicorn, definir DJANGO_CACHE_BACKEND (ej. 'django.core.cache.backends.redis.RedisCache',
+# requiere el paquete 'redis') y DJANGO_CACHE_LOCATION (ej. 'redis://redis:6379/1').
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('DJANGO_CACHE_LOCATION', 'flow-api-cache'),
     }
 }
+# Las cachés en memoria de cada worker (catálogo pre-serializado, códigos de descuento,
+# tarifas de envío) se invalidan incrementando una versión guardada en esta caché. Eso
+# solo llega a todos los workers si la caché es compartida (Redis, Memcached, BD): con
+# LocMemCache cada proceso tiene su propia versión y solo se entera el que hizo el
+# cambio. Por eso, sin caché compartida sus TTL por defecto bajan a unos segundos
+# (los demás workers ven el cambio al vencer) y `manage.py check --deploy` lo advierte.
+CACHE_IS_SHARED = os.getenv('DJANGO_CACHE_SHARED', str(CACHES['default']['BACKEND'] not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+))) == 'True'
 
 # --- Configuración de Email ---
 EMAIL_BACKEND = os.getenv('DJANGO_EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
@@ -101,10 +129,118 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'webmaster@localhost')
 STORE_OWNER_EMAIL = os.getenv('STORE_OWNER_EMAIL')
+# Emails de órdenes encolados en el outbox al pagar/rechazar (payments/emails.py).
+# Por defecto las notificaciones las maneja n8n.
+ORDER_EMAILS_ENABLED = os.getenv('ORDER_EMAILS_ENABLED', 'False') == 'True'
+# Mensajes por llamada a send_messages sobre la conexión SMTP del dispatcher
+EMAIL_SEND_BATCH_SIZE = int(os.getenv('EMAIL_SEND_BATCH_SIZE', '20'))
+
+# --- Configuración de Flow ---
+FLOW_API_KEY = os.getenv('FLOW_API_KEY')
+FLOW_SECRET_KEY = os.getenv('FLOW_SECRET_KEY')
+FLOW_API_URL_PROD = os.getenv('FLOW_API_URL_PROD')
+# Timeouts (segundos) de conexión y lectura para todas las llamadas a Flow
+FLOW_CONNECT_TIMEOUT = float(os.getenv('FLOW_CONNECT_TIMEOUT', '3.05'))
+FLOW_READ_TIMEOUT = float(os.getenv('FLOW_READ_TIMEOUT', '15'))
+# Conexiones keep-alive que cada worker mantiene abiertas hacia Flow
+FLOW_HTTP_POOL_MAXSIZE = int(os.getenv('FLOW_HTTP_POOL_MAXSIZE', '10'))
+# Segundos que se reutiliza una respuesta de payment/getStatus por token:
+# estados finales (2/3/4) y pendiente (1), que debe expirar rápido.
+FLOW_STATUS_CACHE_TTL = int(os.getenv('FLOW_STATUS_CACHE_TTL', '600'))
+FLOW_STATUS_PENDING_CACHE_TTL = int(os.getenv('FLOW_STATUS_PENDING_CACHE_TTL', '3'))
+# Cada cuánto (segundos) un worker revisa la caché mientras otro consulta el mismo token
+FLOW_STATUS_LOCK_POLL_INTERVAL = float(os.getenv('FLOW_STATUS_LOCK_POLL_INTERVAL', '0.05'))
+# Circuit breaker por endpoint de Flow (payments/circuit_breaker.py): ventana de
+# observación, mínimo de llamadas para decidir, tasas que abren el circuito,
+# segundos que queda abierto y llamadas de prueba en semi-abierto.
+FLOW_BREAKER_WINDOW_SECONDS = float(os.getenv('FLOW_BREAKER_WINDOW_SECONDS', '60'))
+FLOW_BREAKER_MIN_CALLS = int(os.getenv('FLOW_BREAKER_MIN_CALLS', '10'))
+FLOW_BREAKER_ERROR_RATE = float(os.getenv('FLOW_BREAKER_ERROR_RATE', '0.5'))
+FLOW_BREAKER_SLOW_CALL_SECONDS = float(os.getenv('FLOW_BREAKER_SLOW_CALL_SECONDS', '5'))
+FLOW_BREAKER_SLOW_CALL_RATE = float(os.getenv('FLOW_BREAKER_SLOW_CALL_RATE', '0.8'))
+FLOW_BREAKER_OPEN_SECONDS = float(os.getenv('FLOW_BREAKER_OPEN_SECONDS', '30'))
+FLOW_BREAKER_HALF_OPEN_PROBES = int(os.getenv('FLOW_BREAKER_HALF_OPEN_PROBES', '1'))
+# Timeout de lectura adaptativo: p95 de latencia x multiplicador, acotado entre
+# FLOW_ADAPTIVE_TIMEOUT_MIN y FLOW_READ_TIMEOUT
+FLOW_ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.getenv('FLOW_ADAPTIVE_TIMEOUT_MULTIPLIER', '3'))
+FLOW_ADAPTIVE_TIMEOUT_MIN = float(os.getenv('FLOW_ADAPTIVE_TIMEOUT_MIN', '2'))
+
+# --- Modo de Servidor ---
+# Con PAYMENTS_ASYNC_VIEWS=True las rutas de create-payment, confirm-payment y
+# flow-callback usan las vistas async de payments/async_views.py. Pensado para
+# servir con ASGI (SERVER_MODE=asgi en entrypoint.sh); bajo WSGI siguen
+# funcionando, pero sin la ventaja de concurrencia: llaman a Flow con el cliente
+# síncrono en un hilo (ThreadedFlowClient en payments/flow_client.py).
+PAYMENTS_ASYNC_VIEWS = os.getenv('PAYMENTS_ASYNC_VIEWS', 'False') == 'True'
+
+# --- Estado de órdenes para las páginas de resultado (payments/order_status.py) ---
+# Segundos que se cachea el estado final y el pendiente de una orden.
+ORDER_STATUS_CACHE_TTL = int(os.getenv('ORDER_STATUS_CACHE_TTL', '3600'))
+ORDER_STATUS_PENDING_CACHE_TTL = int(os.getenv('ORDER_STATUS_PENDING_CACHE_TTL', '5'))
+# Cuánto retiene el long-poll la petición esperando un cambio. Requiere ASGI
+# (SERVER_MODE=asgi con PAYMENTS_ASYNC_VIEWS=True): bajo WSGI cada espera ocuparía un
+# hilo del worker, así que ahí vale 0 y la página vuelve a preguntar cada
+# ORDER_STATUS_CLIENT_RETRY_MS. Con varios workers requiere además caché compartida
+# (CACHE_IS_SHARED) para ver los cambios que publica otro worker.
+ORDER_STATUS_WAIT_TIMEOUT = float(os.getenv('ORDER_STATUS_WAIT_TIMEOUT', '25' if PAYMENTS_ASYNC_VIEWS else '0'))
+# Un cambio publicado en el mismo proceso despierta la espera al instante; los de otros
+# workers se detectan releyendo la caché cada tantos segundos.
+ORDER_STATUS_WAIT_POLL_INTERVAL = float(os.getenv('ORDER_STATUS_WAIT_POLL_INTERVAL', '2'))
+# Milisegundos que espera la página antes de volver a preguntar si el servidor no retuvo la petición
+ORDER_STATUS_CLIENT_RETRY_MS = int(os.getenv('ORDER_STATUS_CLIENT_RETRY_MS', '3000'))
+# Máximo de órdenes (commerce_order o tokens) por consulta a order-status-bulk
+ORDER_STATUS_BULK_MAX_ITEMS = int(os.getenv('ORDER_STATUS_BULK_MAX_ITEMS', '500'))
+# Órdenes por página de query-order-status (?limit=) y el máximo que se permite pedir
+ORDER_QUERY_PAGE_SIZE = int(os.getenv('ORDER_QUERY_PAGE_SIZE', '20'))
+ORDER_QUERY_MAX_PAGE_SIZE = int(os.getenv('ORDER_QUERY_MAX_PAGE_SIZE', '100'))
+
+# --- Códigos de descuento (payments/discounts.py) ---
+# Segundos que un worker reutiliza un código leído de la BD (con caché compartida los
+# cambios lo invalidan antes; sin ella es lo que tardan los demás workers en verlos)
+# y cuántos códigos guarda como máximo en memoria.
+DISCOUNT_CODE_CACHE_TTL = int(os.getenv('DISCOUNT_CODE_CACHE_TTL', '300' if CACHE_IS_SHARED else '10'))
+DISCOUNT_CODE_CACHE_MAX_ENTRIES = int(os.getenv('DISCOUNT_CODE_CACHE_MAX_ENTRIES', '10000'))
+# Segundos que create-payment aparta un uso de un código con límite mientras el cliente paga
+DISCOUNT_RESERVATION_TTL = int(os.getenv('DISCOUNT_RESERVATION_TTL', '1800'))
+# Máximo de códigos por llamada a validate-discounts
+DISCOUNT_BATCH_VALIDATION_MAX_CODES = int(os.getenv('DISCOUNT_BATCH_VALIDATION_MAX_CODES', '200'))
+
+# --- Catálogo de productos ---
+# Productos por página del listado paginado (?limit=) y el máximo que se permite pedir
+PRODUCT_PAGE_SIZE = int(os.getenv('PRODUCT_PAGE_SIZE', '24'))
+PRODUCT_MAX_PAGE_SIZE = int(os.getenv('PRODUCT_MAX_PAGE_SIZE', '100'))
+# Caché del catálogo pre-serializado (products/catalog_cache.py): segundos que vive cada
+# entrada (con caché compartida los cambios la invalidan antes; sin ella, es lo que
+# tardan los demás workers en ver un cambio), cuánto dura el lock de reconstrucción y
+# cuánto espera un worker sin versión anterior que servir a que otro termine.
+CATALOG_CACHE_TTL = int(os.getenv('CATALOG_CACHE_TTL', '86400' if CACHE_IS_SHARED else '10'))
+CATALOG_CACHE_LOCK_TIMEOUT = int(os.getenv('CATALOG_CACHE_LOCK_TIMEOUT', '30'))
+CATALOG_CACHE_LOCK_WAIT = float(os.getenv('CATALOG_CACHE_LOCK_WAIT', '2'))
+
+# --- Cotización de carritos (payments/pricing.py) ---
+# Productos distintos que acepta un carrito en cart-quote y create-payment
+PRICING_MAX_LINE_ITEMS = int(os.getenv('PRICING_MAX_LINE_ITEMS', '100'))
+
+# --- Tarifas de envío (payments/shipping.py) ---
+# Segundos que un worker usa su tabla de tarifas en memoria antes de recargarla. Con
+# caché compartida los cambios la invalidan antes; sin ella (CACHE_IS_SHARED=False)
+# es lo que tardan los demás workers en ver una tarifa nueva.
+SHIPPING_RATES_CACHE_TTL = int(os.getenv('SHIPPING_RATES_CACHE_TTL', '3600' if CACHE_IS_SHARED else '10'))
 
 # --- Configuración de n8n ---
 N8N_SALE_WEBHOOK_URL = os.getenv('N8N_SALE_WEBHOOK_URL')
 
+# --- Outbox de notificaciones (payments/outbox.py) ---
+# Eventos por lote, reintentos con backoff exponencial (segundos) y cuánto
+# tiempo queda reservado un lote antes de que otro dispatcher pueda tomarlo.
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_RETRY_BASE_SECONDS = int(os.getenv('OUTBOX_RETRY_BASE_SECONDS', '30'))
+OUTBOX_RETRY_MAX_SECONDS = int(os.getenv('OUTBOX_RETRY_MAX_SECONDS', '3600'))
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', '120'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '2'))
+OUTBOX_HTTP_TIMEOUT = float(os.getenv('OUTBOX_HTTP_TIMEOUT', '10'))
+
 # --- Configuración de Archivos Media (para subidas locales si alguna vez se usan) ---
 # Como ahora usas URLField para la imagen principal del blog/producto,
 # estas configuraciones son más para un posible uso futuro de FileField/ImageField
@@ -157,6 +293,9 @@ if PUBLIC_URL_BASE and PUBLIC_URL_BASE not in CORS_ALLOWED_ORIGINS:
     if origin_from_public_url not in CORS_ALLOWED_ORIGINS:
          CORS_ALLOWED_ORIGINS.append(origin_from_public_url)
 
+# Headers que el frontend necesita leer: paginación de query-order-status
+CORS_EXPOSE_HEADERS = ['Link', 'X-Next-Cursor']
+
 # --- Configuración de CSRF ---
 CSRF_TRUSTED_ORIGINS_STRING = os.getenv('DJANGO_CSRF_TRUSTED_ORIGINS')
 if CSRF_TRUSTED_ORIGINS_STRING:
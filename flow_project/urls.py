@@ -4,12 +4,16 @@ from django.contrib import admin
 from django.urls import path, include
 # Estas importaciones deben coincidir con dónde realmente tienes definidas estas vistas.
 # Asumimos que ambas están en payments/views.py según nuestras últimas discusiones.
-from payments.views import health_check_view, FlowCallbackView 
+from payments import async_views, views as payment_views
+from payments.views import health_check_view
 
 # Para servir archivos media en desarrollo (DEBUG=True) y si NO usas S3 localmente
 from django.conf import settings
 from django.conf.urls.static import static
 
+# Modo ASGI (PAYMENTS_ASYNC_VIEWS): ver payments/async_views.py
+FlowCallbackView = async_views.AsyncFlowCallbackView if settings.PAYMENTS_ASYNC_VIEWS else payment_views.FlowCallbackView
+
 urlpatterns = [
     # Ruta raíz para el health check (buena práctica para Render/plataformas)
     path('', health_check_view, name='health_check'),
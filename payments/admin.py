@@ -1,12 +1,39 @@
 # payments/admin.py
 from django.contrib import admin
-from .models import Order, DiscountCode # Añade DiscountCode
+from django.utils import timezone
+from .models import Order, DiscountCode, OutboxEvent, ShippingRate # Añade DiscountCode
 
 # ... (Tu ProductAdmin y OrderAdmin existentes) ...
 
 @admin.register(DiscountCode)
 class DiscountCodeAdmin(admin.ModelAdmin):
-    list_display = ('code', 'discount_type', 'discount_value', 'is_active', 'valid_from', 'valid_until', 'min_purchase_amount', 'usage_limit', 'times_used')
+    list_display = ('code', 'discount_type', 'discount_value', 'is_active', 'valid_from', 'valid_until', 'min_purchase_amount', 'usage_limit', 'times_used', 'reserved')
     list_filter = ('is_active', 'discount_type', 'valid_from', 'valid_until')
     search_fields = ('code',)
-    list_editable = ('is_active', 'discount_value', 'usage_limit')
\ No newline at end of file
+    list_editable = ('is_active', 'discount_value', 'usage_limit')
+    readonly_fields = ('times_used', 'reserved') # Los cuenta el checkout con UPDATE atómicos
+
+
+@admin.register(ShippingRate)
+class ShippingRateAdmin(admin.ModelAdmin):
+    list_display = ('region', 'commune', 'max_weight', 'price', 'is_active', 'updated_at')
+    list_filter = ('is_active', 'region')
+    search_fields = ('region', 'commune')
+    list_editable = ('max_weight', 'price', 'is_active')
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'event_type', 'order', 'status', 'attempts', 'next_attempt_at', 'created_at', 'sent_at')
+    list_filter = ('status', 'event_type')
+    search_fields = ('order__commerce_order',)
+    readonly_fields = ('created_at', 'sent_at', 'last_error')
+    raw_id_fields = ('order',)
+    actions = ['retry_events']
+
+    @admin.action(description="Reintentar ahora los eventos seleccionados")
+    def retry_events(self, request, queryset):
+        updated = queryset.exclude(status=OutboxEvent.STATUS_SENT).update(
+            status=OutboxEvent.STATUS_PENDING, attempts=0, next_attempt_at=timezone.now()
+        )
+        self.message_user(request, f"{updated} eventos vuelven a la cola del outbox.")
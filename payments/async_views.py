@@ -0,0 +1,259 @@
+# payments/async_views.py
+"""
+Versiones async de las vistas que hablan con Flow y n8n. Pensadas para
+servirse con ASGI (uvicorn, ver flow_project/asgi.py): mientras una petición
+espera a Flow, el mismo worker atiende a las demás. Se activan con
+PAYMENTS_ASYNC_VIEWS=True (ver payments/urls.py y flow_project/urls.py).
+
+La lógica de negocio es la misma de payments/views.py (payments/services.py);
+lo que necesita transacciones o select_for_update corre vía sync_to_async.
+"""
+import json
+import logging
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, HttpResponseRedirect
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from .flow_client import (
+    get_async_flow_client,
+    FlowError,
+    FlowConfigurationError,
+    FlowCircuitOpenError,
+    FLOW_HTTP_STATUS_ERRORS,
+    FLOW_REQUEST_ERRORS,
+)
+from .models import Order
+from .order_status import FINAL_ORDER_STATUSES, wait_for_status_change
+from .services import (
+    CheckoutError,
+    create_pending_order,
+    build_flow_payment_params,
+    set_order_status,
+    complete_flow_payment,
+    apply_flow_confirmation,
+    aupdate_pending_order_status,
+    apply_callback_status_to_redirect,
+    build_fungigrow_redirect_url,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _request_data(request):
+    """Equivalente a request.data de DRF: JSON o form-data."""
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+    return request.POST
+
+
+def _flow_unavailable_response(circuit_err):
+    """503 + Retry-After mientras el circuit breaker de Flow está abierto."""
+    response = JsonResponse(
+        {"error": "Flow no está disponible en este momento. Intenta nuevamente en unos segundos.", "retry_after": circuit_err.retry_after},
+        status=503,
+    )
+    response['Retry-After'] = str(circuit_err.retry_after)
+    return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncCreatePaymentView(View):
+    """
+    Versión async de CreatePaymentView: crea la orden local y la petición de
+    pago en Flow sin bloquear el worker mientras Flow responde.
+    """
+    async def post(self, request, *args, **kwargs):
+        data = _request_data(request)
+        if data is None or not hasattr(data, 'get'):
+            return JsonResponse({"error": "El cuerpo de la petición no es un JSON válido."}, status=400)
+
+        flow_client = get_async_flow_client(request)
+        try:
+            flow_client.check_available('payment/create')
+        except FlowCircuitOpenError as circuit_err:
+            return _flow_unavailable_response(circuit_err)
+
+        try:
+            new_order = await sync_to_async(create_pending_order)(data)
+        except CheckoutError as checkout_err:
+            return JsonResponse(checkout_err.payload, status=checkout_err.http_status)
+
+        params_to_flow = build_flow_payment_params(new_order, data)
+
+        try:
+            flow_json_response = await flow_client.create_payment(params_to_flow)
+        except FlowConfigurationError as config_err:
+            await sync_to_async(set_order_status)(new_order, 'ERROR')
+            logger.critical(f"AsyncCreatePaymentView: {config_err}")
+            return JsonResponse({"error": "Configuración del servidor incompleta."}, status=500)
+        except FlowCircuitOpenError as circuit_err:
+            await sync_to_async(set_order_status)(new_order, 'REJECTED')
+            logger.error(f"AsyncCreatePaymentView: {circuit_err}")
+            return _flow_unavailable_response(circuit_err)
+        except FLOW_HTTP_STATUS_ERRORS as http_err:
+            await sync_to_async(set_order_status)(new_order, 'REJECTED')
+            try: error_content = http_err.response.json()
+            except ValueError: error_content = http_err.response.text[:500]
+            logger.error(f"AsyncCreatePaymentView: ERROR HTTP de Flow: {http_err.response.status_code} - {error_content}")
+            return JsonResponse({"error": f"Error directo de Flow: {http_err.response.status_code}", "flow_response_details": error_content}, status=502)
+        except FLOW_REQUEST_ERRORS as e:
+            await sync_to_async(set_order_status)(new_order, 'REJECTED')
+            logger.error(f"AsyncCreatePaymentView: ERROR de conexión con Flow: {e}")
+            return JsonResponse({"error": f"Error de conexión al contactar a Flow: {e}"}, status=503)
+
+        try:
+            payload = await sync_to_async(complete_flow_payment)(new_order, flow_json_response)
+        except CheckoutError as checkout_err:
+            return JsonResponse(checkout_err.payload, status=checkout_err.http_status)
+        return JsonResponse(payload, status=201)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncFlowConfirmationView(View):
+    """
+    Versión async del webhook de confirmación de Flow (FlowConfirmationView).
+    """
+    async def post(self, request, *args, **kwargs):
+        flow_token = request.POST.get('token')
+
+        if not flow_token:
+            logger.warning("AsyncFlowConfirmationView: Recibida confirmación de Flow SIN token.")
+            return JsonResponse({"error": "Token no proporcionado por Flow"}, status=400)
+
+        logger.info(f"AsyncFlowConfirmationView: Recibido token de confirmación de Flow: {flow_token}")
+
+        try:
+            payment_data_from_flow = await get_async_flow_client(request).get_status(flow_token, final_only=True)
+
+            commerce_order_id = payment_data_from_flow.get('commerceOrder')
+
+            if not commerce_order_id:
+                logger.error(f"AsyncFlowConfirmationView: Flow no devolvió commerceOrder para el token {flow_token}. Respuesta de Flow: {payment_data_from_flow}")
+                return HttpResponse(status=200) # OK a Flow para que no reintente, pero logueamos el error.
+
+            # La transición necesita transaction.atomic + select_for_update, que el ORM async no soporta
+            order_to_update, should_trigger_n8n = await sync_to_async(apply_flow_confirmation)(flow_token, payment_data_from_flow)
+
+            if should_trigger_n8n: # La entrega a n8n la hace el dispatcher del outbox (payments/outbox.py)
+                logger.info(f"AsyncFlowConfirmationView: Venta de orden {commerce_order_id} encolada para n8n.")
+
+        except FLOW_HTTP_STATUS_ERRORS as http_err: # Errores 4xx/5xx de la llamada a Flow getStatus
+            logger.error(f"AsyncFlowConfirmationView: HTTPError al contactar Flow getStatus (token {flow_token}): {http_err.response.status_code} - {http_err.response.text[:200]}")
+            if http_err.response.status_code == 400:
+                return JsonResponse({"error": "Token inválido o petición malformada a Flow getStatus"}, status=400)
+            return JsonResponse({"error": "Error comunicándose con Flow"}, status=503)
+
+        except FLOW_REQUEST_ERRORS as e: # Errores de red al llamar a Flow getStatus
+            logger.error(f"AsyncFlowConfirmationView: RequestError al contactar Flow getStatus (token {flow_token}): {e}")
+            return JsonResponse({"error": "Error de red comunicándose con Flow"}, status=503)
+
+        except FlowCircuitOpenError as circuit_err:
+            logger.warning(f"AsyncFlowConfirmationView: {circuit_err} (token {flow_token})")
+            return _flow_unavailable_response(circuit_err)
+
+        except FlowError as e:
+            logger.critical(f"AsyncFlowConfirmationView: No se pudo consultar Flow getStatus (token {flow_token}): {e}")
+            return JsonResponse({"error": "Configuración del servidor incompleta."}, status=503)
+
+        except Exception as e:
+            logger.critical(f"AsyncFlowConfirmationView: Error crítico inesperado procesando confirmación (token {flow_token}): {e}", exc_info=True)
+            return JsonResponse({"error": "Error interno del servidor"}, status=500)
+
+        return HttpResponse(status=200)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncFlowCallbackView(View):
+    """
+    Versión async de FlowCallbackView (urlReturn de Flow): verifica el estado
+    con Flow y redirige al usuario a FungiGrow.
+    """
+    async def handle_callback(self, request):
+        flow_token = request.POST.get('token') or request.GET.get('token')
+
+        redirect_params = {
+            'orderId': 'desconocido',
+            'status': 'error',
+            'message': 'Error_procesando_pago_interno'
+        }
+
+        if not flow_token:
+            redirect_params['message'] = 'Token_de_Flow_no_recibido_en_callback'
+            return HttpResponseRedirect(build_fungigrow_redirect_url(redirect_params))
+
+        order_in_db = await Order.objects.filter(flow_token=flow_token).afirst()
+        if order_in_db:
+            redirect_params['orderId'] = order_in_db.commerce_order
+        else:
+            logger.warning(f"AsyncFlowCallbackView: No se encontró orden con flow_token {flow_token} en el callback.")
+
+        try:
+            payment_data = await get_async_flow_client(request).get_status(flow_token)
+
+            flow_status_code = payment_data.get('status')
+            commerce_order_from_flow = payment_data.get('commerceOrder')
+
+            order_to_update = None
+            if commerce_order_from_flow:
+                if order_in_db and order_in_db.commerce_order == commerce_order_from_flow:
+                    order_to_update = order_in_db
+                else:
+                    order_to_update = await Order.objects.filter(commerce_order=commerce_order_from_flow).afirst()
+
+            if order_to_update:
+                # Solo actualizamos si está PENDING para no sobrescribir un estado final del webhook
+                if order_to_update.status == 'PENDING':
+                    await aupdate_pending_order_status(order_to_update, flow_status_code, flow_token=flow_token)
+                elif not order_to_update.flow_token:
+                    await Order.objects.filter(pk=order_to_update.pk, flow_token__isnull=True).aupdate(flow_token=flow_token)
+            else:
+                logger.warning(f"AsyncFlowCallbackView: No se encontró orden local para commerceOrder {commerce_order_from_flow} devuelto por Flow en callback.")
+
+            apply_callback_status_to_redirect(payment_data, redirect_params)
+
+        except (httpx.HTTPError, requests.exceptions.RequestException, FlowError) as e:
+            logger.error(f"AsyncFlowCallbackView: Error al consultar estado en Flow: {e}")
+            redirect_params['status'] = 'error'
+            redirect_params['message'] = 'Fallo en la verificacion del estado con Flow'
+
+        return HttpResponseRedirect(build_fungigrow_redirect_url(redirect_params))
+
+    async def get(self, request, *args, **kwargs):
+        return await self.handle_callback(request)
+
+    async def post(self, request, *args, **kwargs):
+        return await self.handle_callback(request)
+
+
+class OrderStatusWaitView(View):
+    """
+    Long-poll del estado de una orden para las páginas de resultado: la
+    página envía el último estado que conoce (?status=PENDING) y la petición
+    queda abierta hasta que la orden cambie o pasen ORDER_STATUS_WAIT_TIMEOUT
+    segundos. Mientras espera solo lee la caché (payments/order_status.py).
+    `retry_ms` le indica a la página cuánto esperar antes de volver a preguntar.
+    """
+    async def get(self, request, commerce_order, *args, **kwargs):
+        known_status = request.GET.get('status')
+        timeout = settings.ORDER_STATUS_WAIT_TIMEOUT if known_status else 0
+        snapshot, changed = await wait_for_status_change(commerce_order, known_status, timeout)
+        if snapshot is None:
+            return JsonResponse({"error": "Orden no encontrada"}, status=404)
+
+        is_final = snapshot['status'] in FINAL_ORDER_STATUSES
+        return JsonResponse({
+            "status": snapshot['status'],
+            "final": is_final,
+            "changed": changed,
+            # Si el servidor retuvo la petición, la página puede volver a preguntar de inmediato
+            "retry_ms": 0 if settings.ORDER_STATUS_WAIT_TIMEOUT > 0 else settings.ORDER_STATUS_CLIENT_RETRY_MS,
+        })
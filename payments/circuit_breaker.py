@@ -0,0 +1,209 @@
+# payments/circuit_breaker.py
+"""
+Circuit breaker y timeout adaptativo por endpoint de Flow (payment/create,
+payment/getStatus), usado por FlowClient y AsyncFlowClient.
+
+Cada breaker mira una ventana deslizante de FLOW_BREAKER_WINDOW_SECONDS con
+el resultado y la latencia de cada llamada:
+
+- CERRADO: deja pasar todo. Si en la ventana hay al menos FLOW_BREAKER_MIN_CALLS
+  llamadas y la tasa de errores (red, timeout, 5xx) supera FLOW_BREAKER_ERROR_RATE
+  o la de llamadas lentas supera FLOW_BREAKER_SLOW_CALL_RATE, se abre.
+- ABIERTO: rechaza de inmediato con FlowCircuitOpenError (las vistas responden
+  503 + Retry-After) durante FLOW_BREAKER_OPEN_SECONDS, sin ocupar un worker
+  esperando a Flow.
+- SEMI-ABIERTO: pasado ese tiempo deja salir hasta FLOW_BREAKER_HALF_OPEN_PROBES
+  llamadas de prueba. Si responden bien se cierra; si fallan, vuelve a abrirse.
+
+El timeout de lectura se adapta a la latencia observada: p95 de las llamadas
+exitosas por FLOW_ADAPTIVE_TIMEOUT_MULTIPLIER, entre FLOW_ADAPTIVE_TIMEOUT_MIN y
+FLOW_READ_TIMEOUT. El estado es por proceso (cada worker decide por su cuenta).
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+# Tope de muestras en la ventana para no crecer sin límite con mucho tráfico
+MAX_WINDOW_SAMPLES = 1000
+
+
+def percentile(sorted_values, fraction):
+    """Percentil (0..1) de una lista ya ordenada, por el método nearest-rank."""
+    if not sorted_values:
+        return None
+    index = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=MAX_WINDOW_SAMPLES) # (momento, falló, latencia)
+        self.state = STATE_CLOSED
+        self.opened_at = None
+        self._probes_in_flight = 0
+
+        # Contadores acumulados para las métricas
+        self.trips = 0
+        self.rejected = 0
+        self.calls = 0
+        self.failures = 0
+
+    # --- Estado ---
+    def _prune(self, now):
+        window_start = now - settings.FLOW_BREAKER_WINDOW_SECONDS
+        while self._samples and self._samples[0][0] < window_start:
+            self._samples.popleft()
+
+    def _open(self, now):
+        self.state = STATE_OPEN
+        self.opened_at = now
+        self._probes_in_flight = 0
+        self.trips += 1
+
+    def retry_after(self, now=None):
+        """Segundos que faltan para el siguiente intento (0 si el circuito no está abierto)."""
+        if self.state != STATE_OPEN:
+            return 0
+        now = time.monotonic() if now is None else now
+        return max(math.ceil(self.opened_at + settings.FLOW_BREAKER_OPEN_SECONDS - now), 1)
+
+    def rejecting_for(self, now=None):
+        """
+        Segundos durante los que before_call seguirá rechazando llamadas, o 0
+        si ya deja pasar (cerrado, semi-abierto o abierto con el plazo cumplido,
+        en cuyo caso la siguiente llamada es la prueba de semi-abierto).
+        """
+        now = time.monotonic() if now is None else now
+        if self.state != STATE_OPEN or now - self.opened_at >= settings.FLOW_BREAKER_OPEN_SECONDS:
+            return 0
+        return self.retry_after(now)
+
+    def before_call(self):
+        """
+        Registra el inicio de una llamada. Devuelve True si es una prueba en
+        semi-abierto; lanza FlowCircuitOpenError si el circuito no deja pasar.
+        """
+        from .flow_client import FlowCircuitOpenError # Import diferido: flow_client importa este módulo
+
+        with self._lock:
+            now = time.monotonic()
+            if self.state == STATE_OPEN:
+                if now - self.opened_at >= settings.FLOW_BREAKER_OPEN_SECONDS:
+                    self.state = STATE_HALF_OPEN
+                    self._probes_in_flight = 0
+                else:
+                    self.rejected += 1
+                    raise FlowCircuitOpenError(self.name, self.retry_after(now))
+
+            if self.state == STATE_HALF_OPEN:
+                if self._probes_in_flight >= settings.FLOW_BREAKER_HALF_OPEN_PROBES:
+                    self.rejected += 1
+                    raise FlowCircuitOpenError(self.name, 1)
+                self._probes_in_flight += 1
+                return True
+            return False
+
+    def record(self, failed, latency, probe=False):
+        """Registra el resultado de una llamada y abre o cierra el circuito según corresponda."""
+        with self._lock:
+            now = time.monotonic()
+            self.calls += 1
+            if failed:
+                self.failures += 1
+            self._samples.append((now, failed, latency))
+
+            if probe:
+                self._probes_in_flight = max(self._probes_in_flight - 1, 0)
+            if self.state == STATE_HALF_OPEN:
+                if failed:
+                    self._open(now)
+                elif probe:
+                    # Flow respondió bien a la prueba: se cierra y la ventana parte de cero
+                    self.state = STATE_CLOSED
+                    self.opened_at = None
+                    self._samples.clear()
+                return
+
+            if self.state == STATE_CLOSED:
+                self._prune(now)
+                total = len(self._samples)
+                if total < settings.FLOW_BREAKER_MIN_CALLS:
+                    return
+                failed_calls = sum(1 for _, sample_failed, _ in self._samples if sample_failed)
+                slow_calls = sum(1 for _, _, sample_latency in self._samples if sample_latency >= settings.FLOW_BREAKER_SLOW_CALL_SECONDS)
+                if failed_calls / total >= settings.FLOW_BREAKER_ERROR_RATE or slow_calls / total >= settings.FLOW_BREAKER_SLOW_CALL_RATE:
+                    self._open(now)
+
+    def release(self, probe):
+        """Libera una llamada que terminó sin resultado atribuible a Flow (p. ej. cancelada)."""
+        if probe:
+            with self._lock:
+                self._probes_in_flight = max(self._probes_in_flight - 1, 0)
+
+    # --- Timeout adaptativo ---
+    def _success_latencies(self):
+        return sorted(latency for _, failed, latency in self._samples if not failed)
+
+    def read_timeout(self, default):
+        """Timeout de lectura para la próxima llamada según la latencia reciente."""
+        with self._lock:
+            self._prune(time.monotonic())
+            latencies = self._success_latencies()
+        if len(latencies) < settings.FLOW_BREAKER_MIN_CALLS:
+            return default
+        adaptive = percentile(latencies, 0.95) * settings.FLOW_ADAPTIVE_TIMEOUT_MULTIPLIER
+        return min(max(adaptive, settings.FLOW_ADAPTIVE_TIMEOUT_MIN), default)
+
+    # --- Métricas ---
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            latencies = self._success_latencies()
+            window_calls = len(self._samples)
+            window_failures = sum(1 for _, failed, _ in self._samples if failed)
+            return {
+                'state': self.state,
+                'retry_after': self.retry_after(now),
+                'trips': self.trips,
+                'rejected': self.rejected,
+                'calls': self.calls,
+                'failures': self.failures,
+                'window_calls': window_calls,
+                'window_error_rate': round(window_failures / window_calls, 3) if window_calls else 0.0,
+                'latency_p50': percentile(latencies, 0.50),
+                'latency_p95': percentile(latencies, 0.95),
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint):
+    """Breaker del proceso para un endpoint de Flow; lo comparten el cliente síncrono y el async."""
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(endpoint, CircuitBreaker(endpoint))
+    return breaker
+
+
+def breaker_metrics():
+    """Estado y contadores de todos los breakers del proceso, con el timeout de lectura vigente."""
+    endpoints = {}
+    for endpoint, breaker in list(_breakers.items()):
+        metrics = breaker.snapshot()
+        metrics['read_timeout'] = breaker.read_timeout(settings.FLOW_READ_TIMEOUT)
+        endpoints[endpoint] = metrics
+    return {'pid': os.getpid(), 'endpoints': endpoints}
@@ -0,0 +1,342 @@
+# payments/discounts.py
+"""
+Caché en memoria de los códigos de descuento, por proceso.
+
+validate-discount se llama en cada cambio del carrito (y a veces en cada
+tecla), así que cada código consultado queda en un diccionario del worker
+por su forma normalizada: validarlo de nuevo es un lookup más is_valid(),
+sin consultas. También se recuerdan los códigos que no existen, para que
+los prefijos que se van tipeando no vuelvan a la BD.
+
+Se carga por código (no la tabla entera: las campañas generan decenas de
+miles de códigos de un solo uso) y se vacía cuando un DiscountCode se guarda
+o se borra (payments/signals.py). Para que se enteren los demás workers se
+incrementa una versión en la caché de Django, que cada worker compara antes
+de usar su copia; eso requiere una caché compartida (settings.CACHE_IS_SHARED).
+Sin ella solo se entera el worker que hizo el cambio y los demás lo ven al
+vencer DISCOUNT_CODE_CACHE_TTL (10 s por defecto en ese caso). Los UPDATE en
+bloque no disparan señales: quien los haga debe llamar a
+invalidate_discount_codes().
+
+Usos de los códigos con límite (usage_limit):
+
+- create-payment aparta un uso con un UPDATE condicional sobre el contador
+  `reserved` (WHERE times_used + reserved < usage_limit) y crea una
+  DiscountReservation que vence en DISCOUNT_RESERVATION_TTL segundos. Si no
+  queda cupo, el checkout se rechaza: dos compradores no pueden llevarse el
+  último uso.
+- Al pasar la orden a PAID la reserva se convierte en uso (times_used + 1,
+  reserved - 1). Si ya había vencido, se cuenta con el UPDATE condicional
+  WHERE times_used + reserved < usage_limit.
+- Si la orden se rechaza la reserva se libera; las vencidas se liberan cuando
+  un código se queda sin cupo y en cada reconciliación.
+
+Cada paso es un solo UPDATE sobre la fila del código, sin leerla antes ni
+tomar select_for_update: el lock dura lo que dura ese UPDATE dentro de una
+transacción corta, así que cientos de checkouts del mismo código no hacen fila.
+La reconciliación, que cierra cientos de órdenes en una transacción, usa las
+versiones en bloque (consume_discount_codes, release_discount_reservations):
+un UPDATE por código en vez de uno por orden.
+"""
+import logging
+import secrets
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.db.models.constants import OnConflict
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import DiscountCode, DiscountReservation, normalize_discount_code
+
+logger = logging.getLogger(__name__)
+
+DISCOUNT_CODES_VERSION_KEY = 'discount-codes-version'
+
+
+class DiscountCodeCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {} # código normalizado -> (DiscountCode o None, cargado en)
+        self._version = None
+
+    def _sync_version(self):
+        version = cache.get(DISCOUNT_CODES_VERSION_KEY)
+        if version is None:
+            # Sin versión compartida (caché reiniciada): se parte una nueva, distinta de la que se tenía
+            cache.add(DISCOUNT_CODES_VERSION_KEY, time.time_ns(), None)
+            version = cache.get(DISCOUNT_CODES_VERSION_KEY)
+        if version != self._version:
+            with self._lock:
+                self._entries.clear()
+                self._version = version
+
+    def get(self, code):
+        """DiscountCode de `code` (sin distinguir mayúsculas) o None. Las instancias son compartidas: no modificarlas."""
+        normalized = normalize_discount_code(code)
+        if not normalized:
+            return None
+        self._sync_version()
+        entry = self._entries.get(normalized)
+        if entry is not None and time.monotonic() - entry[1] < settings.DISCOUNT_CODE_CACHE_TTL:
+            return entry[0]
+
+        discount_code = DiscountCode.objects.filter(code_normalized=normalized).first()
+        with self._lock:
+            if len(self._entries) >= settings.DISCOUNT_CODE_CACHE_MAX_ENTRIES:
+                self._entries.pop(next(iter(self._entries))) # El más antiguo
+            self._entries[normalized] = (discount_code, time.monotonic())
+        return discount_code
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+
+_discount_codes = DiscountCodeCache()
+
+
+def get_discount_code(code):
+    """Código de descuento por su texto (sin distinguir mayúsculas), o None si no existe. Validarlo con is_valid()."""
+    return _discount_codes.get(code)
+
+
+def invalidate_discount_codes():
+    """Descarta los códigos en memoria de todos los workers (los de este de inmediato)."""
+    try:
+        cache.incr(DISCOUNT_CODES_VERSION_KEY)
+    except ValueError: # La clave no existe todavía
+        cache.set(DISCOUNT_CODES_VERSION_KEY, time.time_ns(), None)
+    _discount_codes.clear()
+
+
+# --- Usos y reservas ---
+def _has_room():
+    return Q(usage_limit__gt=F('times_used') + F('reserved'))
+
+
+def reserve_discount_code(discount_code, order):
+    """
+    Aparta un uso de `discount_code` para `order` (llamar dentro de la
+    transacción que crea la orden). Los códigos sin límite no se reservan.
+    Devuelve False si el código ya no tiene cupo.
+    """
+    if discount_code.usage_limit is None:
+        return True
+    taken = DiscountCode.objects.filter(_has_room(), pk=discount_code.pk).update(reserved=F('reserved') + 1)
+    if not taken and release_expired_reservations(discount_code_id=discount_code.pk):
+        taken = DiscountCode.objects.filter(_has_room(), pk=discount_code.pk).update(reserved=F('reserved') + 1)
+    if not taken:
+        return False
+    DiscountReservation.objects.create(
+        discount_code_id=discount_code.pk,
+        order=order,
+        expires_at=timezone.now() + timedelta(seconds=settings.DISCOUNT_RESERVATION_TTL),
+    )
+    return True
+
+
+def _take_reservation(order):
+    """Borra la reserva de la orden. Devuelve el id del código reservado, o None si no tenía (o ya la borró otro)."""
+    discount_code_id = DiscountReservation.objects.filter(order_id=order.pk).values_list('discount_code_id', flat=True).first()
+    if discount_code_id is None:
+        return None
+    deleted, _ = DiscountReservation.objects.filter(order_id=order.pk).delete()
+    return discount_code_id if deleted else None
+
+
+def consume_discount_code(order):
+    """
+    Cuenta el uso del código de la orden al pasar a PAID (dentro de la misma
+    transacción). Devuelve False si el código ya no tenía cupo y el uso no se contó.
+    """
+    if not order.applied_discount_code:
+        return True
+    discount_code_id = _take_reservation(order)
+    if discount_code_id is not None:
+        DiscountCode.objects.filter(pk=discount_code_id).update(
+            times_used=F('times_used') + 1, reserved=Greatest(F('reserved') - 1, 0)
+        )
+        return True
+
+    # Sin reserva (venció, o la orden es anterior a las reservas): solo si queda cupo
+    counted = DiscountCode.objects.filter(
+        Q(usage_limit__isnull=True) | _has_room(),
+        code_normalized=normalize_discount_code(order.applied_discount_code),
+    ).update(times_used=F('times_used') + 1)
+    if not counted:
+        logger.warning(
+            f"Orden {order.commerce_order} pagada con el código {order.applied_discount_code}, que ya no tenía usos disponibles; no se contabiliza."
+        )
+        invalidate_discount_codes()
+    return bool(counted)
+
+
+def release_discount_reservation(order):
+    """Devuelve al código el uso reservado por una orden que no se pagó."""
+    if not order.applied_discount_code:
+        return
+    discount_code_id = _take_reservation(order)
+    if discount_code_id is not None:
+        DiscountCode.objects.filter(pk=discount_code_id).update(reserved=Greatest(F('reserved') - 1, 0))
+
+
+def _take_reservations(orders):
+    """_take_reservation para muchas órdenes: {order.pk: id del código} de las reservas que se borraron."""
+    reservations = dict(
+        DiscountReservation.objects.select_for_update() # Para que release_expired_reservations no descuente las mismas
+        .filter(order_id__in=[order.pk for order in orders])
+        .values_list('order_id', 'discount_code_id')
+    )
+    if reservations:
+        DiscountReservation.objects.filter(order_id__in=list(reservations)).delete()
+    return reservations
+
+
+def consume_discount_codes(orders):
+    """
+    consume_discount_code para muchas órdenes que pasan a PAID en la misma
+    transacción: un UPDATE por código en vez de uno por orden. Las órdenes sin
+    reserva se cuentan mientras quede cupo, leyendo el código con
+    select_for_update. Devuelve las órdenes cuyo uso no se pudo contar.
+    """
+    orders = [order for order in orders if order.applied_discount_code]
+    if not orders:
+        return []
+    reserved = _take_reservations(orders)
+    for discount_code_id, uses in Counter(reserved.values()).items():
+        DiscountCode.objects.filter(pk=discount_code_id).update(
+            times_used=F('times_used') + uses, reserved=Greatest(F('reserved') - uses, 0)
+        )
+
+    unreserved = {} # código normalizado -> órdenes sin reserva
+    for order in orders:
+        if order.pk not in reserved:
+            unreserved.setdefault(normalize_discount_code(order.applied_discount_code), []).append(order)
+    not_counted = []
+    if unreserved:
+        codes = DiscountCode.objects.select_for_update().filter(code_normalized__in=list(unreserved)).only(
+            'code_normalized', 'usage_limit', 'times_used', 'reserved'
+        )
+        for discount_code in codes:
+            code_orders = unreserved.pop(discount_code.code_normalized)
+            room = len(code_orders)
+            if discount_code.usage_limit is not None:
+                room = max(discount_code.usage_limit - discount_code.times_used - discount_code.reserved, 0)
+            counted = min(room, len(code_orders))
+            if counted:
+                DiscountCode.objects.filter(pk=discount_code.pk).update(times_used=F('times_used') + counted)
+            not_counted += code_orders[counted:]
+        not_counted += [order for code_orders in unreserved.values() for order in code_orders] # Códigos que ya no existen
+
+    for order in not_counted:
+        logger.warning(
+            f"Orden {order.commerce_order} pagada con el código {order.applied_discount_code}, que ya no tenía usos disponibles; no se contabiliza."
+        )
+    if not_counted:
+        invalidate_discount_codes()
+    return not_counted
+
+
+def release_discount_reservations(orders):
+    """release_discount_reservation para muchas órdenes: un UPDATE por código."""
+    reserved = _take_reservations([order for order in orders if order.applied_discount_code])
+    for discount_code_id, uses in Counter(reserved.values()).items():
+        DiscountCode.objects.filter(pk=discount_code_id).update(reserved=Greatest(F('reserved') - uses, 0))
+
+
+def release_expired_reservations(discount_code_id=None, batch_size=1000):
+    """Libera las reservas vencidas (de un código o de todos). Devuelve cuántas liberó."""
+    expired = DiscountReservation.objects.filter(expires_at__lte=timezone.now())
+    if discount_code_id is not None:
+        expired = expired.filter(discount_code_id=discount_code_id)
+
+    released = 0
+    while True:
+        by_code = {}
+        for code_id, reservation_id in expired.values_list('discount_code_id', 'pk')[:batch_size]:
+            by_code.setdefault(code_id, []).append(reservation_id)
+        if not by_code:
+            return released
+        for code_id, reservation_ids in by_code.items():
+            # Se descuenta lo que este DELETE borró de verdad: otro proceso puede haber liberado las mismas
+            deleted, _ = DiscountReservation.objects.filter(pk__in=reservation_ids).delete()
+            if deleted:
+                DiscountCode.objects.filter(pk=code_id).update(reserved=Greatest(F('reserved') - deleted, 0))
+                released += deleted
+
+
+# --- Generación en bloque ---
+# Sin caracteres que se confunden al leerlos o dictarlos (0/O, 1/I/L)
+CODE_ALPHABET = 'ABCDEFGHJKMNPQRSTUVWXYZ23456789'
+
+
+_system_random = secrets.SystemRandom()
+
+
+def _random_codes(count, prefix, length):
+    return {f"{prefix}{''.join(_system_random.choices(CODE_ALPHABET, k=length))}" for _ in range(count)}
+
+
+def _insert_codes(codes, template, created_at):
+    """
+    INSERT de `codes` (ya normalizados) con los campos de `template`, sin
+    pasar por el ORM fila por fila: los valores del template se preparan una
+    sola vez y se usa executemany. Los que chocan con un código existente
+    (code es único) se ignoran. Devuelve cuántas filas se insertaron.
+    """
+    template_code = DiscountCode(code='', **template)
+    template_code.created_at = template_code.updated_at = created_at
+    fields = [field for field in DiscountCode._meta.concrete_fields if not field.primary_key]
+    fixed = {
+        field.attname: field.get_db_prep_save(getattr(template_code, field.attname), connection)
+        for field in fields if field.attname not in ('code', 'code_normalized')
+    }
+    quote_name = connection.ops.quote_name
+    sql = (
+        f"{connection.ops.insert_statement(on_conflict=OnConflict.IGNORE)} {quote_name(DiscountCode._meta.db_table)} "
+        f"({', '.join(quote_name(field.column) for field in fields)}) VALUES ({', '.join(['%s'] * len(fields))}) "
+        f"{connection.ops.on_conflict_suffix_sql(fields, OnConflict.IGNORE, None, None)}"
+    )
+    rows = [[code if field.attname in ('code', 'code_normalized') else fixed[field.attname] for field in fields] for code in codes]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+        return cursor.rowcount
+
+
+def generate_discount_codes(count, template, prefix='', length=10, batch_size=5000):
+    """
+    Crea `count` códigos únicos con los campos de `template` (discount_type,
+    discount_value, usage_limit, valid_until...) por lotes de `batch_size`,
+    un INSERT ... ON CONFLICT DO NOTHING por lote sin consultar antes qué
+    códigos existen. Solo si el lote choca con alguno ya existente (muy raro:
+    31^length combinaciones) se consulta cuáles quedaron y se repone la
+    diferencia. Devuelve la lista de códigos creados.
+    """
+    prefix = normalize_discount_code(prefix)
+    max_length = DiscountCode._meta.get_field('code').max_length
+    if len(prefix) + length > max_length:
+        raise ValueError(f"El prefijo más {length} caracteres supera el largo máximo de un código ({max_length}).")
+    if len(CODE_ALPHABET) ** length < count * 100:
+        raise ValueError(f"{length} caracteres aleatorios son muy pocos para {count} códigos únicos.")
+
+    created = []
+    while len(created) < count:
+        batch = _random_codes(min(batch_size, count - len(created)), prefix, length) # Puede traer menos por repetidos: se reponen en la vuelta siguiente
+        created_at = timezone.now()
+        with transaction.atomic(): # Un commit por lote y no por fila
+            inserted = _insert_codes(batch, template, created_at)
+            if inserted < len(batch):
+                # Algunos ya existían: los nuestros son los de este lote con este created_at exacto
+                batch = set(DiscountCode.objects.filter(code__in=batch, created_at=created_at).values_list('code', flat=True))
+        created.extend(batch)
+    # Los INSERT directos no disparan señales, y la caché puede recordar alguno de estos como inexistente
+    invalidate_discount_codes()
+    return created
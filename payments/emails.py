@@ -1,9 +1,37 @@
 # payments/emails.py
+"""
+Emails de órdenes. Las funciones send_* ya no hablan con el servidor SMTP:
+arman el mensaje y lo encolan en el outbox (OutboxEvent de tipo 'email').
+El dispatcher (`python manage.py dispatch_outbox`) los entrega reutilizando
+una sola conexión SMTP y send_messages por lotes, con reintentos
+(ver deliver_emails en payments/outbox.py).
+"""
 import os
-from django.core.mail import send_mail
 from django.conf import settings
 from django.template.loader import render_to_string # Para usar templates HTML en el futuro
 
+from .models import OutboxEvent
+from .outbox import enqueue_event
+
+
+def queue_email(order, subject, message_body, recipient_list, from_email=None, events=None):
+    """
+    Encola un email de texto plano para el dispatcher del outbox. Con `events`
+    (una lista) el evento se agrega ahí sin guardar, para que el llamador lo
+    inserte junto con otros en un bulk_create.
+    """
+    payload = {
+        "subject": subject,
+        "body": message_body,
+        "from_email": from_email or settings.DEFAULT_FROM_EMAIL,
+        "to": list(recipient_list),
+    }
+    if events is not None:
+        event = OutboxEvent(event_type=OutboxEvent.TYPE_EMAIL, payload=payload, order=order)
+        events.append(event)
+        return event
+    return enqueue_event(OutboxEvent.TYPE_EMAIL, payload, order=order)
+
 def format_order_details_for_email(order):
     # Helper para formatear los detalles comunes
     details = f"ID de Orden FungiGrow: {order.commerce_order}\n"
@@ -20,7 +48,7 @@ def format_order_details_for_email(order):
     details += f"  Email Cliente: {order.customer_email or 'No especificado'}\n"
     return details
 
-def send_new_sale_to_owner(order):
+def send_new_sale_to_owner(order, events=None):
     subject = f"¡Nueva Venta en FungiGrow! Orden #{order.commerce_order}"
 
     message_body = "Hola Dueño de FungiGrow,\n\n"
@@ -28,16 +56,14 @@ def send_new_sale_to_owner(order):
     message_body += format_order_details_for_email(order)
     message_body += "\nSaludos,\nTu Sistema de Pagos FungiGrow"
 
-    from_email = settings.DEFAULT_FROM_EMAIL
-    recipient_list = [settings.STORE_OWNER_EMAIL]
+    if not settings.STORE_OWNER_EMAIL:
+        print(f"No se puede enviar email de nueva venta para orden {order.commerce_order}: STORE_OWNER_EMAIL no configurado.")
+        return
 
-    try:
-        send_mail(subject, message_body, from_email, recipient_list, fail_silently=False)
-        print(f"Email de nueva venta enviado a {settings.STORE_OWNER_EMAIL} para orden {order.commerce_order}")
-    except Exception as e:
-        print(f"Error al enviar email de nueva venta al dueño: {e}")
+    queue_email(order, subject, message_body, [settings.STORE_OWNER_EMAIL], events=events)
+    print(f"Email de nueva venta encolado para {settings.STORE_OWNER_EMAIL} (orden {order.commerce_order})")
 
-def send_payment_confirmation_to_customer(order):
+def send_payment_confirmation_to_customer(order, events=None):
     if not order.customer_email:
         print(f"No se puede enviar email a cliente para orden {order.commerce_order}: email no proporcionado.")
         return
@@ -64,11 +90,22 @@ def send_payment_confirmation_to_customer(order):
         print(f"No se enviará email a cliente para orden {order.commerce_order} con estado {order.status}")
         return
 
-    from_email = settings.DEFAULT_FROM_EMAIL
-    recipient_list = [order.customer_email]
+    queue_email(order, subject, message_body, [order.customer_email], events=events)
+    print(f"Email de confirmación/estado encolado para {order.customer_email} (orden {order.commerce_order})")
+
 
-    try:
-        send_mail(subject, message_body, from_email, recipient_list, fail_silently=False)
-        print(f"Email de confirmación/estado enviado a {order.customer_email} para orden {order.commerce_order}")
-    except Exception as e:
-        print(f"Error al enviar email al cliente {order.customer_email}: {e}")
\ No newline at end of file
+def queue_order_status_emails(order, previous_status, events=None):
+    """
+    Encola los emails que corresponden a un cambio de estado de la orden: al
+    pasar a PAID, aviso al dueño y confirmación al cliente; al pasar de
+    PENDING a REJECTED, aviso de rechazo al cliente. Solo con
+    ORDER_EMAILS_ENABLED=True (por defecto n8n se encarga de las notificaciones).
+    Con `events` los eventos se agregan a esa lista sin guardar (ver queue_email).
+    """
+    if not settings.ORDER_EMAILS_ENABLED:
+        return
+    if order.status == 'PAID' and previous_status != 'PAID':
+        send_new_sale_to_owner(order, events=events)
+        send_payment_confirmation_to_customer(order, events=events)
+    elif order.status == 'REJECTED' and previous_status == 'PENDING':
+        send_payment_confirmation_to_customer(order, events=events)
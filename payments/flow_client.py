@@ -0,0 +1,476 @@
+# payments/flow_client.py
+import hmac
+import hashlib
+import logging
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+
+from .circuit_breaker import get_breaker
+
+logger = logging.getLogger(__name__)
+
+
+# --- Función Auxiliar para firmar los parámetros ---
+def sign_params(params, secret_key):
+    """
+    Firma los parámetros para la API de Flow usando HMAC-SHA256.
+    """
+    sorted_params = OrderedDict(sorted(params.items()))
+    param_string = "".join([f"{k}{v}" for k, v in sorted_params.items()])
+    signature = hmac.new(
+        secret_key.encode('utf-8'),
+        param_string.encode('utf-8'),
+        hashlib.sha256
+    ).hexdigest()
+    return signature
+
+
+# Estados de payment/getStatus
+FLOW_STATUS_PENDING = 1
+FLOW_STATUS_PAID = 2
+FLOW_STATUS_REJECTED = 3
+FLOW_STATUS_CANCELLED = 4
+FLOW_FINAL_STATUSES = (FLOW_STATUS_PAID, FLOW_STATUS_REJECTED, FLOW_STATUS_CANCELLED)
+
+STATUS_CACHE_KEY_PREFIX = 'flow:status:'
+STATUS_LOCK_KEY_PREFIX = 'flow:status-lock:'
+
+
+def status_cache_key(flow_token):
+    return f"{STATUS_CACHE_KEY_PREFIX}{flow_token}"
+
+
+def status_lock_key(flow_token):
+    return f"{STATUS_LOCK_KEY_PREFIX}{flow_token}"
+
+
+class _InFlightCall:
+    """Consulta a getStatus en curso dentro del proceso; los demás hilos esperan su resultado."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class FlowError(Exception):
+    """Error base del cliente de Flow."""
+
+
+class FlowConfigurationError(FlowError):
+    """Falta configuración (URL base, apiKey o secretKey) para hablar con Flow."""
+
+
+class FlowCircuitOpenError(FlowError):
+    """
+    El circuit breaker del endpoint está abierto: Flow viene fallando o
+    respondiendo lento y no se lo llama. Las vistas responden 503 con
+    Retry-After = `retry_after` segundos.
+    """
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"Circuito abierto para Flow {endpoint}; reintentar en {retry_after}s.")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+# Errores HTTP de Flow según el cliente: httpx (AsyncFlowClient) o requests (FlowClient, ThreadedFlowClient)
+FLOW_HTTP_STATUS_ERRORS = (httpx.HTTPStatusError, requests.exceptions.HTTPError)
+FLOW_REQUEST_ERRORS = (httpx.RequestError, requests.exceptions.RequestException) # Capturar después de FLOW_HTTP_STATUS_ERRORS
+
+
+class BaseFlowClient:
+    """
+    Configuración, firma y política de caché comunes a los clientes de Flow
+    síncrono (FlowClient) y asíncrono (AsyncFlowClient).
+    """
+    def __init__(self, api_key=None, secret_key=None, base_url=None,
+                 connect_timeout=None, read_timeout=None, pool_maxsize=None):
+        self.api_key = api_key if api_key is not None else settings.FLOW_API_KEY
+        self.secret_key = secret_key if secret_key is not None else settings.FLOW_SECRET_KEY
+        base_url = base_url if base_url is not None else settings.FLOW_API_URL_PROD
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.connect_timeout = connect_timeout if connect_timeout is not None else settings.FLOW_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout if read_timeout is not None else settings.FLOW_READ_TIMEOUT
+        self.pool_maxsize = pool_maxsize if pool_maxsize is not None else settings.FLOW_HTTP_POOL_MAXSIZE
+
+    @property
+    def is_sandbox(self):
+        return bool(self.base_url) and 'sandbox' in self.base_url
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    @property
+    def status_lock_ttl(self):
+        return int(self.connect_timeout + self.read_timeout) + 1
+
+    def _endpoint_url(self, endpoint):
+        if not self.base_url:
+            raise FlowConfigurationError("FLOW_API_URL_PROD no está configurada.")
+        if not self.api_key or not self.secret_key:
+            raise FlowConfigurationError("FLOW_API_KEY o FLOW_SECRET_KEY no están configuradas.")
+        return f"{self.base_url}/{endpoint}"
+
+    def check_available(self, endpoint):
+        """
+        Lanza FlowCircuitOpenError si el circuito del endpoint está abierto y
+        aún no cumple su plazo, sin llamar a Flow. Cumplido el plazo deja pasar
+        la llamada para que before_call la convierta en prueba de semi-abierto.
+        """
+        retry_after = get_breaker(endpoint).rejecting_for()
+        if retry_after:
+            raise FlowCircuitOpenError(endpoint, retry_after)
+
+    def signed(self, params):
+        """Devuelve una copia de `params` con apiKey y la firma 's' de Flow."""
+        signed_params = dict(params, apiKey=self.api_key)
+        signed_params['s'] = sign_params(signed_params, self.secret_key)
+        return signed_params
+
+    @staticmethod
+    def status_cache_ttl(payment_data):
+        """Segundos que se cachea una respuesta de getStatus, o None si no se cachea."""
+        if not isinstance(payment_data, dict):
+            return None
+        flow_status_code = payment_data.get('status')
+        if flow_status_code in FLOW_FINAL_STATUSES:
+            ttl = settings.FLOW_STATUS_CACHE_TTL
+        elif flow_status_code == FLOW_STATUS_PENDING:
+            ttl = settings.FLOW_STATUS_PENDING_CACHE_TTL
+        else:
+            return None # Respuestas desconocidas o con error no se cachean
+        return ttl if ttl > 0 else None
+
+    @staticmethod
+    def usable_cached_status(cached, final_only):
+        if cached is None or (final_only and cached.get('status') not in FLOW_FINAL_STATUSES):
+            return None
+        return cached
+
+
+class FlowClient(BaseFlowClient):
+    """
+    Cliente único para la API de Flow.
+
+    Lee la configuración una sola vez y mantiene una `requests.Session` con un
+    pool de conexiones keep-alive, de modo que las llamadas sucesivas a Flow
+    reutilizan la conexión TCP/TLS en vez de abrir una nueva cada vez.
+    Todas las llamadas usan timeouts explícitos de conexión y lectura y pasan
+    por el circuit breaker del endpoint (payments/circuit_breaker.py).
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # Single-flight de getStatus por token dentro del proceso
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def create_payment(self, params):
+        """
+        Llama a payment/create. `params` no debe incluir apiKey ni 's'.
+        Devuelve el JSON de Flow; lanza `requests.exceptions.RequestException`
+        (incluido HTTPError para 4xx/5xx) si la llamada falla y
+        FlowCircuitOpenError si el circuito está abierto.
+        """
+        return self._request('POST', 'payment/create', data=self.signed(params)).json()
+
+    def _request(self, method, endpoint, **kwargs):
+        """Hace la llamada HTTP a Flow a través del breaker del endpoint, con timeout adaptativo."""
+        url = self._endpoint_url(endpoint)
+        breaker = get_breaker(endpoint)
+        probe = breaker.before_call()
+        timeout = (self.connect_timeout, breaker.read_timeout(self.read_timeout))
+        started = time.monotonic()
+        failed = True # Errores de red y timeouts cuentan como fallo
+        try:
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+            failed = response.status_code >= 500 # Un 4xx es error nuestro, no de Flow
+            response.raise_for_status()
+            return response
+        finally:
+            breaker.record(failed, time.monotonic() - started, probe=probe)
+
+    def get_status(self, flow_token, use_cache=True, final_only=False):
+        """
+        Devuelve el JSON de payment/getStatus para el token dado.
+        Estados: 1=Pendiente, 2=Pagada, 3=Rechazada, 4=Anulada.
+
+        La respuesta se guarda en la caché compartida por token, así el webhook,
+        el callback del navegador y el return handler pagan un solo viaje a Flow.
+        Los estados finales se guardan por FLOW_STATUS_CACHE_TTL y el pendiente
+        solo por FLOW_STATUS_PENDING_CACHE_TTL, para detectar pronto el cambio.
+        Con `final_only=True` (webhook de confirmación) un pendiente cacheado
+        se ignora y se consulta a Flow.
+
+        Las consultas concurrentes por el mismo token se coalescen: dentro del
+        proceso los hilos esperan a la consulta en curso, y entre workers se
+        usa un lock en la caché (`cache.add`) mientras el resto espera a que
+        el resultado aparezca en ella.
+        """
+        if not use_cache:
+            return self.fetch_status(flow_token)
+
+        cached = self._cached_status(flow_token, final_only)
+        if cached is not None:
+            logger.debug(f"FlowClient: Estado de Flow para token {flow_token} servido desde caché")
+            return cached
+
+        with self._inflight_lock:
+            call = self._inflight.get(flow_token)
+            is_leader = call is None
+            if is_leader:
+                call = self._inflight[flow_token] = _InFlightCall()
+
+        if not is_leader:
+            logger.debug(f"FlowClient: Esperando consulta en curso a Flow para token {flow_token}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._get_status_across_workers(flow_token, final_only)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(flow_token, None)
+            call.done.set()
+
+    def _cached_status(self, flow_token, final_only):
+        return self.usable_cached_status(cache.get(status_cache_key(flow_token)), final_only)
+
+    def _get_status_across_workers(self, flow_token, final_only):
+        lock_key = status_lock_key(flow_token)
+        lock_ttl = self.status_lock_ttl
+        acquired = cache.add(lock_key, True, lock_ttl)
+
+        if not acquired:
+            # Otro worker ya está consultando este token: esperamos a que libere el lock
+            # y usamos lo que dejó en caché. Si no dejó nada útil, consultamos nosotros.
+            deadline = time.monotonic() + lock_ttl
+            while time.monotonic() < deadline and cache.get(lock_key) is not None:
+                cached = self._cached_status(flow_token, final_only)
+                if cached is not None:
+                    return cached
+                time.sleep(settings.FLOW_STATUS_LOCK_POLL_INTERVAL)
+            cached = self._cached_status(flow_token, final_only)
+            if cached is not None:
+                return cached
+            acquired = cache.add(lock_key, True, lock_ttl)
+
+        try:
+            payment_data = self.fetch_status(flow_token)
+            self.remember_status(flow_token, payment_data)
+            return payment_data
+        finally:
+            if acquired:
+                cache.delete(lock_key)
+
+    def fetch_status(self, flow_token):
+        """Llama a payment/getStatus sin pasar por la caché."""
+        logger.debug(f"FlowClient: Consultando estado a Flow para token {flow_token}")
+        return self._request('GET', 'payment/getStatus', params=self.signed({'token': flow_token})).json()
+
+    def remember_status(self, flow_token, payment_data):
+        """Guarda en caché una respuesta de getStatus según su estado."""
+        ttl = self.status_cache_ttl(payment_data)
+        if ttl:
+            cache.set(status_cache_key(flow_token), payment_data, ttl)
+
+
+class AsyncFlowClient(BaseFlowClient):
+    """
+    Cliente de Flow para las vistas asíncronas (servidor ASGI).
+
+    Usa un `httpx.AsyncClient` con pool keep-alive, de modo que mientras se
+    espera a Flow el worker sigue atendiendo otras peticiones. Comparte con
+    FlowClient la caché de getStatus y el lock entre workers; la coalescencia
+    dentro del proceso se hace con futures del event loop.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(max_connections=self.pool_maxsize, max_keepalive_connections=self.pool_maxsize),
+        )
+        self._inflight = {}
+
+    async def create_payment(self, params):
+        """
+        Llama a payment/create. Lanza `httpx.HTTPStatusError` para 4xx/5xx,
+        `httpx.RequestError` para errores de red y FlowCircuitOpenError si el
+        circuito está abierto.
+        """
+        response = await self._request('POST', 'payment/create', data=self.signed(params))
+        return response.json()
+
+    async def _request(self, method, endpoint, **kwargs):
+        """Versión async de FlowClient._request (mismo breaker por endpoint)."""
+        url = self._endpoint_url(endpoint)
+        breaker = get_breaker(endpoint)
+        probe = breaker.before_call()
+        timeout = httpx.Timeout(breaker.read_timeout(self.read_timeout), connect=self.connect_timeout)
+        started = time.monotonic()
+        failed = True
+        try:
+            response = await self.http.request(method, url, timeout=timeout, **kwargs)
+            failed = response.status_code >= 500
+            response.raise_for_status()
+            return response
+        except asyncio.CancelledError:
+            # El cliente se fue; no es un fallo de Flow
+            breaker.release(probe)
+            probe = None
+            raise
+        finally:
+            if probe is not None:
+                breaker.record(failed, time.monotonic() - started, probe=probe)
+
+    async def get_status(self, flow_token, use_cache=True, final_only=False):
+        """Versión async de FlowClient.get_status (misma caché y coalescencia)."""
+        if not use_cache:
+            return await self.fetch_status(flow_token)
+
+        cached = await self._cached_status(flow_token, final_only)
+        if cached is not None:
+            logger.debug(f"AsyncFlowClient: Estado de Flow para token {flow_token} servido desde caché")
+            return cached
+
+        future = self._inflight.get(flow_token)
+        if future is not None:
+            logger.debug(f"AsyncFlowClient: Esperando consulta en curso a Flow para token {flow_token}")
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise # Cancelaron esta petición, no la consulta que esperaba
+            # La petición que consultaba se canceló (su cliente se fue): consultamos nosotros
+            return await self.get_status(flow_token, use_cache=use_cache, final_only=final_only)
+
+        future = self._inflight[flow_token] = asyncio.get_running_loop().create_future()
+        try:
+            payment_data = await self._get_status_across_workers(flow_token, final_only)
+            future.set_result(payment_data)
+            return payment_data
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() # Marcado como recuperado aunque nadie más lo espere
+            raise
+        finally:
+            self._inflight.pop(flow_token, None)
+
+    async def _cached_status(self, flow_token, final_only):
+        return self.usable_cached_status(await cache.aget(status_cache_key(flow_token)), final_only)
+
+    async def _get_status_across_workers(self, flow_token, final_only):
+        lock_key = status_lock_key(flow_token)
+        lock_ttl = self.status_lock_ttl
+        acquired = await cache.aadd(lock_key, True, lock_ttl)
+
+        if not acquired:
+            deadline = time.monotonic() + lock_ttl
+            while time.monotonic() < deadline and await cache.aget(lock_key) is not None:
+                cached = await self._cached_status(flow_token, final_only)
+                if cached is not None:
+                    return cached
+                await asyncio.sleep(settings.FLOW_STATUS_LOCK_POLL_INTERVAL)
+            cached = await self._cached_status(flow_token, final_only)
+            if cached is not None:
+                return cached
+            acquired = await cache.aadd(lock_key, True, lock_ttl)
+
+        try:
+            payment_data = await self.fetch_status(flow_token)
+            ttl = self.status_cache_ttl(payment_data)
+            if ttl:
+                await cache.aset(status_cache_key(flow_token), payment_data, ttl)
+            return payment_data
+        finally:
+            if acquired:
+                await cache.adelete(lock_key)
+
+    async def fetch_status(self, flow_token):
+        """Llama a payment/getStatus sin pasar por la caché."""
+        logger.debug(f"AsyncFlowClient: Consultando estado a Flow para token {flow_token}")
+        response = await self._request('GET', 'payment/getStatus', params=self.signed({'token': flow_token}))
+        return response.json()
+
+
+_flow_client = None
+_flow_client_lock = threading.Lock()
+
+
+def get_flow_client():
+    """
+    Devuelve el cliente de Flow del proceso (uno por worker de gunicorn),
+    creándolo la primera vez que se usa.
+    """
+    global _flow_client
+    if _flow_client is None:
+        with _flow_client_lock:
+            if _flow_client is None:
+                _flow_client = FlowClient()
+    return _flow_client
+
+
+class ThreadedFlowClient:
+    """
+    La interfaz de AsyncFlowClient sobre el FlowClient síncrono del proceso,
+    para las vistas async servidas por WSGI. Ahí Django corre cada petición
+    async en un event loop nuevo: un httpx.AsyncClient por loop no reutilizaría
+    conexiones y nunca se cerraría. Cada llamada corre en un hilo
+    (sync_to_async) con el pool keep-alive de FlowClient; los errores HTTP son
+    los de `requests` (ver FLOW_HTTP_STATUS_ERRORS / FLOW_REQUEST_ERRORS).
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def check_available(self, endpoint):
+        self.client.check_available(endpoint)
+
+    async def create_payment(self, params):
+        return await sync_to_async(self.client.create_payment, thread_sensitive=False)(params)
+
+    async def get_status(self, flow_token, use_cache=True, final_only=False):
+        return await sync_to_async(self.client.get_status, thread_sensitive=False)(flow_token, use_cache=use_cache, final_only=final_only)
+
+
+# Un AsyncFlowClient por event loop: httpx.AsyncClient no puede compartirse entre loops.
+_async_flow_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_flow_client(request=None):
+    """
+    Cliente de Flow para una vista async. Servida por ASGI (`request` es un
+    ASGIRequest, o sin request), el AsyncFlowClient del event loop actual (uno
+    por worker uvicorn, creado la primera vez que se usa). Servida por WSGI,
+    un ThreadedFlowClient sobre el cliente síncrono del proceso.
+    """
+    if request is not None and not isinstance(request, ASGIRequest):
+        return ThreadedFlowClient(get_flow_client())
+    loop = asyncio.get_running_loop()
+    client = _async_flow_clients.get(loop)
+    if client is None:
+        client = _async_flow_clients[loop] = AsyncFlowClient()
+    return client
@@ -0,0 +1,221 @@
+# payments/flow_emulator.py
+"""
+Emulador local de la API de Flow para desarrollo y pruebas de carga
+(`python manage.py run_flow_emulator`). Apunta el backend a él con
+FLOW_API_URL_PROD=http://127.0.0.1:8765 y las mismas FLOW_API_KEY/FLOW_SECRET_KEY.
+
+Implementa:
+- POST payment/create: valida apiKey y la firma 's', registra el pago como
+  pendiente y devuelve {url, token, flowOrder} como Flow.
+- GET payment/getStatus: valida la firma y devuelve el estado del pago
+  (1=Pendiente, 2=Pagada, 3=Rechazada).
+- GET /app/web/pay.php?token=...: simula que el usuario paga; resuelve el
+  pago, dispara urlConfirmation y redirige a urlReturn con el token.
+
+Si no se visita la página de pago, el pago se resuelve solo a los
+`confirm_delay` segundos y también se dispara urlConfirmation (como Flow).
+Se puede inyectar latencia (`latency` ± `jitter`), una tasa de errores 500
+(`error_rate`) y una tasa de pagos rechazados (`reject_rate`).
+"""
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from .flow_client import sign_params, FLOW_STATUS_PENDING, FLOW_STATUS_PAID, FLOW_STATUS_REJECTED
+
+logger = logging.getLogger(__name__)
+
+PAY_PAGE_PATH = '/app/web/pay.php'
+
+
+class EmulatedPayment:
+    def __init__(self, flow_order, token, params):
+        self.flow_order = flow_order
+        self.token = token
+        self.params = params
+        self.status = FLOW_STATUS_PENDING
+        self.created_at = time.time()
+        self.lock = threading.Lock()
+        self.confirmation_sent = False
+
+    def as_status(self):
+        return {
+            'flowOrder': self.flow_order,
+            'commerceOrder': self.params.get('commerceOrder'),
+            'requestDate': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.created_at)),
+            'status': self.status,
+            'subject': self.params.get('subject'),
+            'currency': self.params.get('currency', 'CLP'),
+            'amount': self.params.get('amount'),
+            'payer': self.params.get('email'),
+            'paymentData': {} if self.status == FLOW_STATUS_PENDING else {
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'media': 'Emulador',
+                'amount': self.params.get('amount'),
+                'user_message': 'Pago rechazado por el emulador' if self.status == FLOW_STATUS_REJECTED else '',
+            },
+        }
+
+
+class FlowEmulator:
+    """Estado del emulador y la lógica de cada endpoint, independiente del servidor HTTP."""
+    def __init__(self, api_key, secret_key, public_url, latency=0.0, jitter=0.0,
+                 error_rate=0.0, reject_rate=0.0, confirm_delay=1.0, send_confirmation=True):
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.public_url = public_url.rstrip('/')
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.confirm_delay = confirm_delay
+        self.send_confirmation = send_confirmation
+
+        self.payments = {}
+        self._lock = threading.Lock()
+        self._flow_orders = itertools.count(1000)
+        self._session = requests.Session() # urlConfirmation reutiliza conexiones al backend
+
+    # --- Inyección de fallas ---
+    def simulate_latency(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    # --- Firma ---
+    def check_signature(self, params):
+        """Devuelve (http_status, error) si apiKey o la firma no son válidas, o None."""
+        if params.get('apiKey') != self.api_key:
+            return 401, {'code': 108, 'message': 'Invalid apiKey'}
+        received = params.get('s')
+        unsigned = {k: v for k, v in params.items() if k != 's'}
+        if not received or received != sign_params(unsigned, self.secret_key):
+            return 401, {'code': 108, 'message': 'Invalid signature'}
+        return None
+
+    # --- Endpoints ---
+    def create_payment(self, params):
+        error = self.check_signature(params)
+        if error:
+            return error
+        missing = [key for key in ('commerceOrder', 'subject', 'amount', 'email', 'urlConfirmation', 'urlReturn') if not params.get(key)]
+        if missing:
+            return 400, {'code': 1605, 'message': f"Missing parameters: {', '.join(missing)}"}
+
+        token = f"EMU{random.getrandbits(96):024X}"
+        payment = EmulatedPayment(next(self._flow_orders), token, params)
+        with self._lock:
+            self.payments[token] = payment
+
+        if self.send_confirmation and self.confirm_delay >= 0:
+            timer = threading.Timer(self.confirm_delay, self.resolve, args=(token,))
+            timer.daemon = True
+            timer.start()
+        return 200, {'url': f"{self.public_url}{PAY_PAGE_PATH}", 'token': token, 'flowOrder': payment.flow_order}
+
+    def get_status(self, params):
+        error = self.check_signature(params)
+        if error:
+            return error
+        payment = self.payments.get(params.get('token'))
+        if payment is None:
+            return 400, {'code': 105, 'message': 'Token not found'}
+        return 200, payment.as_status()
+
+    def resolve(self, token):
+        """Resuelve el pago (pagado o rechazado según reject_rate) y dispara urlConfirmation una vez."""
+        payment = self.payments.get(token)
+        if payment is None:
+            return None
+        with payment.lock:
+            if payment.status == FLOW_STATUS_PENDING:
+                rejected = self.reject_rate > 0 and random.random() < self.reject_rate
+                payment.status = FLOW_STATUS_REJECTED if rejected else FLOW_STATUS_PAID
+            fire = self.send_confirmation and not payment.confirmation_sent
+            payment.confirmation_sent = True
+        if fire:
+            try:
+                self._session.post(payment.params['urlConfirmation'], data={'token': token}, timeout=30)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"FlowEmulator: urlConfirmation falló para token {token}: {e}")
+        return payment
+
+
+class FlowEmulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, como la API real
+    emulator = None # Lo asigna make_server
+
+    def log_message(self, format, *args):
+        logger.debug(f"FlowEmulator: {self.address_string()} {format % args}")
+
+    def _send_json(self, http_status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(http_status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _split_path(self):
+        parsed = urllib.parse.urlparse(self.path)
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        return parsed.path.rstrip('/'), params
+
+    def _api_path(self, path):
+        # Acepta tanto /payment/create como /api/payment/create (URL base de Flow con /api)
+        return path[len('/api'):] if path.startswith('/api/') else path
+
+    def do_POST(self):
+        path, _ = self._split_path()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(body).items()}
+
+        self.emulator.simulate_latency()
+        if self._api_path(path) != '/payment/create':
+            return self._send_json(404, {'code': 404, 'message': 'Not found'})
+        if self.emulator.should_fail():
+            return self._send_json(500, {'code': 500, 'message': 'Injected error'})
+        self._send_json(*self.emulator.create_payment(params))
+
+    def do_GET(self):
+        path, params = self._split_path()
+
+        if path == PAY_PAGE_PATH:
+            payment = self.emulator.resolve(params.get('token'))
+            if payment is None:
+                return self._send_json(404, {'code': 105, 'message': 'Token not found'})
+            separator = '&' if '?' in payment.params['urlReturn'] else '?'
+            self.send_response(302)
+            self.send_header('Location', f"{payment.params['urlReturn']}{separator}token={payment.token}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.emulator.simulate_latency()
+        if self._api_path(path) != '/payment/getStatus':
+            return self._send_json(404, {'code': 404, 'message': 'Not found'})
+        if self.emulator.should_fail():
+            return self._send_json(500, {'code': 500, 'message': 'Injected error'})
+        self._send_json(*self.emulator.get_status(params))
+
+
+def make_server(host, port, **emulator_kwargs):
+    """Crea el servidor HTTP del emulador (multi-hilo) listo para serve_forever()."""
+    emulator_kwargs.setdefault('public_url', f"http://{host}:{port}")
+    emulator = FlowEmulator(**emulator_kwargs)
+    handler = type('BoundFlowEmulatorHandler', (FlowEmulatorHandler,), {'emulator': emulator})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.emulator = emulator
+    return server
@@ -0,0 +1,120 @@
+# payments/management/commands/bench_checkout.py
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.circuit_breaker import percentile
+
+
+class CheckoutBenchmark:
+    """
+    Recorre el checkout completo contra un backend en marcha que apunta al
+    emulador de Flow (run_flow_emulator):
+
+    create-payment -> página de pago del emulador -> confirm-payment (como
+    Flow) -> flow-callback (como el navegador). Mide cada paso por separado.
+    """
+    STEPS = ('create', 'pay', 'confirm', 'callback')
+
+    def __init__(self, base_url, confirm=True, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.confirm = confirm
+        self.timeout = timeout
+        self.run_id = uuid.uuid4().hex[:8]
+        self.samples = {step: [] for step in self.STEPS}
+        self.errors = {step: 0 for step in self.STEPS}
+        self.status_codes = {step: {} for step in self.STEPS}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def session(self):
+        # Una sesión keep-alive por hilo, como un cliente real
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _timed(self, step, method, url, expected, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.session().request(method, url, timeout=self.timeout, allow_redirects=False, **kwargs)
+            status_code = response.status_code
+        except requests.exceptions.RequestException:
+            response, status_code = None, 'error'
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.samples[step].append(elapsed)
+            self.status_codes[step][status_code] = self.status_codes[step].get(status_code, 0) + 1
+            if status_code not in expected:
+                self.errors[step] += 1
+        return response if status_code in expected else None
+
+    def run_checkout(self, index):
+        """Un checkout completo. Devuelve True si todos los pasos respondieron lo esperado."""
+        commerce_order = f"BENCH-{self.run_id}-{index}"
+        response = self._timed('create', 'POST', f"{self.base_url}/api/create-payment/", (201,), json={
+            'amount': 10000,
+            'commerceOrder': commerce_order,
+            'subject': f"Benchmark {commerce_order}",
+            'return_url': 'http://localhost:3000',
+            'customer_email': f"{commerce_order.lower()}@example.com",
+        })
+        if response is None:
+            return False
+        flow_token = response.json()['token']
+        pay_url = response.json()['redirect_url']
+
+        # El "usuario" paga en el emulador, que resuelve el pago (y llama a urlConfirmation si está activo)
+        if self._timed('pay', 'GET', pay_url, (302,)) is None:
+            return False
+        if self.confirm and self._timed('confirm', 'POST', f"{self.base_url}/api/confirm-payment/", (200,), data={'token': flow_token}) is None:
+            return False
+        return self._timed('callback', 'GET', f"{self.base_url}/payment/flow-callback/", (302,), params={'token': flow_token}) is not None
+
+    def run(self, total, concurrency):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(self.run_checkout, range(total)))
+        return sum(results), time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark de extremo a extremo del checkout (create -> confirm -> callback) contra un backend "
+        "que usa el emulador de Flow. Reporta throughput y percentiles de latencia por endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help="URL del backend a medir.")
+        parser.add_argument('--checkouts', type=int, default=200, help="Checkouts completos a ejecutar.")
+        parser.add_argument('--concurrency', type=int, default=10, help="Checkouts en paralelo.")
+        parser.add_argument('--timeout', type=float, default=30, help="Timeout (s) de cada petición.")
+        parser.add_argument('--no-confirm', action='store_true', help="No llamar a confirm-payment: lo hace el emulador vía urlConfirmation.")
+
+    def handle(self, *args, **options):
+        if options['checkouts'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--checkouts y --concurrency deben ser mayores que cero.")
+
+        bench = CheckoutBenchmark(options['base_url'], confirm=not options['no_confirm'], timeout=options['timeout'])
+        self.stdout.write(
+            f"Benchmark {bench.run_id}: {options['checkouts']} checkouts, concurrencia {options['concurrency']}, contra {bench.base_url}"
+        )
+        completed, elapsed = bench.run(options['checkouts'], options['concurrency'])
+
+        self.stdout.write(f"\nCheckouts completos: {completed}/{options['checkouts']} en {elapsed:.2f}s ({completed / elapsed:.1f} checkouts/s)\n")
+        header = f"{'paso':<10}{'n':>7}{'errores':>9}{'req/s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}  códigos"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for step in bench.STEPS:
+            samples = sorted(bench.samples[step])
+            if not samples:
+                continue
+            p50, p90, p99 = (percentile(samples, fraction) * 1000 for fraction in (0.50, 0.90, 0.99))
+            codes = ', '.join(f"{code}: {count}" for code, count in sorted(bench.status_codes[step].items(), key=str))
+            self.stdout.write(
+                f"{step:<10}{len(samples):>7}{bench.errors[step]:>9}{len(samples) / elapsed:>9.1f}"
+                f"{p50:>9.1f}{p90:>9.1f}{p99:>9.1f}{samples[-1] * 1000:>9.1f}  {codes}"
+            )
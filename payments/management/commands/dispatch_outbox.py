@@ -0,0 +1,27 @@
+# payments/management/commands/dispatch_outbox.py
+from django.core.management.base import BaseCommand
+
+from payments.outbox import run_dispatcher
+
+
+class Command(BaseCommand):
+    help = "Entrega en segundo plano los eventos del outbox (webhook de ventas de n8n y emails de órdenes) con reintentos y backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Vacía los eventos vencidos y termina, en lugar de quedar escuchando.")
+        parser.add_argument('--batch-size', type=int, default=None, help="Eventos por lote (por defecto OUTBOX_BATCH_SIZE).")
+        parser.add_argument('--interval', type=float, default=None, help="Segundos de espera cuando no hay eventos (por defecto OUTBOX_POLL_INTERVAL).")
+
+    def handle(self, *args, **options):
+        if not options['once']:
+            self.stdout.write("Dispatcher del outbox iniciado. Ctrl+C para detener.")
+        try:
+            processed, sent = run_dispatcher(
+                batch_size=options['batch_size'],
+                poll_interval=options['interval'],
+                once=options['once'],
+            )
+        except KeyboardInterrupt:
+            self.stdout.write("Dispatcher del outbox detenido.")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Outbox: {processed} eventos procesados, {sent} enviados."))
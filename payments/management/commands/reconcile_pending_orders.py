@@ -0,0 +1,77 @@
+# payments/management/commands/reconcile_pending_orders.py
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from payments.discounts import release_expired_reservations
+from payments.flow_client import FlowCircuitOpenError
+from payments.models import Order
+from payments.reconciliation import reconcile_pending_orders
+
+
+class Command(BaseCommand):
+    help = (
+        "Consulta a Flow el estado de las órdenes PENDING más antiguas que N minutos y aplica "
+        "los estados finales en bloque. Pensado para correr periódicamente (cron) por si se pierde el webhook."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-minutes', type=int, default=30, help="Solo órdenes creadas hace más de estos minutos.")
+        parser.add_argument('--batch-size', type=int, default=500, help="Órdenes por lote.")
+        parser.add_argument('--concurrency', type=int, default=16, help="Consultas simultáneas a Flow.")
+        parser.add_argument('--limit', type=int, default=None, help="Máximo de órdenes a revisar en esta corrida.")
+        parser.add_argument('--dry-run', action='store_true', help="Consulta a Flow pero no modifica la BD.")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--batch-size y --concurrency deben ser mayores que cero.")
+
+        older_than = timezone.now() - timedelta(minutes=options['older_than_minutes'])
+        total = Order.objects.filter(status='PENDING', created_at__lt=older_than, flow_token__isnull=False).exclude(flow_token='').count()
+        if options['limit'] is not None:
+            total = min(total, options['limit'])
+        without_token = Order.objects.filter(status='PENDING', created_at__lt=older_than).filter(flow_token__isnull=True).count()
+
+        self.stdout.write(
+            f"Reconciliando {total} órdenes PENDING anteriores a {older_than:%Y-%m-%d %H:%M} "
+            f"(lotes de {options['batch_size']}, concurrencia {options['concurrency']}{', dry-run' if options['dry_run'] else ''})."
+        )
+        if without_token:
+            self.stdout.write(self.style.WARNING(f"{without_token} órdenes PENDING sin flow_token no se pueden consultar a Flow y se omiten."))
+
+        started = time.monotonic()
+
+        def progress(stats):
+            elapsed = time.monotonic() - started
+            rate = stats.scanned / elapsed if elapsed else 0
+            eta = (total - stats.scanned) / rate if rate else 0
+            self.stdout.write(
+                f"  {stats.scanned}/{total} revisadas ({rate:.0f}/s, ETA {eta:.0f}s): "
+                f"{stats.paid} pagadas, {stats.rejected} rechazadas, {stats.still_pending} siguen pendientes, {stats.errors} errores"
+            )
+
+        try:
+            stats = reconcile_pending_orders(
+                older_than,
+                batch_size=options['batch_size'],
+                concurrency=options['concurrency'],
+                dry_run=options['dry_run'],
+                limit=options['limit'],
+                progress=progress,
+            )
+        except FlowCircuitOpenError as e:
+            raise CommandError(f"Flow no está respondiendo, se detiene la reconciliación: {e}")
+
+        if not options['dry_run']:
+            released = release_expired_reservations()
+            if released:
+                self.stdout.write(f"{released} reservas vencidas de códigos de descuento liberadas.")
+
+        for sample in stats.error_samples:
+            self.stdout.write(self.style.WARNING(f"  Error: {sample}"))
+        self.stdout.write(self.style.SUCCESS(
+            f"Listo en {time.monotonic() - started:.1f}s: {stats.scanned} revisadas, {stats.paid} pagadas, "
+            f"{stats.rejected} rechazadas, {stats.still_pending} siguen pendientes, {stats.errors} errores."
+        ))
@@ -0,0 +1,48 @@
+# payments/management/commands/run_flow_emulator.py
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.flow_emulator import make_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Levanta un emulador local de la API de Flow (payment/create, payment/getStatus y "
+        "urlConfirmation) para desarrollo y pruebas de carga. Usar con FLOW_API_URL_PROD=http://HOST:PUERTO."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--public-url', default=None, help="URL con la que el navegador llega al emulador (por defecto http://HOST:PUERTO).")
+        parser.add_argument('--latency-ms', type=float, default=0, help="Latencia agregada a cada llamada a la API.")
+        parser.add_argument('--jitter-ms', type=float, default=0, help="Variación aleatoria (±) de la latencia.")
+        parser.add_argument('--error-rate', type=float, default=0.0, help="Fracción de llamadas a la API que responden 500 (0..1).")
+        parser.add_argument('--reject-rate', type=float, default=0.0, help="Fracción de pagos que terminan rechazados (0..1).")
+        parser.add_argument('--confirm-delay-ms', type=float, default=1000, help="Tras cuánto se resuelve solo un pago y se llama a urlConfirmation.")
+        parser.add_argument('--no-confirmation', action='store_true', help="No llamar a urlConfirmation (el benchmark confirma por su cuenta).")
+
+    def handle(self, *args, **options):
+        if not settings.FLOW_API_KEY or not settings.FLOW_SECRET_KEY:
+            raise CommandError("Configura FLOW_API_KEY y FLOW_SECRET_KEY: el emulador valida la firma con ellas.")
+
+        server = make_server(
+            options['host'],
+            options['port'],
+            api_key=settings.FLOW_API_KEY,
+            secret_key=settings.FLOW_SECRET_KEY,
+            public_url=options['public_url'] or f"http://{options['host']}:{options['port']}",
+            latency=options['latency_ms'] / 1000,
+            jitter=options['jitter_ms'] / 1000,
+            error_rate=options['error_rate'],
+            reject_rate=options['reject_rate'],
+            confirm_delay=options['confirm_delay_ms'] / 1000,
+            send_confirmation=not options['no_confirmation'],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Emulador de Flow escuchando en http://{options['host']}:{options['port']}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write("Emulador de Flow detenido.")
+        finally:
+            server.server_close()
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:46
+
+import re
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+def normalize_phone_e164(phone, default_country_code='56'):
+    # Copia congelada de payments.models.normalize_phone_e164 tal como era al crear esta
+    # migración: si la función cambia después, el backfill debe seguir dando lo mismo.
+    if not phone:
+        return None
+    digits = re.sub(r'\D', '', phone)
+    if not digits:
+        return None
+    if phone.strip().startswith('+'):
+        return f"+{digits}"
+    if digits.startswith('00'):
+        return f"+{digits[2:]}"
+    if len(digits) <= 9:
+        return f"+{default_country_code}{digits}"
+    return f"+{digits}"
+
+
+def fill_shipping_phone_e164(apps, schema_editor):
+    Order = apps.get_model('payments', 'Order')
+    batch = []
+    for order in Order.objects.exclude(shipping_phone__isnull=True).exclude(shipping_phone='').only('pk', 'shipping_phone').iterator(chunk_size=2000):
+        order.shipping_phone_e164 = normalize_phone_e164(order.shipping_phone)
+        batch.append(order)
+        if len(batch) >= 2000:
+            Order.objects.bulk_update(batch, ['shipping_phone_e164'])
+            batch = []
+    if batch:
+        Order.objects.bulk_update(batch, ['shipping_phone_e164'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0007_outboxevent_email'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='shipping_phone_e164',
+            field=models.CharField(blank=True, editable=False, max_length=20, null=True),
+        ),
+        migrations.RunPython(fill_shipping_phone_e164, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['flow_token'], name='order_flow_token_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(django.db.models.functions.text.Lower('commerce_order'), name='order_commerce_order_ci_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(django.db.models.functions.text.Lower('customer_email'), models.OrderBy(models.F('created_at'), descending=True), models.OrderBy(models.F('id'), descending=True), name='order_email_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['shipping_phone_e164', '-created_at', '-id'], name='order_phone_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:49
+
+from django.db import migrations, models
+from django.db.models.functions import Trim, Upper
+
+
+def fill_code_normalized(apps, schema_editor):
+    DiscountCode = apps.get_model('payments', 'DiscountCode')
+    DiscountCode.objects.update(code_normalized=Upper(Trim('code')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0008_order_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discountcode',
+            name='code_normalized',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=50),
+        ),
+        migrations.RunPython(fill_code_normalized, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0009_discountcode_code_normalized'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discountcode',
+            name='reserved',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Usos Reservados'),
+        ),
+        migrations.CreateModel(
+            name='DiscountReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('discount_code', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='payments.discountcode')),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='discount_reservation', to='payments.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['discount_code', 'expires_at'], name='discount_resv_expiry_idx')],
+            },
+        ),
+    ]
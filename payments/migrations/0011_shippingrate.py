@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0010_discount_reservations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShippingRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('region', models.CharField(blank=True, default='', help_text='Vacío = todo el país.', max_length=100, verbose_name='Región')),
+                ('commune', models.CharField(blank=True, default='', help_text='Vacío = todas las comunas de la región.', max_length=100, verbose_name='Comuna')),
+                ('max_weight', models.PositiveIntegerField(help_text='Límite superior (incluido) de la banda de peso.', verbose_name='Peso Máximo (gramos)')),
+                ('price', models.DecimalField(decimal_places=0, max_digits=10, verbose_name='Precio')),
+                ('is_active', models.BooleanField(default=True, verbose_name='¿Está Activa?')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Tarifa de Envío',
+                'verbose_name_plural': 'Tarifas de Envío',
+                'ordering': ['region', 'commune', 'max_weight'],
+                'constraints': [models.UniqueConstraint(fields=('region', 'commune', 'max_weight'), name='shipping_rate_band_unique')],
+            },
+        ),
+    ]
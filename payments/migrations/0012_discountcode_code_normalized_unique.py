@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:12
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Trim, Upper
+
+
+def dedupe_code_normalized(apps, schema_editor):
+    """
+    Antes de hacer único code_normalized: de cada grupo de códigos que solo
+    difieren en mayúsculas o espacios se conserva el más antiguo (el que ya
+    resolvía get_discount_code, que toma el primero por pk) y los demás se
+    renombran con su id como sufijo.
+    """
+    DiscountCode = apps.get_model('payments', 'DiscountCode')
+    DiscountCode.objects.update(code_normalized=Upper(Trim('code')))
+    duplicated = list(
+        DiscountCode.objects.values('code_normalized').annotate(total=Count('pk')).filter(total__gt=1).values_list('code_normalized', flat=True)
+    )
+    for code_normalized in duplicated:
+        for discount_code in DiscountCode.objects.filter(code_normalized=code_normalized).order_by('pk')[1:]:
+            suffix = f"-{discount_code.pk}"
+            renamed = f"{code_normalized[:50 - len(suffix)]}{suffix}"
+            while DiscountCode.objects.filter(code_normalized=renamed).exists():
+                suffix += 'X'
+                renamed = f"{code_normalized[:50 - len(suffix)]}{suffix}"
+            DiscountCode.objects.filter(pk=discount_code.pk).update(code=renamed, code_normalized=renamed)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0011_shippingrate'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_code_normalized, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='discountcode',
+            name='code_normalized',
+            field=models.CharField(default='', editable=False, max_length=50, unique=True),
+        ),
+    ]
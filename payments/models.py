@@ -1,8 +1,36 @@
 # payments/models.py
 
+import re
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Lower
 from django.utils import timezone
 
+
+def normalize_phone_e164(phone, default_country_code='56'):
+    """
+    Normaliza un teléfono a E.164 (+56912345678). Acepta los formatos que
+    llegan del checkout: '+56 9 1234 5678', '56912345678', '9 1234 5678',
+    '(9) 1234-5678'... Sin prefijo de país se asume Chile. Devuelve None si
+    no quedan dígitos.
+    """
+    if not phone:
+        return None
+    digits = re.sub(r'\D', '', phone)
+    if not digits:
+        return None
+    if phone.strip().startswith('+'):
+        return f"+{digits}"
+    if digits.startswith('00'):
+        return f"+{digits[2:]}"
+    if len(digits) <= 9: # Número nacional sin código de país
+        return f"+{default_country_code}{digits}"
+    return f"+{digits}"
+
+
 class Order(models.Model):
     STATUS_CHOICES = [
         ('PENDING', 'Pendiente'),
@@ -26,6 +54,8 @@ class Order(models.Model):
     shipping_commune = models.CharField(max_length=100, blank=True, null=True)
     shipping_region = models.CharField(max_length=100, blank=True, null=True)
     shipping_phone = models.CharField(max_length=20, blank=True, null=True)
+    # shipping_phone normalizado (E.164), para buscar sin depender del formato en que se ingresó
+    shipping_phone_e164 = models.CharField(max_length=20, blank=True, null=True, editable=False)
     applied_discount_code = models.CharField(max_length=50, null=True, blank=True, verbose_name="Código de Descuento Aplicado")
 
     customer_email = models.EmailField(max_length=254, blank=True, null=True) # Email del cliente
@@ -34,10 +64,84 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Callback, retorno y consulta por token
+            models.Index(fields=['flow_token'], name='order_flow_token_idx'),
+            # commerce_order sin distinguir mayúsculas (QueryOrderStatusView)
+            models.Index(Lower('commerce_order'), name='order_commerce_order_ci_idx'),
+            # Órdenes de un cliente, más recientes primero: el orden del índice evita ordenar en memoria
+            models.Index(Lower('customer_email'), F('created_at').desc(), F('id').desc(), name='order_email_created_idx'),
+            models.Index(fields=['shipping_phone_e164', '-created_at', '-id'], name='order_phone_created_idx'),
+            # Reconciliación de PENDING viejas
+            models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+        ]
+
     def __str__(self):
         return f"Orden {self.commerce_order} - {self.get_status_display()}"
 
+    def save(self, *args, **kwargs):
+        self.shipping_phone_e164 = normalize_phone_e164(self.shipping_phone)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'shipping_phone' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'shipping_phone_e164'}
+        super().save(*args, **kwargs)
+
+
+class OutboxEvent(models.Model):
+    """
+    Evento pendiente de entregar a un sistema externo (outbox transaccional).
+    Se escribe en la misma transacción que el cambio de la orden que lo origina
+    y lo entrega en segundo plano el dispatcher (payments/outbox.py,
+    `python manage.py dispatch_outbox`), con reintentos y backoff.
+    """
+    TYPE_N8N_SALE = 'n8n_sale'
+    TYPE_EMAIL = 'email'
+    EVENT_TYPE_CHOICES = [
+        (TYPE_N8N_SALE, 'Venta a n8n'),
+        (TYPE_EMAIL, 'Email'),
+    ]
+
+    STATUS_PENDING = 'PENDING'
+    STATUS_SENT = 'SENT'
+    STATUS_FAILED = 'FAILED'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pendiente'),
+        (STATUS_SENT, 'Enviado'),
+        (STATUS_FAILED, 'Fallido'), # Se agotaron los reintentos
+    ]
+
+    event_type = models.CharField(max_length=30, choices=EVENT_TYPE_CHOICES)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='outbox_events')
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # El dispatcher solo busca eventos pendientes cuyo reintento ya venció
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_event_type_display()} #{self.pk} - {self.get_status_display()}"
+
+
+
 
+# Contadores de DiscountCode que solo cambian con UPDATE atómicos (payments/discounts.py)
+USAGE_COUNTER_FIELDS = ('times_used', 'reserved')
+
+
+def normalize_discount_code(code):
+    """Forma canónica de un código de descuento: sin espacios alrededor y en mayúsculas."""
+    return (code or '').strip().upper()
 
 
 class DiscountCode(models.Model):
@@ -47,6 +151,9 @@ class DiscountCode(models.Model):
     ]
 
     code = models.CharField(max_length=50, unique=True, db_index=True, verbose_name="Código de Descuento")
+    # `code` normalizado (normalize_discount_code): las búsquedas sin distinguir mayúsculas van por este índice,
+    # único para que 'Promo10' y 'PROMO10' no puedan convivir
+    code_normalized = models.CharField(max_length=50, unique=True, editable=False, default='')
     discount_type = models.CharField(max_length=20, choices=DISCOUNT_TYPE_CHOICES, verbose_name="Tipo de Descuento")
     discount_value = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Valor del Descuento")
     is_active = models.BooleanField(default=True, verbose_name="¿Está Activo?")
@@ -54,7 +161,10 @@ class DiscountCode(models.Model):
     valid_until = models.DateTimeField(null=True, blank=True, verbose_name="Válido Hasta")
     min_purchase_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, verbose_name="Monto Mínimo de Compra (subtotal productos)")
     usage_limit = models.PositiveIntegerField(null=True, blank=True, verbose_name="Límite de Usos Totales")
+    # Usos contados (times_used) y apartados por checkouts en curso (reserved, ver DiscountReservation):
+    # los mantiene payments/discounts.py con UPDATE atómicos, save() no los escribe en filas existentes
     times_used = models.PositiveIntegerField(default=0, verbose_name="Veces Usado")
+    reserved = models.PositiveIntegerField(default=0, editable=False, verbose_name="Usos Reservados")
     max_discount_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, verbose_name="Monto Máximo de Descuento (para porcentaje)")
 
     created_at = models.DateTimeField(auto_now_add=True)
@@ -63,6 +173,25 @@ class DiscountCode(models.Model):
     def __str__(self):
         return self.code
 
+    def clean(self):
+        super().clean()
+        # code_normalized no es editable: el admin no validaría su unicidad y el choque llegaría como IntegrityError
+        duplicate = DiscountCode.objects.filter(code_normalized=normalize_discount_code(self.code)).exclude(pk=self.pk)
+        if self.code and duplicate.exists():
+            raise ValidationError({'code': "Ya existe un código de descuento igual (sin distinguir mayúsculas)."})
+
+    def save(self, *args, **kwargs):
+        self.code_normalized = normalize_discount_code(self.code)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'code' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'code_normalized'}
+        elif update_fields is None and not self._state.adding and not kwargs.get('force_insert'):
+            # Los contadores cambian con UPDATE atómicos en cada checkout: guardar una instancia leída antes no debe pisarlos
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields if not field.primary_key and field.name not in USAGE_COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
     def is_valid(self, cart_subtotal=None):
         if not self.is_active:
             return False, "Este código de descuento no está activo."
@@ -100,53 +229,53 @@ class DiscountCode(models.Model):
             # El descuento no puede ser mayor que el monto
             return min(discount_value_decimal, amount).quantize(Decimal('0.01')) # Redondea a 2 decimales
         return Decimal('0.00')
-    DISCOUNT_TYPE_CHOICES = [
-        ('percentage', 'Porcentaje'),
-        ('fixed_amount', 'Monto Fijo'),
-    ]
 
-    code = models.CharField(max_length=50, unique=True, db_index=True, verbose_name="Código de Descuento")
-    discount_type = models.CharField(max_length=20, choices=DISCOUNT_TYPE_CHOICES, verbose_name="Tipo de Descuento")
-    discount_value = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Valor del Descuento")
-    is_active = models.BooleanField(default=True, verbose_name="¿Está Activo?")
-    valid_from = models.DateTimeField(null=True, blank=True, verbose_name="Válido Desde")
-    valid_until = models.DateTimeField(null=True, blank=True, verbose_name="Válido Hasta")
-    min_purchase_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, verbose_name="Monto Mínimo de Compra (subtotal productos)")
-    usage_limit = models.PositiveIntegerField(null=True, blank=True, verbose_name="Límite de Usos Totales")
-    times_used = models.PositiveIntegerField(default=0, verbose_name="Veces Usado")
-    max_discount_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, verbose_name="Monto Máximo de Descuento (para porcentaje)")
+
+class ShippingRate(models.Model):
+    """
+    Tarifa de envío para una banda de peso: desde el max_weight de la banda
+    anterior hasta este. Región y comuna vacías son la tarifa por defecto
+    (comuna vacía: todas las comunas de la región). Se consulta desde la
+    tabla en memoria de payments/shipping.py.
+    """
+    region = models.CharField(max_length=100, blank=True, default='', verbose_name="Región", help_text="Vacío = todo el país.")
+    commune = models.CharField(max_length=100, blank=True, default='', verbose_name="Comuna", help_text="Vacío = todas las comunas de la región.")
+    max_weight = models.PositiveIntegerField(verbose_name="Peso Máximo (gramos)", help_text="Límite superior (incluido) de la banda de peso.")
+    price = models.DecimalField(max_digits=10, decimal_places=0, verbose_name="Precio")
+    is_active = models.BooleanField(default=True, verbose_name="¿Está Activa?")
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        verbose_name = "Tarifa de Envío"
+        verbose_name_plural = "Tarifas de Envío"
+        ordering = ['region', 'commune', 'max_weight']
+        constraints = [
+            models.UniqueConstraint(fields=['region', 'commune', 'max_weight'], name='shipping_rate_band_unique'),
+        ]
+
     def __str__(self):
-        return self.code
+        zone = ' / '.join(part for part in (self.region, self.commune) if part) or 'Todo el país'
+        return f"{zone}: hasta {self.max_weight} g - ${self.price}"
 
-    def is_valid(self, cart_subtotal=None):
-        if not self.is_active:
-            return False, "Este código de descuento no está activo."
-        
-        now = timezone.now()
-        if self.valid_from and now < self.valid_from:
-            return False, "Este código de descuento aún no es válido."
-        if self.valid_until and now > self.valid_until:
-            return False, "Este código de descuento ha expirado."
-        
-        if self.usage_limit is not None and self.times_used >= self.usage_limit:
-            return False, "Este código de descuento ha alcanzado su límite de usos."
-            
-        if cart_subtotal is not None and cart_subtotal < self.min_purchase_amount:
-            return False, f"Esta compra no alcanza el monto mínimo de ${self.min_purchase_amount:,.0f} para usar este código."
-            
-        return True, "Código válido."
 
-    def calculate_discount(self, amount):
-        if self.discount_type == 'percentage':
-            discount = (self.discount_value / 100) * amount
-            if self.max_discount_amount is not None and discount > self.max_discount_amount:
-                return self.max_discount_amount
-            return discount
-        elif self.discount_type == 'fixed_amount':
-            # El descuento no puede ser mayor que el monto
-            return min(self.discount_value, amount) 
-        return 0
\ No newline at end of file
+class DiscountReservation(models.Model):
+    """
+    Uso de un código con límite apartado para una orden mientras se paga.
+    Se crea en create-payment (junto con reserved + 1 en el código), se
+    consume al pasar la orden a PAID y se libera si se rechaza o si vence sin
+    que el pago termine (payments/discounts.py).
+    """
+    discount_code = models.ForeignKey(DiscountCode, on_delete=models.CASCADE, related_name='reservations')
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='discount_reservation')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['discount_code', 'expires_at'], name='discount_resv_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.discount_code} para {self.order.commerce_order}"
@@ -0,0 +1,221 @@
+# payments/order_status.py
+"""
+Estado publicado de cada orden, por commerce_order y por flow_token. Cada
+vez que una orden cambia (post_save, o los UPDATE en bloque del callback y
+la reconciliación) su estado se escribe en la caché. De ahí leen:
+
+- el long-poll de /api/order-status/<orden>/wait/, que responde apenas el
+  estado cambia sin consultar la BD mientras espera. Los cambios publicados
+  en el mismo proceso lo despiertan al instante (un asyncio.Event por
+  espera); los de otros workers se ven al releer la caché cada
+  ORDER_STATUS_WAIT_POLL_INTERVAL segundos;
+- OrderStatusView y GetOrderStatusByTokenView, que además responden 304 a
+  los GET condicionales (ETag / Last-Modified) sin tocar la BD.
+
+Con varios workers la caché debe ser compartida (DJANGO_CACHE_BACKEND, p. ej.
+Redis). Con LocMemCache cada worker solo ve sus propios cambios y el estado
+pendiente expira cada ORDER_STATUS_PENDING_CACHE_TTL segundos para releerlo
+de la BD. El long-poll solo retiene la petición servido por ASGI (ver
+ORDER_STATUS_WAIT_TIMEOUT en settings).
+"""
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Order
+
+ORDER_STATUS_KEY_PREFIX = 'order-status:'
+ORDER_STATUS_TOKEN_KEY_PREFIX = 'order-status-token:'
+FINAL_ORDER_STATUSES = ('PAID', 'REJECTED', 'ERROR')
+# Estados que ya no cambian y se cachean ORDER_STATUS_CACHE_TTL. ERROR queda
+# fuera: la confirmación de Flow todavía puede llevar la orden a PAID, y con
+# LocMemCache otro worker no vería ese cambio hasta que expire la entrada.
+LONG_CACHED_ORDER_STATUSES = ('PAID', 'REJECTED')
+
+SNAPSHOT_FIELDS = ('commerce_order', 'flow_token', 'status', 'updated_at')
+
+# Long-polls esperando en este proceso: commerce_order -> {(loop, asyncio.Event)}
+_status_waiters = {}
+_status_waiters_lock = threading.Lock()
+
+
+def order_status_cache_key(commerce_order):
+    return f"{ORDER_STATUS_KEY_PREFIX}{commerce_order}"
+
+
+def order_status_token_cache_key(flow_token):
+    return f"{ORDER_STATUS_TOKEN_KEY_PREFIX}{flow_token}"
+
+
+def status_snapshot(commerce_order, status, updated_at, flow_token=None):
+    """
+    Lo que se guarda en caché por orden: el estado, más el ETag y la fecha de
+    última modificación que necesitan los GET condicionales (ambos salen de
+    updated_at, que cambia en cada guardado).
+    """
+    return {
+        'commerce_order': commerce_order,
+        'flow_token': flow_token,
+        'status': status,
+        'updated_at': updated_at.isoformat() if updated_at else None,
+        'last_modified': updated_at.timestamp() if updated_at else None,
+        'etag': f'"{status}-{int(updated_at.timestamp() * 1_000_000)}"' if updated_at else f'"{status}"',
+    }
+
+
+def _snapshot_from_row(row):
+    return status_snapshot(row['commerce_order'], row['status'], row['updated_at'], flow_token=row['flow_token'])
+
+
+def _status_ttl(status):
+    return settings.ORDER_STATUS_CACHE_TTL if status in LONG_CACHED_ORDER_STATUSES else settings.ORDER_STATUS_PENDING_CACHE_TTL
+
+
+def _cache_entries(snapshot):
+    """Claves de caché de una orden: por commerce_order y, si ya lo tiene, por flow_token."""
+    entries = {order_status_cache_key(snapshot['commerce_order']): snapshot}
+    if snapshot['flow_token']:
+        entries[order_status_token_cache_key(snapshot['flow_token'])] = snapshot
+    return entries
+
+
+def publish_order_status(order):
+    """Escribe en caché el estado actual de la orden (por commerce_order y por flow_token)."""
+    publish_order_statuses([order])
+
+
+def publish_order_statuses(orders):
+    """publish_order_status para muchas órdenes con un set_many por TTL."""
+    by_ttl = {}
+    for order in orders:
+        snapshot = status_snapshot(order.commerce_order, order.status, order.updated_at, flow_token=order.flow_token)
+        by_ttl.setdefault(_status_ttl(order.status), {}).update(_cache_entries(snapshot))
+    for ttl, entries in by_ttl.items():
+        cache.set_many(entries, ttl)
+    _wake_status_waiters(order.commerce_order for order in orders)
+
+
+def forget_order_status(order):
+    """Borra de la caché el estado de una orden eliminada."""
+    keys = [order_status_cache_key(order.commerce_order)]
+    if order.flow_token:
+        keys.append(order_status_token_cache_key(order.flow_token))
+    cache.delete_many(keys)
+    _wake_status_waiters([order.commerce_order])
+
+
+def _wake_status_waiters(commerce_orders):
+    """Despierta los long-poll de este proceso que esperan a estas órdenes. Se puede llamar desde cualquier hilo."""
+    with _status_waiters_lock:
+        if not _status_waiters:
+            return
+        waiters = [waiter for commerce_order in commerce_orders for waiter in _status_waiters.get(commerce_order, ())]
+    for loop, event in waiters:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError: # El loop de esa espera ya se cerró
+            pass
+
+
+def _get_or_load(cache_key, **lookup):
+    snapshot = cache.get(cache_key)
+    if snapshot is None:
+        row = Order.objects.filter(**lookup).values(*SNAPSHOT_FIELDS).first()
+        if row is None:
+            return None
+        snapshot = _snapshot_from_row(row)
+        cache.set_many(_cache_entries(snapshot), _status_ttl(snapshot['status']))
+    return snapshot
+
+
+def get_order_status(commerce_order):
+    """Snapshot del estado de la orden desde la caché (o la BD si no está), o None si no existe."""
+    return _get_or_load(order_status_cache_key(commerce_order), commerce_order=commerce_order)
+
+
+def get_order_status_by_token(flow_token):
+    """Como get_order_status, buscando la orden por su token de Flow."""
+    return _get_or_load(order_status_token_cache_key(flow_token), flow_token=flow_token)
+
+
+def _get_or_load_many(key_func, field, values):
+    """
+    Snapshots de muchas órdenes: un get_many a la caché y, para las que no
+    están, un solo SELECT ... WHERE field IN (...). Devuelve {valor: snapshot o None}.
+    """
+    keys = {key_func(value): value for value in values}
+    cached = cache.get_many(list(keys))
+    snapshots = {keys[key]: snapshot for key, snapshot in cached.items()}
+    missing = [value for value in values if value not in snapshots]
+    if missing:
+        by_ttl = {}
+        for row in Order.objects.filter(**{f"{field}__in": missing}).values(*SNAPSHOT_FIELDS):
+            snapshot = _snapshot_from_row(row)
+            snapshots[row[field]] = snapshot
+            by_ttl.setdefault(_status_ttl(snapshot['status']), {}).update(_cache_entries(snapshot))
+        for ttl, entries in by_ttl.items():
+            cache.set_many(entries, ttl)
+    return {value: snapshots.get(value) for value in values}
+
+
+def get_order_statuses(commerce_orders):
+    """get_order_status para muchas órdenes a la vez: {commerce_order: snapshot o None}."""
+    return _get_or_load_many(order_status_cache_key, 'commerce_order', commerce_orders)
+
+
+def get_order_statuses_by_token(flow_tokens):
+    """get_order_status_by_token para muchos tokens a la vez: {flow_token: snapshot o None}."""
+    return _get_or_load_many(order_status_token_cache_key, 'flow_token', flow_tokens)
+
+
+async def aget_order_status(commerce_order):
+    """Versión async de get_order_status."""
+    snapshot = await cache.aget(order_status_cache_key(commerce_order))
+    if snapshot is None:
+        row = await Order.objects.filter(commerce_order=commerce_order).values(*SNAPSHOT_FIELDS).afirst()
+        if row is None:
+            return None
+        snapshot = _snapshot_from_row(row)
+        await cache.aset_many(_cache_entries(snapshot), _status_ttl(snapshot['status']))
+    return snapshot
+
+
+async def wait_for_status_change(commerce_order, known_status, timeout):
+    """
+    Espera hasta `timeout` segundos a que el estado de la orden deje de ser
+    `known_status` (o sea final). Devuelve (snapshot, changed); snapshot es
+    None si la orden no existe.
+
+    No consulta en bucle: duerme en un asyncio.Event que publish_order_statuses
+    activa cuando la orden cambia en este proceso, y solo relee la caché cada
+    ORDER_STATUS_WAIT_POLL_INTERVAL segundos por si el cambio vino de otro worker.
+    """
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with _status_waiters_lock:
+        _status_waiters.setdefault(commerce_order, set()).add(waiter)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            waiter[1].clear() # Antes de leer: un cambio publicado desde aquí vuelve a activarlo
+            snapshot = await aget_order_status(commerce_order)
+            if snapshot is None:
+                return None, False
+            changed = bool(known_status) and snapshot['status'] != known_status
+            if changed or not known_status or snapshot['status'] in FINAL_ORDER_STATUSES:
+                return snapshot, changed
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return snapshot, False
+            try:
+                await asyncio.wait_for(waiter[1].wait(), min(settings.ORDER_STATUS_WAIT_POLL_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        with _status_waiters_lock:
+            waiters = _status_waiters.get(commerce_order)
+            waiters.discard(waiter)
+            if not waiters:
+                del _status_waiters[commerce_order]
@@ -0,0 +1,258 @@
+# payments/outbox.py
+"""
+Outbox transaccional para las notificaciones salientes (webhook de ventas de
+n8n y emails de órdenes, ver payments/emails.py). Las vistas solo escriben
+un OutboxEvent dentro de la misma transacción que cambia la orden; la entrega
+real la hace este dispatcher en segundo plano (`python manage.py dispatch_outbox`):
+
+- Toma lotes de eventos vencidos y los reserva por OUTBOX_LEASE_SECONDS, así
+  un dispatcher que muere a mitad de lote no pierde eventos.
+- Entrega cada lote reutilizando conexiones keep-alive y guarda los
+  resultados en un solo commit (bulk_update).
+- Si la entrega falla, reintenta con backoff exponencial hasta
+  OUTBOX_MAX_ATTEMPTS; después el evento queda FAILED para revisión en el admin.
+
+Los emails de un lote se envían con send_messages sobre una conexión SMTP
+que se mantiene abierta mientras haya cola y se cierra cuando se vacía.
+
+La entrega es "al menos una vez": cada POST lleva el encabezado
+X-Outbox-Event-Id para que el receptor pueda descartar duplicados.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+# --- Encolado (dentro de la transacción del llamador) ---
+def enqueue_event(event_type, payload, order=None):
+    """Crea un evento pendiente. Debe llamarse dentro de la transacción que origina el evento."""
+    return OutboxEvent.objects.create(event_type=event_type, payload=payload, order=order)
+
+
+def n8n_sale_event(order, flow_status_code):
+    """OutboxEvent (sin guardar) con la venta pagada para n8n, o None si n8n no está configurado."""
+    from .services import build_n8n_sale_payload # Import diferido: services importa este módulo
+
+    if not settings.N8N_SALE_WEBHOOK_URL:
+        logger.warning(f"Outbox: N8N_SALE_WEBHOOK_URL no configurada. No se notifica a n8n para orden {order.commerce_order}.")
+        return None
+    return OutboxEvent(event_type=OutboxEvent.TYPE_N8N_SALE, payload=build_n8n_sale_payload(order, flow_status_code), order=order)
+
+
+def enqueue_n8n_sale(order, flow_status_code):
+    """Encola la notificación de venta pagada a n8n. Devuelve el evento o None si n8n no está configurado."""
+    event = n8n_sale_event(order, flow_status_code)
+    if event is None:
+        return None
+    event.save()
+    logger.info(f"Outbox: Venta de orden {order.commerce_order} encolada para n8n (evento {event.pk}).")
+    return event
+
+
+# --- Entrega ---
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_outbox_session():
+    """Sesión HTTP keep-alive compartida por las entregas del dispatcher."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_maxsize=settings.OUTBOX_BATCH_SIZE))
+                session.mount('http://', HTTPAdapter(pool_maxsize=settings.OUTBOX_BATCH_SIZE))
+                _session = session
+    return _session
+
+
+def deliver_n8n_sales(events):
+    """Entrega un lote de ventas a n8n. Devuelve {event_id: mensaje de error o None}."""
+    results = {}
+    url = settings.N8N_SALE_WEBHOOK_URL
+    session = get_outbox_session()
+    for event in events:
+        if not url:
+            results[event.pk] = "N8N_SALE_WEBHOOK_URL no configurada"
+            continue
+        try:
+            response = session.post(
+                url,
+                json=event.payload,
+                headers={'X-Outbox-Event-Id': str(event.pk)},
+                timeout=settings.OUTBOX_HTTP_TIMEOUT,
+            )
+            response.raise_for_status()
+            results[event.pk] = None
+        except requests.exceptions.RequestException as e:
+            results[event.pk] = str(e)
+    return results
+
+
+_email_connection = None
+
+
+def get_email_connection():
+    """Conexión SMTP persistente del dispatcher; se abre una vez y se reutiliza entre lotes."""
+    global _email_connection
+    if _email_connection is None:
+        connection = get_connection(fail_silently=False)
+        connection.open()
+        _email_connection = connection
+    return _email_connection
+
+
+def close_email_connection():
+    global _email_connection
+    if _email_connection is not None:
+        try:
+            _email_connection.close()
+        except Exception: # La conexión ya podía estar caída
+            pass
+        _email_connection = None
+
+
+def build_email_message(event, connection):
+    payload = event.payload
+    return EmailMessage(
+        subject=payload.get('subject', ''),
+        body=payload.get('body', ''),
+        from_email=payload.get('from_email') or settings.DEFAULT_FROM_EMAIL,
+        to=payload.get('to') or [],
+        connection=connection,
+    )
+
+
+def deliver_emails(events):
+    """
+    Entrega un lote de emails con send_messages en grupos de EMAIL_SEND_BATCH_SIZE
+    sobre la conexión persistente. Si un grupo falla, se reabre la conexión y se
+    envían sus mensajes de a uno para saber cuáles reintentar.
+    """
+    results = {}
+    chunk_size = max(settings.EMAIL_SEND_BATCH_SIZE, 1)
+    for start in range(0, len(events), chunk_size):
+        chunk = events[start:start + chunk_size]
+        try:
+            connection = get_email_connection()
+            connection.send_messages([build_email_message(event, connection) for event in chunk])
+            results.update({event.pk: None for event in chunk})
+            continue
+        except Exception as e:
+            logger.warning(f"Outbox: Falló el envío de {len(chunk)} emails en lote, se reintentan de a uno: {e}")
+            close_email_connection()
+
+        for event in chunk:
+            try:
+                connection = get_email_connection()
+                connection.send_messages([build_email_message(event, connection)])
+                results[event.pk] = None
+            except Exception as e:
+                close_email_connection()
+                results[event.pk] = str(e) or e.__class__.__name__
+    return results
+
+
+# Función de entrega por tipo de evento; cada una recibe el lote completo de su tipo
+DELIVERY_HANDLERS = {
+    OutboxEvent.TYPE_N8N_SALE: deliver_n8n_sales,
+    OutboxEvent.TYPE_EMAIL: deliver_emails,
+}
+
+
+def retry_delay(attempts):
+    """Espera antes del siguiente intento: backoff exponencial con tope."""
+    delay = settings.OUTBOX_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0))
+    return timedelta(seconds=min(delay, settings.OUTBOX_RETRY_MAX_SECONDS))
+
+
+def claim_due_events(batch_size):
+    """Reserva hasta batch_size eventos vencidos moviendo su next_attempt_at al final del lease."""
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True) # Ignorado en SQLite
+            .filter(status=OutboxEvent.STATUS_PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        if events:
+            lease_until = now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+            OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(next_attempt_at=lease_until)
+    return events
+
+
+def dispatch_batch(batch_size=None):
+    """
+    Entrega un lote de eventos vencidos y guarda los resultados.
+    Devuelve (procesados, enviados).
+    """
+    events = claim_due_events(batch_size or settings.OUTBOX_BATCH_SIZE)
+    if not events:
+        return 0, 0
+
+    by_type = {}
+    for event in events:
+        by_type.setdefault(event.event_type, []).append(event)
+
+    results = {}
+    for event_type, typed_events in by_type.items():
+        handler = DELIVERY_HANDLERS.get(event_type)
+        if handler is None:
+            results.update({event.pk: f"Tipo de evento desconocido: {event_type}" for event in typed_events})
+            continue
+        try:
+            results.update(handler(typed_events))
+        except Exception as e: # Un fallo inesperado del handler no debe perder el lote
+            logger.exception(f"Outbox: Error inesperado entregando eventos {event_type}")
+            results.update({event.pk: f"Error inesperado: {e}" for event in typed_events})
+
+    now = timezone.now()
+    sent = 0
+    for event in events:
+        error = results.get(event.pk, "Sin resultado del handler")
+        event.attempts += 1
+        if error is None:
+            event.status = OutboxEvent.STATUS_SENT
+            event.sent_at = now
+            event.last_error = ''
+            sent += 1
+        else:
+            event.last_error = error[:2000]
+            if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                event.status = OutboxEvent.STATUS_FAILED
+                logger.error(f"Outbox: Evento {event.pk} ({event.event_type}) FALLIDO tras {event.attempts} intentos: {error}")
+            else:
+                event.next_attempt_at = now + retry_delay(event.attempts)
+                logger.warning(f"Outbox: Evento {event.pk} ({event.event_type}) falló (intento {event.attempts}), se reintenta a las {event.next_attempt_at:%H:%M:%S}: {error}")
+
+    OutboxEvent.objects.bulk_update(events, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+    return len(events), sent
+
+
+def run_dispatcher(batch_size=None, poll_interval=None, once=False):
+    """Bucle del dispatcher: vacía los eventos vencidos y duerme cuando no quedan."""
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    poll_interval = settings.OUTBOX_POLL_INTERVAL if poll_interval is None else poll_interval
+    total_processed = total_sent = 0
+    while True:
+        processed, sent = dispatch_batch(batch_size)
+        total_processed += processed
+        total_sent += sent
+        if processed < batch_size: # No quedan más eventos vencidos por ahora
+            close_email_connection() # No dejamos la conexión SMTP ociosa mientras no hay cola
+            if once:
+                return total_processed, total_sent
+            time.sleep(poll_interval)
@@ -0,0 +1,131 @@
+# payments/pricing.py
+"""
+Precio de un carrito calculado en el servidor: lo usan el endpoint de
+cotización (/api/cart-quote/) y create-payment cuando el frontend envía los
+ítems, para no depender del 'amount' que calcula el navegador.
+
+Todos los productos del carrito se leen con una sola consulta IN por slug
+(solo las columnas que hacen falta); el código de descuento y las tarifas de
+envío salen de tablas en memoria (payments/discounts.py, payments/shipping.py),
+así que cotizar cuesta una consulta.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+
+from products.models import Product
+
+from .discounts import get_discount_code
+from .shipping import has_shipping_rates, quote_shipping
+
+PRICING_PRODUCT_FIELDS = ('id', 'slug', 'name', 'price', 'weight')
+
+
+class PricingError(Exception):
+    """Carrito que no se puede cotizar (ítems mal formados o productos que no existen)."""
+
+
+class CartLine:
+    def __init__(self, product, quantity):
+        self.product = product
+        self.quantity = quantity
+        self.unit_price = product.price
+        self.total = product.price * quantity
+        self.weight = (product.weight or 0) * quantity # Gramos
+
+    def as_dict(self):
+        return {
+            'slug': self.product.slug,
+            'name': self.product.name,
+            'quantity': self.quantity,
+            'unit_price': str(self.unit_price),
+            'total': str(self.total),
+        }
+
+
+class CartQuote:
+    def __init__(self, lines, shipping=Decimal('0')):
+        self.lines = lines
+        self.subtotal = sum((line.total for line in lines), Decimal('0'))
+        self.weight = sum(line.weight for line in lines)
+        self.shipping = shipping
+        self.discount_code = None # DiscountCode aplicado (válido para este subtotal)
+        self.discount_amount = Decimal('0')
+        self.discount_message = None
+
+    @property
+    def total(self):
+        return self.subtotal - self.discount_amount + self.shipping
+
+    def apply_discount(self, code):
+        discount_code = get_discount_code(code)
+        if discount_code is None:
+            self.discount_message = "El código de descuento no existe."
+            return
+        is_valid, message = discount_code.is_valid(cart_subtotal=self.subtotal)
+        self.discount_message = message
+        if is_valid:
+            self.discount_code = discount_code
+            self.discount_amount = discount_code.calculate_discount(self.subtotal)
+
+    def as_dict(self):
+        return {
+            'lines': [line.as_dict() for line in self.lines],
+            'subtotal': str(self.subtotal),
+            'discount': {
+                'code': self.discount_code.code if self.discount_code else None,
+                'amount': str(self.discount_amount),
+                'message': self.discount_message,
+            },
+            'shipping': str(self.shipping),
+            'weight_grams': self.weight,
+            'total': str(self.total),
+        }
+
+
+def parse_cart_items(items):
+    """Valida [{'slug', 'quantity'}] y devuelve {slug: cantidad} (sumando slugs repetidos)."""
+    if not isinstance(items, list) or not items:
+        raise PricingError("'items' debe ser una lista con al menos un producto.")
+    quantities = {}
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('slug'), str) or not item['slug']:
+            raise PricingError("Cada ítem debe tener un 'slug'.")
+        try:
+            quantity = int(item.get('quantity', 1))
+        except (TypeError, ValueError):
+            raise PricingError(f"Cantidad inválida para '{item['slug']}'.")
+        if quantity < 1:
+            raise PricingError(f"Cantidad inválida para '{item['slug']}'.")
+        quantities[item['slug']] = quantities.get(item['slug'], 0) + quantity
+    if len(quantities) > settings.PRICING_MAX_LINE_ITEMS:
+        raise PricingError(f"El carrito no puede tener más de {settings.PRICING_MAX_LINE_ITEMS} productos distintos.")
+    return quantities
+
+
+def price_cart(items, discount_code=None, shipping=Decimal('0'), region=None, commune=None):
+    """
+    Cotiza un carrito: subtotal de los productos activos (una consulta),
+    descuento validado contra ese subtotal y envío. Con `region` (y
+    opcionalmente `commune`) el envío sale de la tabla de tarifas según el peso
+    total; si no hay tarifas configuradas se usa `shipping`. Devuelve CartQuote;
+    lanza PricingError si algún ítem no es válido, el producto no existe o no
+    hay tarifa de envío para la zona.
+    """
+    quantities = parse_cart_items(items)
+    products = {
+        product.slug: product
+        for product in Product.objects.filter(slug__in=list(quantities), is_active=True).only(*PRICING_PRODUCT_FIELDS).order_by()
+    }
+    missing = [slug for slug in quantities if slug not in products]
+    if missing:
+        raise PricingError(f"Productos no disponibles: {', '.join(missing)}")
+
+    quote = CartQuote([CartLine(products[slug], quantity) for slug, quantity in quantities.items()], shipping=shipping)
+    if region and has_shipping_rates():
+        quote.shipping = quote_shipping(region, commune, quote.weight)
+        if quote.shipping is None:
+            raise PricingError(f"No hay tarifa de envío para {', '.join(part for part in (commune, region) if part)} con {quote.weight} g.")
+    if discount_code:
+        quote.apply_discount(discount_code)
+    return quote
@@ -0,0 +1,183 @@
+# payments/reconciliation.py
+"""
+Reconciliación de órdenes PENDING viejas contra Flow, para cuando el webhook
+de confirmación se perdió (`python manage.py reconcile_pending_orders`).
+
+- Recorre las órdenes PENDING con flow_token más antiguas que el corte en
+  lotes por clave (pk > último visto), sin OFFSET ni cargar todo en memoria.
+- Consulta payment/getStatus de cada lote con un pool de hilos acotado y un
+  cliente de Flow propio con tantas conexiones keep-alive como hilos.
+- Si el circuit breaker de getStatus rechaza consultas (abierto, o
+  semi-abierto con menos pruebas permitidas que hilos), esas órdenes se
+  reintentan pasado su Retry-After, hasta CIRCUIT_OPEN_RETRIES veces. La
+  corrida se detiene solo si el circuito sigue abierto después de eso.
+- Aplica las transiciones del lote en una sola transacción: un UPDATE por
+  estado final (solo sobre las que siguen PENDING, por si el webhook llegó
+  mientras tanto), un UPDATE por código de descuento para contar o liberar
+  sus usos y un bulk_create con los eventos de n8n y los emails del outbox.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.db import transaction
+from django.utils import timezone
+
+from .discounts import consume_discount_codes, release_discount_reservations
+from .emails import queue_order_status_emails
+from .flow_client import FlowClient, FlowError, FlowCircuitOpenError
+from .models import Order, OutboxEvent
+from .order_status import publish_order_statuses
+from .outbox import n8n_sale_event
+from .services import pending_order_transition
+
+logger = logging.getLogger(__name__)
+
+# Veces que se reintentan las órdenes de un lote que el circuit breaker rechazó
+CIRCUIT_OPEN_RETRIES = 3
+
+
+class ReconciliationStats:
+    def __init__(self):
+        self.scanned = 0
+        self.paid = 0
+        self.rejected = 0
+        self.still_pending = 0
+        self.errors = 0
+        self.error_samples = [] # Primeros errores, para el reporte
+
+
+def stale_pending_orders(older_than, batch_size, after_pk=0):
+    """Siguiente lote (por pk) de órdenes PENDING con token creadas antes de `older_than`."""
+    return list(
+        Order.objects.filter(status='PENDING', created_at__lt=older_than, pk__gt=after_pk, flow_token__isnull=False)
+        .exclude(flow_token='')
+        .order_by('pk')[:batch_size]
+    )
+
+
+def fetch_statuses(flow_client, orders, pool):
+    """
+    Consulta getStatus de cada orden en paralelo. Devuelve [(orden, payment_data o excepción)].
+
+    Las órdenes que el circuit breaker rechaza (FlowCircuitOpenError) se
+    vuelven a consultar después de esperar su retry_after, hasta
+    CIRCUIT_OPEN_RETRIES veces; si el circuito sigue abierto quedan con el
+    FlowCircuitOpenError como resultado.
+    """
+    def fetch(order):
+        try:
+            # Sin caché: son miles de tokens que no se vuelven a consultar
+            return order, flow_client.get_status(order.flow_token, use_cache=False)
+        except (requests.exceptions.RequestException, FlowError, ValueError) as e:
+            return order, e
+
+    results = {}
+    to_fetch = orders
+    for attempt in range(CIRCUIT_OPEN_RETRIES + 1):
+        rejected = []
+        for order, outcome in pool.map(fetch, to_fetch):
+            results[order.pk] = outcome
+            if isinstance(outcome, FlowCircuitOpenError):
+                rejected.append(order)
+        if not rejected or attempt == CIRCUIT_OPEN_RETRIES:
+            break
+        wait = max(max(results[order.pk].retry_after for order in rejected), 1)
+        logger.warning(f"Reconciliación: circuito de Flow abierto para {len(rejected)} órdenes del lote; se reintentan en {wait}s.")
+        time.sleep(wait)
+        to_fetch = rejected
+    return [(order, results[order.pk]) for order in orders]
+
+
+def apply_transitions(results, stats, dry_run=False):
+    """Aplica en bloque las transiciones finales de un lote ya consultado."""
+    to_status = {'PAID': [], 'REJECTED': []}
+    status_codes = {}
+    for order, payment_data in results:
+        stats.scanned += 1
+        if isinstance(payment_data, Exception):
+            stats.errors += 1
+            if len(stats.error_samples) < 5:
+                stats.error_samples.append(f"{order.commerce_order}: {payment_data}")
+            continue
+        if payment_data.get('commerceOrder') not in (None, order.commerce_order):
+            stats.errors += 1
+            logger.warning(f"Reconciliación: Flow devolvió commerceOrder {payment_data.get('commerceOrder')} para la orden {order.commerce_order}; se omite.")
+            continue
+        transition = pending_order_transition(order, payment_data.get('status'))
+        if transition is None:
+            stats.still_pending += 1
+            continue
+        to_status[transition['status']].append(order)
+        status_codes[order.pk] = payment_data.get('status')
+
+    if dry_run:
+        stats.paid += len(to_status['PAID'])
+        stats.rejected += len(to_status['REJECTED'])
+        return
+
+    now = timezone.now()
+    with transaction.atomic():
+        for new_status, orders in to_status.items():
+            if not orders:
+                continue
+            # Solo las que siguen PENDING: el webhook o el callback pueden haberlas movido ya
+            still_pending_pks = set(
+                Order.objects.select_for_update()
+                .filter(pk__in=[order.pk for order in orders], status='PENDING')
+                .values_list('pk', flat=True)
+            )
+            changed = [order for order in orders if order.pk in still_pending_pks]
+            if not changed:
+                continue
+            Order.objects.filter(pk__in=still_pending_pks, status='PENDING').update(status=new_status, updated_at=now)
+
+            outbox_events = []
+            for order in changed:
+                order.status = new_status
+                order.updated_at = now
+                if new_status == 'PAID':
+                    event = n8n_sale_event(order, status_codes[order.pk])
+                    if event is not None:
+                        outbox_events.append(event)
+                queue_order_status_emails(order, 'PENDING', events=outbox_events)
+            if new_status == 'PAID':
+                consume_discount_codes(changed)
+            else:
+                release_discount_reservations(changed)
+            OutboxEvent.objects.bulk_create(outbox_events)
+            transaction.on_commit(lambda changed=changed: publish_order_statuses(changed))
+
+            if new_status == 'PAID':
+                stats.paid += len(changed)
+            else:
+                stats.rejected += len(changed)
+
+
+def reconcile_pending_orders(older_than, batch_size=500, concurrency=16, dry_run=False, limit=None, progress=None):
+    """
+    Reconcilia todas las órdenes PENDING anteriores a `older_than`. Llama a
+    `progress(stats)` después de cada lote. Devuelve ReconciliationStats.
+    Lanza FlowCircuitOpenError (después de aplicar lo que ya se consultó del
+    lote) si el circuito de getStatus sigue abierto tras los reintentos.
+    """
+    stats = ReconciliationStats()
+    # Cliente propio: tantas conexiones keep-alive como hilos del pool
+    flow_client = FlowClient(pool_maxsize=concurrency)
+    last_pk = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while limit is None or stats.scanned < limit:
+            size = batch_size if limit is None else min(batch_size, limit - stats.scanned)
+            orders = stale_pending_orders(older_than, size, after_pk=last_pk)
+            if not orders:
+                break
+            last_pk = orders[-1].pk
+            results = fetch_statuses(flow_client, orders, pool)
+            apply_transitions(results, stats, dry_run=dry_run)
+            if progress:
+                progress(stats)
+            circuit_open = next((outcome for _, outcome in results if isinstance(outcome, FlowCircuitOpenError)), None)
+            if circuit_open is not None:
+                raise circuit_open # Flow sigue caído después de los reintentos: se detiene la corrida
+    return stats
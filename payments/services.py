@@ -0,0 +1,464 @@
+# payments/services.py
+"""
+Lógica del checkout compartida por las vistas síncronas (payments/views.py)
+y las asíncronas (payments/async_views.py). Las funciones de aquí no conocen
+DRF ni el tipo de respuesta: devuelven datos o lanzan CheckoutError con el
+cuerpo y el código HTTP que la vista debe responder.
+"""
+import base64
+import logging
+import urllib.parse
+from datetime import datetime
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Value
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from .discounts import (
+    get_discount_code,
+    invalidate_discount_codes,
+    reserve_discount_code,
+    consume_discount_code,
+    release_discount_reservation,
+)
+from .models import Order, normalize_phone_e164
+from .pricing import PricingError, price_cart
+from .outbox import enqueue_n8n_sale
+from .emails import queue_order_status_emails
+from .order_status import publish_order_status
+
+logger = logging.getLogger(__name__)
+
+
+class CheckoutError(Exception):
+    """Error del checkout con el cuerpo JSON y el código HTTP a devolver."""
+    def __init__(self, payload, http_status):
+        super().__init__(payload.get('error'))
+        self.payload = payload
+        self.http_status = http_status
+
+
+# --- Creación de pagos ---
+def quote_cart(data):
+    """
+    Cotiza el carrito de un payload con 'items' ([{slug, quantity}]) y,
+    opcionalmente, 'discount_code_applied' y la zona de envío ('region' y
+    'commune', o las de 'shippingDetails'). Si todavía no hay tarifas de envío
+    configuradas se usa el 'shipping_cost' del payload. Lanza CheckoutError 400
+    si el carrito no es válido.
+    """
+    shipping_details = data.get('shippingDetails') or {}
+    try:
+        shipping = Decimal(str(data.get('shipping_cost') or 0))
+    except Exception:
+        raise CheckoutError({"error": "El 'shipping_cost' debe ser un número válido."}, 400)
+    if shipping < 0:
+        raise CheckoutError({"error": "El 'shipping_cost' no puede ser negativo."}, 400)
+    try:
+        return price_cart(
+            data.get('items'),
+            discount_code=data.get('discount_code_applied'),
+            shipping=shipping,
+            region=data.get('region') or shipping_details.get('region'),
+            commune=data.get('commune') or shipping_details.get('comuna'),
+        )
+    except PricingError as e:
+        raise CheckoutError({"error": str(e)}, 400)
+
+
+def create_pending_order(data):
+    """
+    Valida el payload de create-payment, re-valida el código de descuento y
+    crea la orden PENDING. Devuelve la orden creada.
+
+    Si el payload trae 'items', el monto se calcula en el servidor (quote_cart)
+    y el código se valida contra el subtotal real; si además trae 'amount' y no
+    coincide, se responde 409 con la cotización para que el frontend la actualice.
+    Sin 'items' se mantiene el comportamiento anterior: se cobra el 'amount'.
+    """
+    # --- 1. Obtener datos del payload JSON ---
+    amount_from_frontend_str = data.get('amount') # Este es el MONTO FINAL con descuento y envío
+    commerce_order = data.get('commerceOrder')
+    subject = data.get('subject')
+    currency = data.get('currency', 'CLP')
+    fungigrow_return_url_from_frontend = data.get('return_url')
+    shipping_details = data.get('shippingDetails') or {}
+    customer_email_from_frontend = data.get('customer_email')
+
+    # Datos del descuento (opcionales desde el frontend)
+    discount_code_str_applied = data.get('discount_code_applied', None)
+    # Sin 'items', el frontend ya calculó el descuento y lo aplicó al 'amount'.
+    cart_items = data.get('items')
+
+    # --- 2. Validación de parámetros básicos requeridos ---
+    required_from_frontend = {
+        "commerceOrder": commerce_order,
+        "subject": subject,
+        "return_url": fungigrow_return_url_from_frontend,
+        "customer_email": customer_email_from_frontend,
+        "currency": currency
+    }
+    if cart_items is None: # Con ítems el monto lo calcula el servidor
+        required_from_frontend["amount"] = amount_from_frontend_str
+    missing_params = [key for key, value in required_from_frontend.items() if value is None or value == ""] # Chequea None y string vacío
+    if missing_params:
+        raise CheckoutError({"error": f"Faltan parámetros requeridos del frontend: {', '.join(missing_params)}"}, 400)
+
+    final_amount_to_charge = None
+    if amount_from_frontend_str not in (None, ""):
+        try:
+            final_amount_to_charge = Decimal(str(amount_from_frontend_str))
+        except Exception:
+            raise CheckoutError({"error": "El 'amount' debe ser un número válido."}, 400)
+
+    # --- 3. Revalidación del Código de Descuento (si se aplicó) ---
+    actual_discount_code_to_save = None # Código que se guardará en la orden
+    discount_code_to_reserve = None # Si tiene límite de usos, se aparta uno junto con la orden
+
+    if cart_items is not None:
+        # --- 3a. Carrito cotizado en el servidor: precios, descuento (con monto mínimo) y envío ---
+        quote = quote_cart(data)
+        if final_amount_to_charge is not None and final_amount_to_charge != quote.total:
+            logger.warning(f"CreatePaymentView: Monto del frontend {final_amount_to_charge} no coincide con la cotización {quote.total} para orden {commerce_order}.")
+            raise CheckoutError(
+                {"error": "El total del carrito cambió. Revisa el nuevo total e inténtalo nuevamente.", "quote": quote.as_dict()}, 409
+            )
+        if discount_code_str_applied and quote.discount_code is None:
+            logger.warning(f"CreatePaymentView: Código '{discount_code_str_applied}' no aplicado a la orden {commerce_order}: {quote.discount_message}")
+        final_amount_to_charge = quote.total
+        if quote.discount_code is not None:
+            actual_discount_code_to_save = quote.discount_code.code
+            discount_code_to_reserve = quote.discount_code
+    elif discount_code_str_applied:
+        discount_code_object = get_discount_code(discount_code_str_applied)
+        if discount_code_object is not None:
+            # Para validar min_purchase_amount, necesitaríamos el subtotal de productos ANTES del descuento.
+            # Como el frontend ya hizo esta validación, aquí solo validamos existencia, actividad, fechas y límite de uso.
+            is_valid, message = discount_code_object.is_valid() # Validación básica
+
+            if is_valid:
+                actual_discount_code_to_save = discount_code_object.code # Guardamos el código real
+                discount_code_to_reserve = discount_code_object
+                logger.info(f"CreatePaymentView: Código de descuento '{discount_code_object.code}' re-validado exitosamente para orden {commerce_order}.")
+                # NOTA: Confiamos en que el 'amount' enviado por el frontend ya tiene el descuento correctamente aplicado.
+            else:
+                # Si el código ya no es válido al momento de crear el pago, se procede sin descuento.
+                # El frontend es responsable de enviar el monto correcto si el código falla en su lado.
+                logger.warning(f"CreatePaymentView: Código '{discount_code_str_applied}' ya no es válido al crear pago para orden {commerce_order}. Mensaje: {message}. Se procederá sin descuento.")
+        else:
+            logger.warning(f"CreatePaymentView: Código de descuento '{discount_code_str_applied}' no encontrado al crear pago para orden {commerce_order}. Se procederá sin descuento.")
+
+    if final_amount_to_charge <= 0: # El monto final no puede ser cero o negativo
+        raise CheckoutError({"error": "El monto final del pedido no puede ser cero o negativo."}, 400)
+
+    # --- 4. Crear la Orden en la Base de Datos (y reservar el uso del código, en la misma transacción) ---
+    with transaction.atomic():
+        try:
+            order = Order.objects.create(
+                commerce_order=commerce_order,
+                amount=final_amount_to_charge, # Usamos el monto final que ya incluye el descuento (si lo hubo) y envío
+                status='PENDING',
+                fungigrow_return_url=fungigrow_return_url_from_frontend,
+                shipping_name=shipping_details.get('nombreCompleto'),
+                shipping_rut=shipping_details.get('rut'),
+                shipping_address=shipping_details.get('direccion'),
+                shipping_commune=shipping_details.get('comuna'),
+                shipping_region=shipping_details.get('region'),
+                shipping_phone=shipping_details.get('telefono'),
+                customer_email=customer_email_from_frontend,
+                applied_discount_code=actual_discount_code_to_save # Guardamos el código si fue válido
+            )
+        except Exception as e:
+            logger.error(f"CreatePaymentView: Error al crear orden {commerce_order} en BD: {e}")
+            raise CheckoutError({"error": f"La orden {commerce_order} ya existe o hubo un error al crearla en la BD."}, 400)
+
+        if discount_code_to_reserve is not None and not reserve_discount_code(discount_code_to_reserve, order):
+            # El monto ya trae el descuento: sin cupo no se puede cobrar así. Se deshace la orden.
+            logger.warning(f"CreatePaymentView: Código '{discount_code_to_reserve.code}' sin usos disponibles para orden {commerce_order}.")
+            invalidate_discount_codes() # Que la validación deje de ofrecerlo
+            raise CheckoutError(
+                {"error": "El código de descuento alcanzó su límite de usos. Actualiza tu carrito e inténtalo nuevamente."}, 409
+            )
+    return order
+
+
+def build_flow_payment_params(order, data):
+    """Parámetros de payment/create para la orden (sin apiKey ni firma)."""
+    public_backend_url = settings.PUBLIC_URL_BASE.rstrip('/')
+    return {
+        'commerceOrder': str(order.commerce_order),
+        'amount': str(int(order.amount)), # Flow espera un entero para CLP
+        'subject': data.get('subject'),
+        'email': order.customer_email,
+        'currency': data.get('currency', 'CLP'),
+        'urlConfirmation': f"{public_backend_url}/api/confirm-payment/",
+        'urlReturn': f"{public_backend_url}/payment/flow-callback/"
+        # 'paymentMethod': 9, # Opcional, Flow usa 9 (todos) por defecto
+    }
+
+
+def set_order_status(order, new_status):
+    with transaction.atomic():
+        order.status = new_status
+        order.save(update_fields=['status', 'updated_at'])
+        if new_status in ('REJECTED', 'ERROR'):
+            release_discount_reservation(order)
+
+
+def complete_flow_payment(order, flow_json_response):
+    """
+    Procesa la respuesta de payment/create: guarda el token en la orden y
+    devuelve el cuerpo 201 con la URL de pago. Si Flow devolvió un error o
+    una respuesta sin token, marca la orden REJECTED y lanza CheckoutError.
+    """
+    if 'code' in flow_json_response: # Error estructurado de Flow
+        set_order_status(order, 'REJECTED')
+        raise CheckoutError({"error": f"Error por parte de Flow: {flow_json_response.get('message')}", "flow_details": flow_json_response}, 400)
+
+    flow_token = flow_json_response.get('token')
+    if not flow_token:
+        set_order_status(order, 'REJECTED')
+        logger.error(f"CreatePaymentView: Respuesta de Flow sin token: {flow_json_response} para orden {order.commerce_order}")
+        raise CheckoutError({"error": "Respuesta inesperada de Flow (sin token).", "flow_details": flow_json_response}, 500)
+
+    order.flow_token = flow_token
+    order.save(update_fields=['flow_token', 'updated_at'])
+    return {
+        "redirect_url": f"{flow_json_response.get('url')}?token={flow_token}",
+        "token": flow_token
+    }
+
+
+# --- Confirmación (webhook de Flow) ---
+def apply_flow_confirmation(flow_token, payment_data):
+    """
+    Aplica el estado autoritativo de Flow a la orden bajo select_for_update.
+    Si la orden pasa a PAID, la notificación a n8n se encola en el outbox en la
+    misma transacción: todo queda en un solo commit y no se llama a n8n con el
+    lock tomado. Devuelve (orden, should_trigger_n8n); la orden es None si no
+    se encontró.
+    """
+    commerce_order_id = payment_data.get('commerceOrder')
+    flow_status_code = payment_data.get('status') # 1=Pendiente, 2=Pagada, 3=Rechazada, 4=Anulada
+
+    with transaction.atomic():
+        try:
+            order_to_update = Order.objects.select_for_update().get(commerce_order=commerce_order_id)
+        except Order.DoesNotExist:
+            logger.error(f"FlowConfirmationView: Orden {commerce_order_id} (token {flow_token}) confirmada por Flow NO FUE ENCONTRADA en la BD.")
+            return None, False
+
+        previous_status = order_to_update.status
+
+        # Guardar/Actualizar el token de Flow en nuestra orden si no lo teníamos
+        if not order_to_update.flow_token or order_to_update.flow_token != flow_token:
+            order_to_update.flow_token = flow_token
+
+        should_trigger_n8n = False
+
+        # Lógica de Idempotencia y actualización
+        if order_to_update.status == 'PAID' and flow_status_code == 2:
+            logger.info(f"FlowConfirmationView: Orden {commerce_order_id} ya está PAGADA. No se realizan acciones adicionales.")
+        elif order_to_update.status == 'REJECTED' and (flow_status_code == 3 or flow_status_code == 4):
+            logger.info(f"FlowConfirmationView: Orden {commerce_order_id} ya está RECHAZADA. No se realizan acciones adicionales.")
+        else: # El estado actual no es final o no coincide, procedemos a actualizar.
+            if flow_status_code == 2: # Pagada
+                order_to_update.status = 'PAID'
+                logger.info(f"FlowConfirmationView: ✅ Orden {commerce_order_id} actualizada a PAGADA en BD.")
+            elif flow_status_code == 3 or flow_status_code == 4: # Rechazada o Anulada
+                order_to_update.status = 'REJECTED'
+                logger.info(f"FlowConfirmationView: ❌ Orden {commerce_order_id} actualizada a RECHAZADA en BD.")
+            elif flow_status_code == 1: # Pendiente
+                logger.info(f"FlowConfirmationView: ⏳ Orden {commerce_order_id} está/sigue PENDIENTE según Flow. Estado actual BD: {previous_status}.")
+            else:
+                logger.warning(f"FlowConfirmationView: Estado desconocido {flow_status_code} de Flow para orden {commerce_order_id}. Se marca como ERROR.")
+                order_to_update.status = 'ERROR'
+
+            order_to_update.save()
+
+            # Disparamos n8n si el estado cambió a PAID y no lo estaba antes.
+            if order_to_update.status == 'PAID' and previous_status != 'PAID':
+                should_trigger_n8n = True
+                consume_discount_code(order_to_update)
+                enqueue_n8n_sale(order_to_update, flow_status_code)
+            elif order_to_update.status in ('REJECTED', 'ERROR'):
+                release_discount_reservation(order_to_update)
+            queue_order_status_emails(order_to_update, previous_status)
+
+    return order_to_update, should_trigger_n8n
+
+
+def build_n8n_sale_payload(order, flow_status_code):
+    """Cuerpo que recibe el webhook de ventas de n8n."""
+    return {
+        "commerceOrder": order.commerce_order,
+        "amount": str(order.amount),
+        "customer_email": order.customer_email,
+        "flow_token": order.flow_token,
+        "payment_status_flow_code": flow_status_code,
+        "payment_status_internal": order.status,
+        "shipping_details": {
+            "nombreCompleto": order.shipping_name,
+            "rut": order.shipping_rut,
+            "direccion": order.shipping_address,
+            "comuna": order.shipping_commune,
+            "region": order.shipping_region,
+            "telefono": order.shipping_phone,
+        },
+        "fungigrow_return_url": order.fungigrow_return_url,
+        "order_created_at": order.created_at.isoformat() if order.created_at else None,
+        "order_updated_at": order.updated_at.isoformat() if order.updated_at else None,
+        "store_owner_email_recipient": settings.STORE_OWNER_EMAIL
+    }
+
+
+# --- Retorno del usuario desde Flow (callback) ---
+def pending_order_transition(order, flow_status_code, flow_token=None):
+    """
+    Campos del UPDATE condicional que pasa una orden PENDING a su estado final
+    según el código de Flow, o None si el código no es final.
+    """
+    if flow_status_code == 2:
+        new_status = 'PAID'
+    elif flow_status_code == 3 or flow_status_code == 4:
+        new_status = 'REJECTED'
+    else:
+        return None # No cambiamos a PENDING aquí, solo a estados finales.
+
+    fields_to_update = {'status': new_status, 'updated_at': timezone.now()}
+    if flow_token and not order.flow_token: # Si no tenía el token, lo guardamos
+        fields_to_update['flow_token'] = flow_token
+    return fields_to_update
+
+
+def update_pending_order_status(order, flow_status_code, flow_token=None):
+    """
+    Pasa una orden PENDING a PAID o REJECTED según el código de Flow usando un
+    UPDATE condicional (WHERE status='PENDING'). Si el webhook y el navegador
+    llegan a la vez, solo uno hace la transición y nadie pisa el estado final
+    del otro. Quien hace la transición encola en la misma transacción la venta
+    para n8n y los emails de la orden. Devuelve True si esta llamada actualizó la orden.
+    """
+    fields_to_update = pending_order_transition(order, flow_status_code, flow_token)
+    if not fields_to_update:
+        return False
+    with transaction.atomic():
+        updated = Order.objects.filter(pk=order.pk, status='PENDING').update(**fields_to_update)
+        if updated:
+            for field_name, value in fields_to_update.items():
+                setattr(order, field_name, value)
+            if order.status == 'PAID':
+                consume_discount_code(order)
+                enqueue_n8n_sale(order, flow_status_code)
+            else:
+                release_discount_reservation(order)
+            queue_order_status_emails(order, 'PENDING')
+            # El UPDATE no dispara post_save: publicamos el estado a mano
+            transaction.on_commit(lambda: publish_order_status(order))
+    return bool(updated)
+
+
+async def aupdate_pending_order_status(order, flow_status_code, flow_token=None):
+    """Versión async de update_pending_order_status (la transacción corre vía sync_to_async)."""
+    return await sync_to_async(update_pending_order_status)(order, flow_status_code, flow_token=flow_token)
+
+
+def apply_callback_status_to_redirect(payment_data, redirect_params):
+    """Completa status/message de la redirección a FungiGrow según la respuesta de getStatus."""
+    flow_status_code = payment_data.get('status') # 1=Pendiente, 2=Pagada, 3=Rechazada, 4=Anulada
+    commerce_order_from_flow = payment_data.get('commerceOrder')
+
+    if commerce_order_from_flow: # Usamos el commerceOrder de Flow como la fuente más fiable
+        redirect_params['orderId'] = commerce_order_from_flow
+
+    if flow_status_code == 2: # Pagada
+        redirect_params['status'] = 'success'
+        redirect_params['message'] = 'Tu pago fue exitoso'
+    elif flow_status_code == 3 or flow_status_code == 4: # Rechazada o Anulada
+        redirect_params['status'] = 'failure'
+        # Usar el mensaje de Flow si está disponible, sino uno genérico
+        flow_payment_message = (payment_data.get('paymentData') or {}).get('user_message', 'Pago rechazado o anulado')
+        redirect_params['message'] = flow_payment_message if flow_payment_message else 'Pago rechazado o anulado'
+    elif flow_status_code == 1: # Pendiente
+        redirect_params['status'] = 'pending'
+        redirect_params['message'] = 'Tu pago esta pendiente'
+    else: # Otro estado o error en la respuesta de Flow
+        redirect_params['status'] = 'error'
+        redirect_params['message'] = 'Estado de pago desconocido desde Flow'
+
+
+def build_fungigrow_redirect_url(redirect_params):
+    """URL final de /checkout/confirmation en FungiGrow con los parámetros dados."""
+    # Limpiar y codificar espacios en el mensaje para la URL
+    if 'message' in redirect_params and redirect_params['message']:
+        redirect_params['message'] = urllib.parse.quote_plus(str(redirect_params['message']))
+
+    query_string = urllib.parse.urlencode(redirect_params)
+    return f"{settings.FUNGIFRESH_STORE_URL}/checkout/confirmation?{query_string}"
+
+
+# --- Consulta de órdenes ---
+# Lo único que devuelve query-order-status (más el id, para el cursor)
+ORDER_QUERY_FIELDS = ('id', 'commerce_order', 'status', 'created_at', 'amount', 'shipping_name')
+
+
+def find_orders(commerce_order=None, email=None, phone=None):
+    """
+    Órdenes por commerce_order (sin distinguir mayúsculas), email del cliente
+    o teléfono de envío, de la más reciente a la más antigua.
+    Cada filtro calza con un índice de Order (ver Meta.indexes): se compara
+    LOWER(columna) y no `__iexact`, que en SQLite es un LIKE que no usa índices.
+    Devuelve None si no se indicó ningún criterio.
+    """
+    if commerce_order:
+        return (
+            Order.objects.alias(commerce_order_ci=Lower('commerce_order'))
+            .filter(commerce_order_ci=Lower(Value(commerce_order)))
+            .order_by('-created_at', '-id')
+        )
+    if email:
+        return (
+            Order.objects.alias(customer_email_ci=Lower('customer_email'))
+            .filter(customer_email_ci=Lower(Value(email)))
+            .order_by('-created_at', '-id')
+        )
+    if phone:
+        return Order.objects.filter(shipping_phone_e164=normalize_phone_e164(phone)).order_by('-created_at', '-id')
+    return None
+
+
+def encode_order_cursor(row):
+    """Cursor opaco que apunta a la orden siguiente a `row` en el orden (-created_at, -id)."""
+    raw = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_order_cursor(cursor):
+    """(created_at, id) de un cursor de encode_order_cursor. Lanza ValueError si no es válido."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, order_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(order_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+
+
+def order_page(orders_query, cursor=None, limit=20):
+    """
+    Una página de `orders_query` (ordenado por -created_at, -id) por clave en
+    vez de OFFSET: sigue desde la última orden entregada, así que cada página
+    cuesta lo mismo sin importar cuántas órdenes tenga el cliente. Solo trae
+    ORDER_QUERY_FIELDS. Devuelve (filas, cursor de la página siguiente o None).
+    """
+    if cursor:
+        created_at, order_id = decode_order_cursor(cursor)
+        orders_query = orders_query.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=order_id))
+    rows = list(orders_query.values(*ORDER_QUERY_FIELDS)[:limit + 1])
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_order_cursor(rows[-1])
+    return rows, None
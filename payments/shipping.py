@@ -0,0 +1,108 @@
+# payments/shipping.py
+"""
+Cálculo de envío desde la tabla de tarifas (ShippingRate) cargada en memoria.
+
+Las cotizaciones corren en cada cambio del carrito, así que cada worker
+arma una vez un índice {(región, comuna): bandas de peso} con todas las
+tarifas activas y responde desde ahí sin tocar la BD: un acceso al diccionario
+por zona y una búsqueda binaria entre las pocas bandas de esa zona.
+
+El índice se reconstruye cuando una tarifa se guarda o se borra
+(payments/signals.py). Como en payments/discounts.py, los demás workers se
+enteran por una versión en la caché de Django, lo que requiere una caché
+compartida (settings.CACHE_IS_SHARED). Además cada índice se recarga a los
+SHIPPING_RATES_CACHE_TTL segundos: sin caché compartida (10 s por defecto)
+es lo que tardan los demás workers en ver el cambio.
+
+Zonas, de la más específica a la más general: región + comuna, la región
+completa (comuna vacía) y la tarifa por defecto (región y comuna vacías).
+Región y comuna se comparan sin mayúsculas, tildes ni espacios extra.
+"""
+import bisect
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import ShippingRate
+
+SHIPPING_RATES_VERSION_KEY = 'shipping-rates-version'
+
+
+def normalize_zone(name):
+    """'Región Metropolitana ' -> 'region metropolitana'."""
+    decomposed = unicodedata.normalize('NFKD', name or '')
+    return ' '.join(''.join(char for char in decomposed if not unicodedata.combining(char)).lower().split())
+
+
+class ShippingRateTable:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None # {(región, comuna): ([max_weight...], [precio...])}
+        self._version = None
+        self._loaded_at = 0.0
+
+    def _is_stale(self, version):
+        return self._index is None or version != self._version or time.monotonic() - self._loaded_at >= settings.SHIPPING_RATES_CACHE_TTL
+
+    def _load(self):
+        index = {}
+        for rate in ShippingRate.objects.filter(is_active=True).order_by('max_weight').only('region', 'commune', 'max_weight', 'price'):
+            weights, prices = index.setdefault((normalize_zone(rate.region), normalize_zone(rate.commune)), ([], []))
+            weights.append(rate.max_weight)
+            prices.append(rate.price)
+        return index
+
+    def index(self):
+        version = cache.get(SHIPPING_RATES_VERSION_KEY)
+        if version is None:
+            cache.add(SHIPPING_RATES_VERSION_KEY, time.time_ns(), None)
+            version = cache.get(SHIPPING_RATES_VERSION_KEY)
+        if self._is_stale(version):
+            with self._lock:
+                if self._is_stale(version):
+                    self._index = self._load()
+                    self._version = version
+                    self._loaded_at = time.monotonic()
+        return self._index
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+            self._version = None
+
+
+_shipping_rates = ShippingRateTable()
+
+
+def has_shipping_rates():
+    """True si hay alguna tarifa activa configurada."""
+    return bool(_shipping_rates.index())
+
+
+def quote_shipping(region, commune, weight):
+    """
+    Precio de enviar `weight` gramos a la región/comuna, o None si no hay
+    tarifa para esa zona o el peso supera la banda más alta.
+    """
+    index = _shipping_rates.index()
+    region, commune = normalize_zone(region), normalize_zone(commune)
+    for zone in ((region, commune), (region, ''), ('', '')):
+        bands = index.get(zone)
+        if bands is None:
+            continue
+        weights, prices = bands
+        position = bisect.bisect_left(weights, weight)
+        return prices[position] if position < len(prices) else None
+    return None
+
+
+def invalidate_shipping_rates():
+    """Fuerza a todos los workers a recargar la tabla de tarifas."""
+    try:
+        cache.incr(SHIPPING_RATES_VERSION_KEY)
+    except ValueError:
+        cache.set(SHIPPING_RATES_VERSION_KEY, time.time_ns(), None)
+    _shipping_rates.clear()
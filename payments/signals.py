@@ -0,0 +1,32 @@
+# payments/signals.py
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .discounts import invalidate_discount_codes
+from .shipping import invalidate_shipping_rates
+from .models import Order, DiscountCode, ShippingRate
+from .order_status import publish_order_status, forget_order_status
+
+
+@receiver(post_save, sender=Order)
+def publish_status_on_save(sender, instance, **kwargs):
+    # Recién al hacer commit: quien espera no debe ver un estado que aún puede revertirse
+    transaction.on_commit(lambda: publish_order_status(instance))
+
+
+@receiver(post_delete, sender=Order)
+def forget_status_on_delete(sender, instance, **kwargs):
+    transaction.on_commit(lambda: forget_order_status(instance))
+
+
+@receiver(post_save, sender=DiscountCode)
+@receiver(post_delete, sender=DiscountCode)
+def invalidate_discount_codes_on_change(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_discount_codes)
+
+
+@receiver(post_save, sender=ShippingRate)
+@receiver(post_delete, sender=ShippingRate)
+def invalidate_shipping_rates_on_change(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_shipping_rates)
@@ -1,3 +1,1180 @@
-from django.test import TestCase
+import asyncio
+import json
+import smtplib
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from functools import partial
+from io import StringIO
+from urllib.parse import parse_qsl
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import httpx
+import requests
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from requests.adapters import BaseAdapter
+
+from products.models import Product
+
+from . import circuit_breaker
+from .async_views import AsyncCreatePaymentView, AsyncFlowConfirmationView
+
+from .discounts import consume_discount_code, generate_discount_codes, get_discount_code, invalidate_discount_codes
+from .flow_client import (
+    AsyncFlowClient,
+    FlowCircuitOpenError,
+    FlowClient,
+    FlowConfigurationError,
+    ThreadedFlowClient,
+    get_async_flow_client,
+    get_flow_client,
+    sign_params,
+    status_cache_key,
+    status_lock_key,
+)
+from .flow_emulator import PAY_PAGE_PATH, FlowEmulator, make_server
+from .models import DiscountCode, DiscountReservation, Order, OutboxEvent, ShippingRate, normalize_phone_e164
+from .order_status import publish_order_status, wait_for_status_change
+from .outbox import claim_due_events, close_email_connection, dispatch_batch, retry_delay
+from .pricing import price_cart
+from .reconciliation import CIRCUIT_OPEN_RETRIES, ReconciliationStats, apply_transitions, reconcile_pending_orders
+from .shipping import invalidate_shipping_rates, quote_shipping
+from .services import (
+    ORDER_QUERY_FIELDS,
+    CheckoutError,
+    create_pending_order,
+    decode_order_cursor,
+    encode_order_cursor,
+    find_orders,
+    set_order_status,
+    update_pending_order_status,
+)
+
+SIMULATED_ORDERS = 1_000_000
+
+# sqlite_stat1 de una tabla con 1M de órdenes: filas totales y, por cada prefijo
+# del índice, cuántas filas comparten en promedio el mismo valor
+SIMULATED_INDEX_STATS = {
+    'order_flow_token_idx': '1 1',
+    'order_commerce_order_ci_idx': '1 1',
+    'order_email_created_idx': '8 1 1', # ~8 órdenes por cliente
+    'order_phone_created_idx': '8 1 1',
+    'order_status_created_idx': '250000 1',
+}
+
+
+FLOW_TEST_SETTINGS = {'FLOW_API_URL_PROD': 'https://sandbox.flow.test/api', 'FLOW_API_KEY': 'key', 'FLOW_SECRET_KEY': 'secret'}
+
+
+class FakeFlowAdapter(BaseAdapter):
+    """Transporte de requests que responde como la API de Flow, sin red: handler(request) -> (status, json)."""
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+        self.requests = []
+        self.timeouts = []
+        self._lock = threading.Lock()
+
+    def send(self, request, timeout=None, **kwargs):
+        with self._lock:
+            self.requests.append(request)
+            self.timeouts.append(timeout)
+        status, body = self.handler(request)
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(body).encode()
+        response.headers['Content-Type'] = 'application/json'
+        response.url, response.request = request.url, request
+        return response
+
+    def close(self):
+        pass
+
+
+def flow_request_params(request):
+    """Parámetros firmados de una llamada a Flow (query string del GET o cuerpo del POST)."""
+    query = request.url.split('?', 1)[1] if '?' in request.url else request.body or ''
+    return dict(parse_qsl(query if isinstance(query, str) else query.decode()))
+
+
+class NormalizePhoneTests(TestCase):
+    def test_formats_converge_to_e164(self):
+        for phone in ('+56 9 1234 5678', '56912345678', '912345678', '(9) 1234-5678', '0056912345678'):
+            self.assertEqual(normalize_phone_e164(phone), '+56912345678', phone)
+        self.assertIsNone(normalize_phone_e164(''))
+        self.assertIsNone(normalize_phone_e164('sin teléfono'))
+
+    def test_order_save_fills_e164_column(self):
+        order = Order.objects.create(commerce_order='TEL-1', amount=1000, shipping_phone='9 8765 4321')
+        self.assertEqual(order.shipping_phone_e164, '+56987654321')
+        order.shipping_phone = '+56 2 2345 6789'
+        order.save(update_fields=['shipping_phone'])
+        order.refresh_from_db()
+        self.assertEqual(order.shipping_phone_e164, '+56223456789')
+
+
+@skipUnless(connection.vendor == 'sqlite', "Las estadísticas simuladas son de SQLite (sqlite_stat1).")
+class OrderLookupIndexTests(TestCase):
+    """
+    Cada búsqueda de órdenes de las vistas debe resolverse con un índice, y las
+    que ordenan por fecha deben leerlo en ese orden (sin "USE TEMP B-TREE").
+    En vez de insertar 1M de filas se le hace creer al planificador de SQLite
+    que la tabla las tiene, escribiendo sqlite_stat1 y recargándola.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        Order.objects.create(
+            commerce_order='IDX-1', amount=1000, flow_token='tok-1',
+            customer_email='Cliente@Example.com', shipping_phone='+56 9 1234 5678',
+        )
+        table = Order._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            cursor.execute('DELETE FROM sqlite_stat1 WHERE tbl = %s', [table])
+            cursor.execute('INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (%s, NULL, %s)', [table, str(SIMULATED_ORDERS)])
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s", [table])
+            for (index_name,) in cursor.fetchall():
+                # Índices que no son de búsqueda (FKs, unique de commerce_order) quedan como únicos
+                stat = SIMULATED_INDEX_STATS.get(index_name, '1')
+                cursor.execute('INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (%s, %s, %s)', [table, index_name, f"{SIMULATED_ORDERS} {stat}"])
+            cursor.execute('ANALYZE sqlite_schema') # Recarga las estadísticas
+
+    def assertUsesIndex(self, queryset, index_name=None, ordered=False):
+        plan = queryset.explain()
+        self.assertIn('USING', plan, plan)
+        self.assertNotRegex(plan, r'SCAN payments_order(?! USING)', plan)
+        if index_name:
+            self.assertIn(index_name, plan, plan)
+        if ordered:
+            self.assertNotIn('TEMP B-TREE', plan, plan)
+
+    def test_flow_token_lookup(self):
+        self.assertUsesIndex(Order.objects.filter(flow_token='tok-1'), 'order_flow_token_idx')
+
+    def test_commerce_order_lookup(self):
+        self.assertUsesIndex(Order.objects.filter(commerce_order='IDX-1'))
+
+    def test_commerce_order_case_insensitive_lookup(self):
+        queryset = find_orders(commerce_order='idx-1')
+        self.assertUsesIndex(queryset, 'order_commerce_order_ci_idx')
+        self.assertEqual([order.commerce_order for order in queryset], ['IDX-1'])
+
+    def test_email_lookup_ordered_by_date(self):
+        queryset = find_orders(email='CLIENTE@example.com')
+        self.assertUsesIndex(queryset, 'order_email_created_idx', ordered=True)
+        self.assertEqual([order.commerce_order for order in queryset], ['IDX-1'])
+
+    def test_phone_lookup_ordered_by_date(self):
+        queryset = find_orders(phone='912345678')
+        self.assertUsesIndex(queryset, 'order_phone_created_idx', ordered=True)
+        self.assertEqual([order.commerce_order for order in queryset], ['IDX-1'])
+
+    def test_keyset_page_keeps_index_order(self):
+        first_page = find_orders(email='cliente@example.com').values(*ORDER_QUERY_FIELDS)[:1]
+        cursor = encode_order_cursor(first_page[0])
+        created_at, order_id = decode_order_cursor(cursor)
+        next_page = find_orders(email='cliente@example.com').filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=order_id)
+        ).values(*ORDER_QUERY_FIELDS)[:21]
+        self.assertUsesIndex(next_page, 'order_email_created_idx', ordered=True)
+
+    def test_stale_pending_lookup(self):
+        self.assertUsesIndex(Order.objects.filter(status='PENDING', created_at__lt=timezone.now()), 'order_status_created_idx')
+
+
+class QueryOrderStatusPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(5):
+            Order.objects.create(commerce_order=f"B2B-{i}", amount=1000 + i, customer_email='compras@empresa.cl')
+        # Misma fecha para todas: el cursor debe desempatar por id
+        Order.objects.filter(customer_email='compras@empresa.cl').update(created_at=timezone.now())
+
+    def test_walks_all_pages_with_cursor(self):
+        seen = []
+        url = '/api/query-order-status/?email=COMPRAS@empresa.cl&limit=2'
+        for _ in range(5):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.json()), 2)
+            seen += [row['commerce_order'] for row in response.json()]
+            if 'X-Next-Cursor' not in response:
+                break
+            url = f"/api/query-order-status/?email=COMPRAS@empresa.cl&limit=2&cursor={response['X-Next-Cursor']}"
+        self.assertEqual(seen, [f"B2B-{i}" for i in range(4, -1, -1)])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get('/api/query-order-status/?email=compras@empresa.cl&cursor=nope')
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkOrderStatusTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Order.objects.create(commerce_order='BULK-1', amount=1000, flow_token='tok-bulk-1', status='PAID')
+        Order.objects.create(commerce_order='BULK-2', amount=1000, flow_token='tok-bulk-2')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_resolves_many_orders_with_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                '/api/order-status-bulk/', {'commerce_orders': ['BULK-1', 'BULK-2', 'NO-EXISTE']}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        orders = response.json()['orders']
+        self.assertEqual(orders['BULK-1']['status'], 'PAID')
+        self.assertTrue(orders['BULK-1']['final'])
+        self.assertEqual(orders['BULK-2']['status'], 'PENDING')
+        self.assertEqual(orders['NO-EXISTE'], {'found': False})
+
+        # La segunda vez las encontradas salen de la caché; solo la inexistente vuelve a la BD
+        with self.assertNumQueries(1):
+            self.client.post('/api/order-status-bulk/', {'commerce_orders': ['BULK-1', 'BULK-2', 'NO-EXISTE']}, content_type='application/json')
+
+    def test_by_flow_token(self):
+        response = self.client.post('/api/order-status-bulk/', {'flow_tokens': ['tok-bulk-2', 'tok-x']}, content_type='application/json')
+        orders = response.json()['orders']
+        self.assertEqual(orders['tok-bulk-2']['commerce_order'], 'BULK-2')
+        self.assertFalse(orders['tok-x']['found'])
+
+    @override_settings(ORDER_STATUS_BULK_MAX_ITEMS=2)
+    def test_rejects_too_many_items(self):
+        response = self.client.post('/api/order-status-bulk/', {'commerce_orders': ['A', 'B', 'C']}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class DiscountCodeCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_discount_codes()
+        self.discount = DiscountCode.objects.create(code='Promo10', discount_type='percentage', discount_value=10)
+
+    def validate(self, code):
+        return self.client.post('/api/validate-discount/', {'code': code, 'cart_subtotal': '20000'}, content_type='application/json')
+
+    def test_repeated_validation_hits_no_queries(self):
+        self.assertEqual(self.validate('promo10').json()['code'], 'Promo10')
+        self.assertEqual(self.validate('PROMO1').status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.validate(' PROMO10 ').json()['isValid'])
+            self.assertEqual(self.validate('promo1').status_code, 404) # Los que no existen también quedan en memoria
+
+    def test_save_invalidates_cached_code(self):
+        self.assertTrue(self.validate('PROMO10').json()['isValid'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.discount.is_active = False
+            self.discount.save()
+        self.assertFalse(self.validate('PROMO10').json()['isValid'])
+
+    def test_rejects_codes_that_differ_only_in_case(self):
+        duplicate = DiscountCode(code=' promo10', discount_type='percentage', discount_value=5)
+        with self.assertRaises(ValidationError) as raised:
+            duplicate.full_clean()
+        self.assertIn('code', raised.exception.message_dict)
+        self.discount.full_clean() # Editar el propio código no choca consigo mismo
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            duplicate.save()
+
+
+class DiscountReservationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_discount_codes()
+        self.discount = DiscountCode.objects.create(code='ULTIMO', discount_type='fixed_amount', discount_value=1000, usage_limit=1)
+
+    def checkout(self, commerce_order):
+        return create_pending_order({
+            'amount': 9000, 'commerceOrder': commerce_order, 'subject': 'Compra', 'return_url': 'http://localhost:3000',
+            'customer_email': 'cliente@example.com', 'discount_code_applied': 'ultimo',
+        })
+
+    def test_last_use_cannot_be_taken_twice(self):
+        order = self.checkout('RES-1')
+        with self.assertRaises(CheckoutError) as ctx:
+            self.checkout('RES-2')
+        self.assertEqual(ctx.exception.http_status, 409)
+        self.assertFalse(Order.objects.filter(commerce_order='RES-2').exists())
+
+        update_pending_order_status(order, 2)
+        self.discount.refresh_from_db()
+        self.assertEqual((self.discount.times_used, self.discount.reserved), (1, 0))
+        self.assertFalse(DiscountReservation.objects.exists())
+
+    def test_rejected_and_expired_reservations_are_released(self):
+        set_order_status(self.checkout('RES-3'), 'REJECTED')
+        self.discount.refresh_from_db()
+        self.assertEqual(self.discount.reserved, 0)
+
+        self.checkout('RES-4')
+        DiscountReservation.objects.update(expires_at=timezone.now())
+        self.checkout('RES-5') # Sin cupo: libera la reserva vencida de RES-4 y toma el uso
+        self.discount.refresh_from_db()
+        self.assertEqual(self.discount.reserved, 1)
+        self.assertEqual(DiscountReservation.objects.get().order.commerce_order, 'RES-5')
+
+        # RES-4 paga tarde, sin reserva y sin cupo: no se cuenta por sobre el límite
+        self.assertFalse(consume_discount_code(Order.objects.get(commerce_order='RES-4')))
+
+    def test_admin_save_keeps_usage_counters(self):
+        DiscountCode.objects.filter(pk=self.discount.pk).update(usage_limit=2)
+        self.checkout('RES-6')
+        self.checkout('RES-7')
+        consume_discount_code(Order.objects.get(commerce_order='RES-7'))
+        self.discount.discount_value = 2000 # Instancia leída antes de la reserva y del pago
+        self.discount.save()
+        self.discount.refresh_from_db()
+        self.assertEqual((self.discount.reserved, self.discount.times_used), (1, 1))
+        self.assertEqual(self.discount.discount_value, 2000)
+
+
+class DiscountCodeGenerationTests(TestCase):
+    def test_generates_unique_codes_and_validates_them_in_one_query(self):
+        codes = generate_discount_codes(
+            300, {'discount_type': 'fixed_amount', 'discount_value': 5000, 'usage_limit': 1}, prefix='camp-', length=6, batch_size=128
+        )
+        self.assertEqual(len(set(codes)), 300)
+        self.assertTrue(all(code.startswith('CAMP-') for code in codes))
+        self.assertEqual(DiscountCode.objects.filter(code_normalized__startswith='CAMP-').count(), 300)
+
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                '/api/validate-discounts/', {'codes': [codes[0].lower(), codes[1], 'NOPE'], 'cart_subtotal': 20000},
+                content_type='application/json'
+            )
+        results = response.json()['results']
+        self.assertTrue(results[codes[0].lower()]['isValid'])
+        self.assertEqual(results[codes[1]]['discountAmountCalculated'], 5000)
+        self.assertFalse(results['NOPE']['isValid'])
+
+    def test_existing_codes_are_skipped_and_replaced(self):
+        DiscountCode.objects.create(code='CAMP-AAAA', discount_type='fixed_amount', discount_value=1, times_used=3)
+        batches = iter([{'CAMP-AAAA', 'CAMP-BBBB'}, {'CAMP-CCCC'}])
+        with mock.patch('payments.discounts._random_codes', side_effect=lambda *args: next(batches)):
+            codes = generate_discount_codes(2, {'discount_type': 'fixed_amount', 'discount_value': 5000}, prefix='camp-', length=4)
+        self.assertEqual(sorted(codes), ['CAMP-BBBB', 'CAMP-CCCC'])
+        self.assertEqual(DiscountCode.objects.get(code='CAMP-AAAA').times_used, 3) # El existente no se toca
+
+    def test_command_validates_arguments_before_creating_codes(self):
+        with self.assertRaises(CommandError):
+            call_command('generate_discount_codes', 10, type='fixed_amount', value='1000', output='/no/existe/codigos.csv')
+        with self.assertRaises(CommandError):
+            call_command('generate_discount_codes', 10, '--usage-limit=-1', type='fixed_amount', value='1000')
+        self.assertFalse(DiscountCode.objects.exists())
+
+
+class CartPricingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(50):
+            Product.objects.create(name=f"Kit {i}", slug=f"kit-{i}", price=1000 + i, weight=500)
+        Product.objects.create(name="Retirado", slug='retirado', price=1000, is_active=False)
+        DiscountCode.objects.create(code='MIN20K', discount_type='percentage', discount_value=10, min_purchase_amount=20000)
+
+    def setUp(self):
+        cache.clear()
+        invalidate_discount_codes()
+
+    def test_fifty_item_cart_costs_one_query(self):
+        items = [{'slug': f"kit-{i}", 'quantity': 2} for i in range(50)]
+        get_discount_code('MIN20K') # Código ya en la caché del worker
+        with self.assertNumQueries(1):
+            quote = price_cart(items, discount_code='min20k', shipping=Decimal('3990'))
+        self.assertEqual(quote.subtotal, sum(2 * (1000 + i) for i in range(50)))
+        self.assertEqual(quote.discount_amount, quote.subtotal / 10)
+        self.assertEqual(quote.total, quote.subtotal - quote.discount_amount + 3990)
+        self.assertEqual(quote.weight, 50 * 2 * 500)
+
+    def test_minimum_purchase_is_checked_against_real_subtotal(self):
+        quote = price_cart([{'slug': 'kit-0', 'quantity': 1}], discount_code='MIN20K')
+        self.assertIsNone(quote.discount_code)
+        self.assertEqual(quote.total, 1000)
+
+    def test_unknown_or_inactive_products_are_rejected(self):
+        response = self.client.post('/api/cart-quote/', {'items': [{'slug': 'retirado'}]}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_checkout_charges_server_total_and_rejects_stale_amount(self):
+        data = {
+            'commerceOrder': 'CART-1', 'subject': 'Compra', 'return_url': 'http://localhost:3000',
+            'customer_email': 'cliente@example.com', 'items': [{'slug': 'kit-1', 'quantity': 3}], 'shipping_cost': 2000,
+        }
+        with self.assertRaises(CheckoutError) as ctx:
+            create_pending_order({**data, 'amount': 1})
+        self.assertEqual(ctx.exception.http_status, 409)
+        self.assertEqual(ctx.exception.payload['quote']['total'], '5003')
+
+        order = create_pending_order(data)
+        self.assertEqual(order.amount, 3 * 1001 + 2000)
+
+
+class ShippingRateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        ShippingRate.objects.bulk_create([
+            ShippingRate(region='', commune='', max_weight=5000, price=6990),
+            ShippingRate(region='Región Metropolitana', commune='', max_weight=1000, price=2990),
+            ShippingRate(region='Región Metropolitana', commune='', max_weight=5000, price=3990),
+            ShippingRate(region='Región Metropolitana', commune='Santiago', max_weight=5000, price=1990),
+        ])
+        Product.objects.create(name="Kit", slug='kit', price=10000, weight=800)
+
+    def setUp(self):
+        cache.clear()
+        invalidate_shipping_rates()
+
+    def test_quotes_from_memory_by_zone_and_weight_band(self):
+        quote_shipping('x', '', 0) # Carga la tabla
+        with self.assertNumQueries(0):
+            self.assertEqual(quote_shipping('region metropolitana', 'Ñuñoa', 1000), 2990)
+            self.assertEqual(quote_shipping('Region Metropolitana', 'Ñuñoa', 1001), 3990)
+            self.assertEqual(quote_shipping('REGIÓN METROPOLITANA', ' santiago ', 300), 1990)
+            self.assertEqual(quote_shipping('Valparaíso', 'Viña del Mar', 300), 6990)
+            self.assertIsNone(quote_shipping('Valparaíso', '', 5001))
+
+    def test_rate_changes_invalidate_the_table(self):
+        self.assertEqual(quote_shipping('Valparaíso', '', 300), 6990)
+        with self.captureOnCommitCallbacks(execute=True):
+            ShippingRate.objects.create(region='Valparaíso', commune='', max_weight=5000, price=4990)
+        self.assertEqual(quote_shipping('valparaiso', '', 300), 4990)
+
+    def test_table_expires_when_other_workers_cannot_be_notified(self):
+        # Un cambio hecho en otro worker sin caché compartida: sin bump de versión en esta caché
+        self.assertEqual(quote_shipping('Valparaíso', '', 300), 6990)
+        ShippingRate.objects.bulk_create([ShippingRate(region='Valparaíso', commune='', max_weight=5000, price=4990)])
+        self.assertEqual(quote_shipping('valparaiso', '', 300), 6990)
+        with override_settings(SHIPPING_RATES_CACHE_TTL=0):
+            self.assertEqual(quote_shipping('valparaiso', '', 300), 4990)
+
+    def test_cart_quote_adds_shipping_for_total_weight(self):
+        response = self.client.post(
+            '/api/cart-quote/', {'items': [{'slug': 'kit', 'quantity': 2}], 'region': 'Región Metropolitana', 'shipping_cost': 1},
+            content_type='application/json'
+        )
+        self.assertEqual(response.json()['shipping'], '3990') # 1600 g, ignora el shipping_cost del cliente
+        self.assertEqual(response.json()['total'], '23990')
+
+
+def async_flow_transport(handler):
+    """Transporte de httpx para los AsyncFlowClient que se creen: handler(request) -> httpx.Response."""
+    return mock.patch('payments.flow_client.httpx.AsyncClient', partial(httpx.AsyncClient, transport=httpx.MockTransport(handler)))
+
+
+@override_settings(**FLOW_TEST_SETTINGS)
+class AsyncFlowClientTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        circuit_breaker._breakers.clear()
+        self.calls = []
+
+    def async_flow_client(self, handler):
+        with async_flow_transport(handler):
+            return AsyncFlowClient()
+
+    async def test_concurrent_lookups_share_one_call(self):
+        async def flow(request):
+            self.calls.append(request)
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, json={'status': 2})
+
+        client = self.async_flow_client(flow)
+        results = await asyncio.gather(*(client.get_status('tok') for _ in range(5)))
+        await client.http.aclose()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [{'status': 2}] * 5)
+        self.assertEqual(await cache.aget(status_cache_key('tok')), {'status': 2})
+
+    async def test_leader_failure_reaches_the_waiters(self):
+        async def flow(request):
+            self.calls.append(request)
+            await asyncio.sleep(0.05)
+            return httpx.Response(500, json={'code': 500})
+
+        client = self.async_flow_client(flow)
+        results = await asyncio.gather(*(client.get_status('tok') for _ in range(3)), return_exceptions=True)
+        await client.http.aclose()
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(all(isinstance(result, httpx.HTTPStatusError) for result in results))
+        self.assertEqual(client._inflight, {})
+
+    async def test_cancelled_leader_does_not_cancel_the_waiters(self):
+        leader_waiting = asyncio.Event()
+
+        async def flow(request):
+            self.calls.append(request)
+            if len(self.calls) == 1:
+                leader_waiting.set()
+                await asyncio.sleep(30) # El cliente del líder se va antes de que Flow responda
+            return httpx.Response(200, json={'status': 2})
+
+        client = self.async_flow_client(flow)
+        leader = asyncio.create_task(client.get_status('tok'))
+        await leader_waiting.wait()
+        waiter = asyncio.create_task(client.get_status('tok'))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+
+        self.assertEqual(await asyncio.wait_for(waiter, 1), {'status': 2})
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        await client.http.aclose()
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(circuit_breaker.get_breaker('payment/getStatus').failures, 0) # Cancelar no cuenta como fallo de Flow
+
+
+@override_settings(**FLOW_TEST_SETTINGS, PUBLIC_URL_BASE='https://api.example.com')
+class AsyncPaymentViewTests(TestCase):
+    checkout = {
+        'commerceOrder': 'ASYNC-1', 'amount': 5000, 'subject': 'Compra', 'customer_email': 'c@example.com',
+        'return_url': 'http://localhost:3000',
+    }
+
+    def setUp(self):
+        cache.clear()
+        circuit_breaker._breakers.clear()
+
+    async def create_payment(self, flow_response):
+        request = AsyncRequestFactory().post('/api/create-payment/', self.checkout, content_type='application/json')
+        with async_flow_transport(lambda flow_request: flow_response):
+            return await AsyncCreatePaymentView.as_view()(request)
+
+    async def test_create_payment_returns_flow_url(self):
+        response = await self.create_payment(httpx.Response(200, json={'url': 'https://flow.test/pay', 'token': 'tok-async'}))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.content)['redirect_url'], 'https://flow.test/pay?token=tok-async')
+        self.assertEqual((await Order.objects.aget(commerce_order='ASYNC-1')).flow_token, 'tok-async')
+
+    async def test_flow_http_error_rejects_the_order(self):
+        response = await self.create_payment(httpx.Response(400, json={'code': 1605, 'message': 'Missing parameters'}))
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual((await Order.objects.aget(commerce_order='ASYNC-1')).status, 'REJECTED')
+
+    async def test_confirmation_marks_the_order_paid(self):
+        await Order.objects.acreate(commerce_order='ASYNC-2', amount=5000, flow_token='tok-2')
+        request = AsyncRequestFactory().post('/api/confirm-payment/', {'token': 'tok-2'})
+        paid = httpx.Response(200, json={'commerceOrder': 'ASYNC-2', 'status': 2})
+        with async_flow_transport(lambda flow_request: paid):
+            response = await AsyncFlowConfirmationView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((await Order.objects.aget(commerce_order='ASYNC-2')).status, 'PAID')
+
+    def test_served_by_wsgi_calls_flow_through_the_sync_client(self):
+        adapter = FakeFlowAdapter(lambda request: (200, {'url': 'https://flow.test/pay', 'token': 'tok-wsgi'}))
+        request = RequestFactory().post('/api/create-payment/', self.checkout, content_type='application/json')
+        with mock.patch('payments.flow_client._flow_client', None), mock.patch('payments.flow_client.HTTPAdapter', return_value=adapter), \
+                mock.patch('payments.flow_client.httpx.AsyncClient') as async_client_class:
+            response = async_to_sync(AsyncCreatePaymentView.as_view())(request)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(adapter.requests), 1)
+        async_client_class.assert_not_called()
+
+
+class AsyncFlowClientSelectionTests(SimpleTestCase):
+    def test_wsgi_request_uses_the_process_sync_client(self):
+        # Bajo WSGI cada petición async corre en un loop nuevo: no debe crear un httpx.AsyncClient por petición
+        request = RequestFactory().post('/api/create-payment/')
+        with mock.patch('payments.flow_client.AsyncFlowClient') as async_client_class:
+            first, second = get_async_flow_client(request), get_async_flow_client(request)
+        async_client_class.assert_not_called()
+        self.assertIsInstance(first, ThreadedFlowClient)
+        self.assertIs(first.client, get_flow_client())
+        self.assertIs(second.client, first.client)
+
+
+class OrderStatusWaitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def snapshot_order(self, status):
+        return Order(commerce_order='WAIT-1', status=status, amount=1000, updated_at=timezone.now())
+
+    @override_settings(ORDER_STATUS_WAIT_POLL_INTERVAL=60)
+    async def test_publish_wakes_the_waiter_without_polling(self):
+        publish_order_status(self.snapshot_order('PENDING'))
+        waiter = asyncio.create_task(wait_for_status_change('WAIT-1', 'PENDING', timeout=30))
+        await asyncio.sleep(0.05)
+        self.assertFalse(waiter.done())
+
+        # Como el on_commit del webhook: publica desde otro hilo
+        await sync_to_async(publish_order_status, thread_sensitive=False)(self.snapshot_order('PAID'))
+        snapshot, changed = await asyncio.wait_for(waiter, timeout=1)
+        self.assertTrue(changed)
+        self.assertEqual(snapshot['status'], 'PAID')
+
+    async def test_times_out_with_the_known_status(self):
+        publish_order_status(self.snapshot_order('PENDING'))
+        snapshot, changed = await wait_for_status_change('WAIT-1', 'PENDING', timeout=0.05)
+        self.assertFalse(changed)
+        self.assertEqual(snapshot['status'], 'PENDING')
+
+    @override_settings(ORDER_STATUS_CACHE_TTL=3600, ORDER_STATUS_PENDING_CACHE_TTL=5)
+    def test_error_status_uses_the_short_ttl(self):
+        # La confirmación de Flow aún puede llevar una orden en ERROR a PAID
+        with mock.patch('payments.order_status.cache') as status_cache:
+            publish_order_status(self.snapshot_order('ERROR'))
+            publish_order_status(self.snapshot_order('PAID'))
+        self.assertEqual([call.args[1] for call in status_cache.set_many.call_args_list], [5, 3600])
+
+
+class OrderStatusWaitViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.order = Order.objects.create(commerce_order='WAIT-2', amount=1000)
+
+    @override_settings(ORDER_STATUS_WAIT_TIMEOUT=0, ORDER_STATUS_CLIENT_RETRY_MS=3000)
+    def test_without_long_poll_the_page_is_told_to_retry(self):
+        response = self.client.get('/api/order-status/WAIT-2/wait/', {'status': 'PENDING'})
+        self.assertEqual(response.json(), {'status': 'PENDING', 'final': False, 'changed': False, 'retry_ms': 3000})
+        self.assertEqual(self.client.get('/api/order-status/NO-EXISTE/wait/').status_code, 404)
+
+    @override_settings(ORDER_STATUS_WAIT_TIMEOUT=5, ORDER_STATUS_WAIT_POLL_INTERVAL=60)
+    def test_answers_as_soon_as_the_order_changes(self):
+        paid = Order(pk=self.order.pk, commerce_order='WAIT-2', amount=1000, status='PAID', updated_at=timezone.now())
+        threading.Timer(0.1, publish_order_status, args=(paid,)).start() # El webhook en otro hilo
+        started = time.monotonic()
+        with self.assertNumQueries(1): # La carga inicial; mientras espera solo lee la caché
+            response = self.client.get('/api/order-status/WAIT-2/wait/', {'status': 'PENDING'})
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(response.json(), {'status': 'PAID', 'final': True, 'changed': True, 'retry_ms': 0})
+
+
+@override_settings(**FLOW_TEST_SETTINGS, ORDER_EMAILS_ENABLED=True, STORE_OWNER_EMAIL='owner@example.com', N8N_SALE_WEBHOOK_URL='')
+class ReconciliationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        circuit_breaker._breakers.clear()
+
+    def tearDown(self):
+        circuit_breaker._breakers.clear()
+
+    def stale_order(self, i, **fields):
+        order = Order.objects.create(commerce_order=f"REC-{i}", amount=1000, flow_token=f"tok-{i}", customer_email='c@example.com', **fields)
+        Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        return order
+
+    def reconcile(self, statuses, handler=None, **kwargs):
+        adapter = FakeFlowAdapter(handler or (lambda request: (200, {'status': statuses[flow_request_params(request)['token']]})))
+        with mock.patch('payments.flow_client.HTTPAdapter', return_value=adapter):
+            stats = reconcile_pending_orders(timezone.now() - timedelta(minutes=30), **kwargs)
+        return stats, adapter
+
+    def test_batch_counts_discount_uses_and_queues_emails_in_bulk(self):
+        code = DiscountCode.objects.create(code='REC10', discount_type='percentage', discount_value=10, usage_limit=3, reserved=1)
+        orders = [self.stale_order(i, applied_discount_code='rec10') for i in range(4)]
+        DiscountReservation.objects.create(discount_code=code, order=orders[0], expires_at=timezone.now() + timedelta(minutes=5))
+        rejected = self.stale_order(9, applied_discount_code='REC10')
+        statuses = {**{order.flow_token: 2 for order in orders}, rejected.flow_token: 3}
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            stats, _ = self.reconcile(statuses)
+
+        self.assertEqual((stats.paid, stats.rejected, stats.errors), (4, 1, 0))
+        code.refresh_from_db()
+        # La reservada se convierte en uso; de las otras tres solo caben dos
+        self.assertEqual((code.times_used, code.reserved), (3, 0))
+        self.assertFalse(DiscountReservation.objects.exists())
+        sql = [query['sql'] for query in queries.captured_queries]
+        self.assertEqual(len([q for q in sql if q.startswith('UPDATE "payments_discountcode"')]), 2) # Reservadas y sin reserva
+        self.assertEqual(len([q for q in sql if q.startswith('INSERT INTO "payments_outboxevent"')]), 2) # Uno por estado final
+        self.assertEqual(OutboxEvent.objects.filter(event_type=OutboxEvent.TYPE_EMAIL).count(), 4 * 2 + 1)
+
+    @override_settings(FLOW_BREAKER_HALF_OPEN_PROBES=1)
+    def test_half_open_rejections_are_retried_instead_of_aborting(self):
+        for i in range(6):
+            self.stale_order(i)
+        breaker = circuit_breaker.get_breaker('payment/getStatus')
+        breaker.state, breaker.opened_at = circuit_breaker.STATE_OPEN, time.monotonic() - 3600 # Listo para semi-abrirse
+
+        def slow_flow(request):
+            time.sleep(0.05) # La prueba sigue en curso mientras los otros hilos consultan
+            return 200, {'status': 2}
+
+        with mock.patch('payments.reconciliation.time') as reconciliation_time:
+            stats, _ = self.reconcile({}, handler=slow_flow, concurrency=6)
+
+        reconciliation_time.sleep.assert_called_once_with(1)
+        self.assertEqual((stats.paid, stats.errors), (6, 0))
+        self.assertEqual(breaker.state, circuit_breaker.STATE_CLOSED)
+        self.assertFalse(Order.objects.filter(status='PENDING').exists())
+
+    def test_stops_when_the_circuit_stays_open(self):
+        self.stale_order(1)
+        breaker = circuit_breaker.get_breaker('payment/getStatus')
+        breaker.state, breaker.opened_at = circuit_breaker.STATE_OPEN, time.monotonic()
+
+        with mock.patch('payments.reconciliation.time') as reconciliation_time, self.assertRaises(FlowCircuitOpenError):
+            _, adapter = self.reconcile({'tok-1': 2})
+        self.assertEqual(reconciliation_time.sleep.call_count, CIRCUIT_OPEN_RETRIES)
+        self.assertEqual(Order.objects.get(commerce_order='REC-1').status, 'PENDING')
+
+    def test_orders_moved_by_the_webhook_meanwhile_are_left_alone(self):
+        order = self.stale_order(1)
+        Order.objects.filter(pk=order.pk).update(status='PAID') # El webhook llegó después de consultar a Flow
+        stats = ReconciliationStats()
+        apply_transitions([(order, {'status': 3})], stats)
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'PAID')
+        self.assertEqual((stats.rejected, stats.scanned), (0, 1))
+
+    def test_dry_run_and_mismatched_orders_change_nothing(self):
+        for i in range(3):
+            self.stale_order(i)
+        stats, adapter = self.reconcile({}, handler=lambda request: (200, {'status': 2, 'commerceOrder': 'REC-1'}), dry_run=True, batch_size=2)
+        self.assertEqual(len(adapter.requests), 3)
+        self.assertEqual((stats.scanned, stats.paid, stats.errors), (3, 1, 2)) # Flow devolvió otra orden para REC-0 y REC-2
+        self.assertEqual(Order.objects.filter(status='PENDING').count(), 3)
+
+    def test_command_reports_an_open_circuit(self):
+        self.stale_order(1)
+        breaker = circuit_breaker.get_breaker('payment/getStatus')
+        breaker.state, breaker.opened_at = circuit_breaker.STATE_OPEN, time.monotonic()
+        with mock.patch('payments.reconciliation.time'), self.assertRaises(CommandError):
+            call_command('reconcile_pending_orders', stdout=StringIO())
+
+
+@override_settings(**FLOW_TEST_SETTINGS)
+class FlowClientTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        circuit_breaker._breakers.clear()
+
+    def flow_client(self, handler, **kwargs):
+        client = FlowClient(**kwargs)
+        adapter = FakeFlowAdapter(handler)
+        client.session.mount('https://', adapter)
+        return client, adapter
+
+    def test_create_payment_signs_params_on_the_pooled_session(self):
+        client, adapter = self.flow_client(lambda request: (200, {'token': 'tok', 'url': 'https://flow.test/pay'}))
+        for i in range(2):
+            self.assertEqual(client.create_payment({'commerceOrder': f"P-{i}", 'amount': '1000'})['token'], 'tok')
+
+        self.assertEqual(len(adapter.requests), 2) # Las dos por el mismo adaptador (pool keep-alive de la sesión)
+        params = flow_request_params(adapter.requests[0])
+        signature = params.pop('s')
+        self.assertEqual(params['apiKey'], 'key')
+        self.assertEqual(signature, sign_params(params, 'secret'))
+        self.assertEqual(adapter.requests[0].url, 'https://sandbox.flow.test/api/payment/create')
+        self.assertEqual(adapter.timeouts[0], (client.connect_timeout, client.read_timeout))
+
+    def test_errors_from_flow_and_missing_configuration(self):
+        client, _ = self.flow_client(lambda request: (400, {'code': 108, 'message': 'Invalid signature'}))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client.create_payment({'commerceOrder': 'P-1'})
+        with self.assertRaises(FlowConfigurationError):
+            FlowClient(api_key='').create_payment({'commerceOrder': 'P-1'})
+
+    def test_process_shares_one_client(self):
+        self.assertIs(get_flow_client(), get_flow_client())
+
+    # --- Caché de getStatus ---
+    def status_client(self, *statuses):
+        """Cliente cuyo getStatus responde los estados dados, uno por llamada (el último se repite)."""
+        responses = list(statuses)
+        return self.flow_client(lambda request: (200, {'status': responses.pop(0) if len(responses) > 1 else responses[0]}))
+
+    def test_final_status_is_served_from_cache(self):
+        client, adapter = self.status_client(2)
+        self.assertEqual(client.get_status('tok')['status'], 2)
+        self.assertEqual(client.get_status('tok', final_only=True)['status'], 2)
+        self.assertEqual(len(adapter.requests), 1)
+        self.assertEqual(cache.get(status_cache_key('tok'))['status'], 2)
+
+    def test_pending_status_is_not_trusted_by_the_webhook(self):
+        client, adapter = self.status_client(1, 2)
+        self.assertEqual(client.get_status('tok')['status'], 1)
+        self.assertEqual(client.get_status('tok')['status'], 1) # El pendiente se cachea unos segundos
+        self.assertEqual(client.get_status('tok', final_only=True)['status'], 2)
+        self.assertEqual(len(adapter.requests), 2)
+
+    def test_errors_and_disabled_ttl_are_not_cached(self):
+        client, adapter = self.flow_client(lambda request: (200, {'code': 105, 'message': 'Token not found'}))
+        client.get_status('tok')
+        client.get_status('tok')
+        with override_settings(FLOW_STATUS_CACHE_TTL=0):
+            paid_client, paid_adapter = self.status_client(2)
+            paid_client.get_status('tok-2')
+            paid_client.get_status('tok-2')
+        self.assertEqual((len(adapter.requests), len(paid_adapter.requests)), (2, 2))
+
+
+@override_settings(**FLOW_TEST_SETTINGS, FLOW_STATUS_LOCK_POLL_INTERVAL=0.01)
+class FlowStatusSingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        circuit_breaker._breakers.clear()
+        self.release = threading.Event()
+        self.client = FlowClient()
+        self.responses = [(200, {'status': 2})]
+        self.adapter = FakeFlowAdapter(self.slow_flow)
+        self.client.session.mount('https://', self.adapter)
+
+    def slow_flow(self, request):
+        self.release.wait(5) # Flow responde cuando el test lo suelta
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+    def concurrent_lookups(self, count):
+        results = [None] * count
+
+        def lookup(i):
+            try:
+                results[i] = self.client.get_status('tok')
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=lookup, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1) # Que todos lleguen a esperar la consulta en curso
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_concurrent_lookups_share_one_call(self):
+        results = self.concurrent_lookups(8)
+        self.assertEqual(len(self.adapter.requests), 1)
+        self.assertTrue(all(result == {'status': 2} for result in results))
+        self.assertEqual(self.client._inflight, {})
+
+    def test_leader_failure_reaches_the_waiters_and_is_not_kept(self):
+        self.responses = [(500, {'code': 500, 'message': 'Internal error'}), (200, {'status': 2})]
+        results = self.concurrent_lookups(4)
+        self.assertEqual(len(self.adapter.requests), 1)
+        self.assertTrue(all(isinstance(result, requests.exceptions.HTTPError) for result in results))
+        self.assertIsNone(cache.get(status_lock_key('tok')))
+
+        self.assertEqual(self.client.get_status('tok'), {'status': 2}) # La siguiente consulta vuelve a Flow
+        self.assertEqual(len(self.adapter.requests), 2)
+
+    def test_waits_for_the_worker_holding_the_lock(self):
+        cache.add(status_lock_key('tok'), True, 30) # Otro worker está consultando
+        threading.Timer(0.05, cache.set, args=(status_cache_key('tok'), {'status': 3}, 60)).start()
+        self.release.set()
+        self.assertEqual(self.client.get_status('tok'), {'status': 3})
+        self.assertEqual(self.adapter.requests, [])
+
+
+@override_settings(N8N_SALE_WEBHOOK_URL='https://n8n.test/webhook/sale', OUTBOX_LEASE_SECONDS=120, OUTBOX_MAX_ATTEMPTS=3,
+                   OUTBOX_RETRY_BASE_SECONDS=30, OUTBOX_RETRY_MAX_SECONDS=3600)
+class OutboxDispatchTests(TestCase):
+    def sale_events(self, count):
+        return OutboxEvent.objects.bulk_create(
+            [OutboxEvent(event_type=OutboxEvent.TYPE_N8N_SALE, payload={'orden': i}) for i in range(count)]
+        )
+
+    def dispatch(self, handler):
+        adapter = FakeFlowAdapter(handler)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        with mock.patch('payments.outbox._session', session):
+            return dispatch_batch(), adapter
+
+    def test_claimed_events_are_leased_until_delivered(self):
+        self.sale_events(3)
+        first = claim_due_events(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual([event.pk for event in claim_due_events(5)], [OutboxEvent.objects.order_by('pk').last().pk])
+        self.assertEqual(claim_due_events(5), []) # Todos reservados por otro dispatcher
+        leased_until = OutboxEvent.objects.get(pk=first[0].pk).next_attempt_at
+        self.assertAlmostEqual((leased_until - timezone.now()).total_seconds(), 120, delta=5)
+
+    def test_dispatch_posts_each_event_once_with_its_id(self):
+        events = self.sale_events(3)
+        (processed, sent), adapter = self.dispatch(lambda request: (200, {}))
+        self.assertEqual((processed, sent), (3, 3))
+        self.assertEqual(sorted(int(request.headers['X-Outbox-Event-Id']) for request in adapter.requests), [event.pk for event in events])
+        self.assertEqual(OutboxEvent.objects.filter(status=OutboxEvent.STATUS_SENT, attempts=1).count(), 3)
+        self.assertEqual(dispatch_batch(), (0, 0))
+
+    def test_failures_back_off_and_end_failed(self):
+        event = self.sale_events(1)[0]
+        for attempt in range(1, 4):
+            OutboxEvent.objects.filter(pk=event.pk).update(next_attempt_at=timezone.now()) # Ya le toca
+            (processed, sent), _ = self.dispatch(lambda request: (503, {}))
+            self.assertEqual((processed, sent), (1, 0))
+            event.refresh_from_db()
+            self.assertEqual(event.attempts, attempt)
+            self.assertIn('503', event.last_error)
+            if attempt < 3:
+                self.assertEqual(event.status, OutboxEvent.STATUS_PENDING)
+                self.assertAlmostEqual((event.next_attempt_at - timezone.now()).total_seconds(), 30 * 2 ** (attempt - 1), delta=5)
+        self.assertEqual(event.status, OutboxEvent.STATUS_FAILED)
+
+    def test_retry_delay_is_capped(self):
+        self.assertEqual(retry_delay(1), timedelta(seconds=30))
+        self.assertEqual(retry_delay(4), timedelta(seconds=240))
+        self.assertEqual(retry_delay(20), timedelta(seconds=3600))
+
+
+BOUNCING_EMAIL = 'rebota@example.com'
+
+
+class BatchRecordingEmailBackend(BaseEmailBackend):
+    """Backend de email de prueba: cuenta las conexiones, registra cada send_messages y rechaza los lotes con BOUNCING_EMAIL."""
+    opened = 0
+    batches = []
+
+    def open(self):
+        BatchRecordingEmailBackend.opened += 1
+        return True
+
+    def send_messages(self, messages):
+        if any(BOUNCING_EMAIL in message.to for message in messages):
+            raise smtplib.SMTPRecipientsRefused({BOUNCING_EMAIL: (550, b'No such user')})
+        BatchRecordingEmailBackend.batches.append([message.to[0] for message in messages])
+        return len(messages)
+
+
+@override_settings(EMAIL_BACKEND='payments.tests.BatchRecordingEmailBackend', OUTBOX_MAX_ATTEMPTS=3)
+class OutboxEmailTests(TestCase):
+    def setUp(self):
+        close_email_connection()
+        BatchRecordingEmailBackend.opened, BatchRecordingEmailBackend.batches = 0, []
+
+    def tearDown(self):
+        close_email_connection()
+
+    def email_events(self, recipients):
+        return OutboxEvent.objects.bulk_create([
+            OutboxEvent(event_type=OutboxEvent.TYPE_EMAIL, payload={'subject': 'Pedido', 'body': '...', 'to': [recipient]})
+            for recipient in recipients
+        ])
+
+    @override_settings(EMAIL_SEND_BATCH_SIZE=2)
+    def test_sends_in_batches_over_one_connection(self):
+        recipients = [f"c{i}@example.com" for i in range(5)]
+        self.email_events(recipients)
+        self.assertEqual(dispatch_batch(), (5, 5))
+        self.assertEqual(BatchRecordingEmailBackend.batches, [recipients[0:2], recipients[2:4], recipients[4:]])
+        self.assertEqual(BatchRecordingEmailBackend.opened, 1)
+
+        self.email_events(['c5@example.com'])
+        dispatch_batch()
+        self.assertEqual(BatchRecordingEmailBackend.opened, 1) # La conexión sigue abierta entre lotes
+
+    def test_failed_batch_is_retried_one_by_one(self):
+        ok_first, bouncing, ok_last = self.email_events(['a@example.com', BOUNCING_EMAIL, 'b@example.com'])
+        self.assertEqual(dispatch_batch(), (3, 2))
+        self.assertEqual(BatchRecordingEmailBackend.batches, [['a@example.com'], ['b@example.com']])
+        statuses = dict(OutboxEvent.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {ok_first.pk: OutboxEvent.STATUS_SENT, bouncing.pk: OutboxEvent.STATUS_PENDING, ok_last.pk: OutboxEvent.STATUS_SENT})
+        bouncing.refresh_from_db()
+        self.assertEqual(bouncing.attempts, 1)
+        self.assertIn(BOUNCING_EMAIL, bouncing.last_error)
+
+
+@override_settings(FLOW_BREAKER_WINDOW_SECONDS=60, FLOW_BREAKER_MIN_CALLS=4, FLOW_BREAKER_ERROR_RATE=0.5, FLOW_BREAKER_SLOW_CALL_SECONDS=5,
+                   FLOW_BREAKER_SLOW_CALL_RATE=0.8, FLOW_BREAKER_OPEN_SECONDS=30, FLOW_BREAKER_HALF_OPEN_PROBES=2,
+                   FLOW_ADAPTIVE_TIMEOUT_MULTIPLIER=3, FLOW_ADAPTIVE_TIMEOUT_MIN=2)
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('payments.circuit_breaker.time')
+        patcher.start().monotonic.side_effect = lambda: self.now
+        self.addCleanup(patcher.stop)
+        self.breaker = circuit_breaker.CircuitBreaker('payment/getStatus')
+
+    def call(self, failed=False, latency=0.1):
+        probe = self.breaker.before_call()
+        self.breaker.record(failed, latency, probe=probe)
+
+    def trip(self):
+        for _ in range(4):
+            self.call(failed=True)
+        self.assertEqual(self.breaker.state, circuit_breaker.STATE_OPEN)
+
+    def test_opens_on_error_rate_and_rejects_until_it_can_retry(self):
+        for failed in (True, True, False):
+            self.call(failed)
+        self.assertEqual(self.breaker.state, circuit_breaker.STATE_CLOSED) # Menos de FLOW_BREAKER_MIN_CALLS
+        self.call(failed=True)
+        self.assertEqual(self.breaker.state, circuit_breaker.STATE_OPEN)
+
+        self.now += 10
+        with self.assertRaises(FlowCircuitOpenError) as ctx:
+            self.breaker.before_call()
+        self.assertEqual(ctx.exception.retry_after, 20)
+        self.assertEqual((self.breaker.trips, self.breaker.rejected), (1, 1))
+
+    def test_old_failures_leave_the_window(self):
+        for _ in range(3):
+            self.call(failed=True)
+        self.now += 61
+        self.call(failed=True)
+        self.assertEqual(self.breaker.state, circuit_breaker.STATE_CLOSED)
+
+    def test_slow_calls_open_the_circuit(self):
+        for _ in range(4):
+            self.call(latency=6)
+        self.assertEqual(self.breaker.state, circuit_breaker.STATE_OPEN)
+
+    def test_half_open_lets_out_limited_probes_and_closes_on_success(self):
+        self.trip()
+        self.now += 30
+        probes = [self.breaker.before_call(), self.breaker.before_call()]
+        self.assertEqual(probes, [True, True])
+        self.assertEqual(self.breaker.state, circuit_breaker.STATE_HALF_OPEN)
+        with self.assertRaises(FlowCircuitOpenError) as ctx:
+            self.breaker.before_call() # Ya salieron FLOW_BREAKER_HALF_OPEN_PROBES pruebas
+        self.assertEqual(ctx.exception.retry_after, 1)
+
+        self.breaker.record(False, 0.1, probe=True)
+        self.assertEqual(self.breaker.state, circuit_breaker.STATE_CLOSED)
+        self.assertEqual(self.breaker.snapshot()['window_calls'], 0) # La ventana parte de cero
+
+    def test_failed_probe_reopens(self):
+        self.trip()
+        self.now += 30
+        self.call(failed=True)
+        self.assertEqual(self.breaker.state, circuit_breaker.STATE_OPEN)
+        self.assertEqual(self.breaker.opened_at, self.now)
+        self.assertEqual(self.breaker.trips, 2)
+
+    def test_cancelled_probe_is_released(self):
+        self.trip()
+        self.now += 30
+        self.breaker.release(self.breaker.before_call())
+        self.breaker.release(self.breaker.before_call())
+        self.assertTrue(self.breaker.before_call()) # Las pruebas liberadas no ocupan cupo
+        self.assertEqual(self.breaker.failures, 4)
+
+    def test_read_timeout_follows_p95_latency(self):
+        self.assertEqual(self.breaker.read_timeout(15), 15) # Sin suficientes muestras
+        for _ in range(4):
+            self.call(latency=0.5)
+        self.assertEqual(self.breaker.read_timeout(15), 2) # 1.5 s, subido al mínimo
+        for _ in range(4):
+            self.call(latency=1.5)
+        self.assertEqual(self.breaker.read_timeout(15), 4.5)
+        self.assertEqual(self.breaker.read_timeout(3), 3) # Nunca más que FLOW_READ_TIMEOUT
+
+
+@override_settings(**FLOW_TEST_SETTINGS)
+class CircuitOpenViewTests(TestCase):
+    def setUp(self):
+        circuit_breaker._breakers.clear()
+        breaker = circuit_breaker.get_breaker('payment/create')
+        breaker.state, breaker.opened_at = circuit_breaker.STATE_OPEN, time.monotonic()
+
+    def tearDown(self):
+        circuit_breaker._breakers.clear()
+
+    def test_create_payment_answers_503_without_creating_the_order(self):
+        adapter = FakeFlowAdapter(lambda request: (200, {}))
+        with mock.patch('payments.flow_client._flow_client', None), mock.patch('payments.flow_client.HTTPAdapter', return_value=adapter):
+            response = self.client.post('/api/create-payment/', {
+                'commerceOrder': 'OPEN-1', 'amount': 5000, 'subject': 'Compra', 'customer_email': 'c@example.com', 'return_url': 'http://localhost:3000',
+            }, content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(response.json()['retry_after']))
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(adapter.requests, [])
+
+    def test_create_payment_probes_flow_once_the_open_window_expires(self):
+        checkout = {'amount': 5000, 'subject': 'Compra', 'customer_email': 'c@example.com', 'return_url': 'http://localhost:3000'}
+        adapter = FakeFlowAdapter(lambda request: (200, {'url': 'https://flow.test/pay', 'token': 'tok-probe'}))
+        breaker = circuit_breaker.get_breaker('payment/create')
+        with mock.patch('payments.flow_client._flow_client', None), mock.patch('payments.flow_client.HTTPAdapter', return_value=adapter):
+            rejected = self.client.post('/api/create-payment/', dict(checkout, commerceOrder='OPEN-1'), content_type='application/json')
+            with mock.patch('payments.circuit_breaker.time') as clock:
+                clock.monotonic.return_value = breaker.opened_at + settings.FLOW_BREAKER_OPEN_SECONDS
+                response = self.client.post('/api/create-payment/', dict(checkout, commerceOrder='OPEN-2'), content_type='application/json')
+        self.assertEqual(rejected.status_code, 503)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(adapter.requests), 1)
+        self.assertEqual(breaker.state, circuit_breaker.STATE_CLOSED)
+
+
+class FlowEmulatorTests(SimpleTestCase):
+    payment = {
+        'commerceOrder': 'EMU-1', 'subject': 'Compra', 'amount': '5000', 'email': 'c@example.com',
+        'urlConfirmation': 'https://api.example.com/api/confirm-payment/', 'urlReturn': 'https://api.example.com/payment/flow-callback/',
+    }
+
+    def setUp(self):
+        circuit_breaker._breakers.clear()
+
+    def signed(self, params, secret='secret'):
+        params = dict(params, apiKey='key')
+        return dict(params, s=sign_params(params, secret))
+
+    def test_checks_signature_and_resolves_payments(self):
+        emulator = FlowEmulator('key', 'secret', 'http://emulador', send_confirmation=False)
+        self.assertEqual(emulator.create_payment(self.signed(self.payment, secret='otra'))[0], 401)
+        self.assertEqual(emulator.create_payment(self.signed({'commerceOrder': 'EMU-1'}))[0], 400)
+
+        http_status, created = emulator.create_payment(self.signed(self.payment))
+        self.assertEqual(http_status, 200)
+        self.assertEqual(created['url'], f"http://emulador{PAY_PAGE_PATH}")
+        status_params = self.signed({'token': created['token']})
+        self.assertEqual(emulator.get_status(status_params)[1]['status'], 1)
+        emulator.resolve(created['token'])
+        self.assertEqual(emulator.get_status(status_params)[1]['status'], 2)
+        self.assertEqual(emulator.get_status(self.signed({'token': 'no-existe'}))[0], 400)
+
+        rejecting = FlowEmulator('key', 'secret', 'http://emulador', reject_rate=1, send_confirmation=False)
+        token = rejecting.create_payment(self.signed(self.payment))[1]['token']
+        self.assertEqual(rejecting.resolve(token).status, 3)
+
+    def test_flow_client_round_trip_over_http(self):
+        server = make_server('127.0.0.1', 0, api_key='key', secret_key='secret', send_confirmation=False)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        client = FlowClient(api_key='key', secret_key='secret', base_url=f"{base_url}/api")
+
+        token = client.create_payment(self.payment)['token']
+        self.assertEqual(client.get_status(token, use_cache=False)['status'], 1)
+        pay_page = requests.get(f"{base_url}{PAY_PAGE_PATH}", params={'token': token}, allow_redirects=False, timeout=5)
+        self.assertEqual(pay_page.status_code, 302)
+        self.assertEqual(pay_page.headers['Location'], f"{self.payment['urlReturn']}?token={token}")
+        self.assertEqual(client.get_status(token, use_cache=False)['status'], 2)
+
+
+class OrderStatusConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.order = Order.objects.create(commerce_order='ETAG-1', amount=1000, flow_token='tok-etag')
+
+    def get(self, url, headers=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, headers=headers)
+        return response, len(queries)
+
+    def test_conditional_gets_answer_304_without_queries(self):
+        response, queries = self.get('/api/order-status/ETAG-1/')
+        self.assertEqual((response.status_code, queries), (200, 1)) # Primera lectura: llena la caché
+        self.assertEqual(response.json(), {'status': 'PENDING'})
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        etag = response['ETag']
+
+        for url in ('/api/order-status/ETAG-1/', '/api/order-status-by-token/tok-etag/'):
+            response, queries = self.get(url, {'If-None-Match': etag})
+            self.assertEqual((response.status_code, queries), (304, 0), url)
+            self.assertEqual(response.content, b'')
+        response, queries = self.get('/api/order-status/ETAG-1/', {'If-Modified-Since': response['Last-Modified']})
+        self.assertEqual((response.status_code, queries), (304, 0))
+
+    def test_status_change_invalidates_the_etag(self):
+        etag = self.get('/api/order-status/ETAG-1/')[0]['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            update_pending_order_status(self.order, 2)
+
+        response, queries = self.get('/api/order-status/ETAG-1/', {'If-None-Match': etag})
+        self.assertEqual((response.status_code, queries), (200, 0))
+        self.assertEqual(response.json(), {'status': 'PAID'})
+        self.assertNotEqual(response['ETag'], etag)
@@ -1,21 +1,39 @@
 # payments/urls.py
 
+from django.conf import settings
 from django.urls import path
 # Asegúrate de que TODAS las vistas que usas en este archivo estén importadas aquí
+from . import async_views, views
 from .views import (
-    CreatePaymentView, 
-    FlowConfirmationView,
     OrderStatusView,
     GetOrderStatusByTokenView,
+    BulkOrderStatusView,
     QueryOrderStatusView,
-    ValidateDiscountCodeView  
+    ValidateDiscountCodeView,
+    BatchValidateDiscountCodesView,
+    CartQuoteView,
+    ShippingQuoteView,
+    FlowMetricsView,
 )
 
+from .async_views import OrderStatusWaitView
+
+# Modo ASGI (PAYMENTS_ASYNC_VIEWS): vistas async que no bloquean el worker mientras esperan a Flow/n8n
+CreatePaymentView = async_views.AsyncCreatePaymentView if settings.PAYMENTS_ASYNC_VIEWS else views.CreatePaymentView
+FlowConfirmationView = async_views.AsyncFlowConfirmationView if settings.PAYMENTS_ASYNC_VIEWS else views.FlowConfirmationView
+
 urlpatterns = [
     path('create-payment/', CreatePaymentView.as_view(), name='create-payment'),
     path('confirm-payment/', FlowConfirmationView.as_view(), name='flow-confirmation'),
+    path('order-status/<str:commerce_order>/', OrderStatusView.as_view(), name='order-status'),
+    path('order-status/<str:commerce_order>/wait/', OrderStatusWaitView.as_view(), name='order-status-wait'),
     path('order-status-by-token/<str:flow_token>/', GetOrderStatusByTokenView.as_view(), name='order-status-by-token'),
+    path('order-status-bulk/', BulkOrderStatusView.as_view(), name='order-status-bulk'),
     path('query-order-status/', QueryOrderStatusView.as_view(), name='query-order-status'),
     path('validate-discount/', ValidateDiscountCodeView.as_view(), name='validate-discount'),
+    path('cart-quote/', CartQuoteView.as_view(), name='cart-quote'),
+    path('shipping-quote/', ShippingQuoteView.as_view(), name='shipping-quote'),
+    path('validate-discounts/', BatchValidateDiscountCodesView.as_view(), name='validate-discounts'),
+    path('flow-metrics/', FlowMetricsView.as_view(), name='flow-metrics'),
 
 ]
\ No newline at end of file
@@ -1,72 +1,64 @@
-import os
 import requests
-import hmac
-import hashlib
-from collections import OrderedDict
 import logging
-from django.db import transaction
 from django.shortcuts import render
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
 from django.views import View
 from .models import Order
 from django.conf import settings
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
-import urllib.parse
 from .emails import send_new_sale_to_owner, send_payment_confirmation_to_customer
-from .models import DiscountCode # Importa el nuevo modelo
+from .models import DiscountCode, normalize_discount_code # Importa el nuevo modelo
 from decimal import Decimal # Para manejar montos
+# sign_params se re-exporta aquí por compatibilidad con código que lo importaba desde views
+from .flow_client import get_flow_client, sign_params, FlowError, FlowConfigurationError, FlowCircuitOpenError
+from .circuit_breaker import breaker_metrics
+from .discounts import get_discount_code
+from .pricing import PricingError, price_cart
+from .shipping import quote_shipping
+from .order_status import (
+    FINAL_ORDER_STATUSES,
+    get_order_status,
+    get_order_status_by_token,
+    get_order_statuses,
+    get_order_statuses_by_token,
+)
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from .services import (
+    CheckoutError,
+    create_pending_order,
+    build_flow_payment_params,
+    set_order_status,
+    complete_flow_payment,
+    apply_flow_confirmation,
+    update_pending_order_status,
+    apply_callback_status_to_redirect,
+    build_fungigrow_redirect_url,
+    find_orders,
+    quote_cart,
+    order_page,
+)
 
 # Configura el logger para este módulo
 logger = logging.getLogger(__name__)
 
 
-# --- Función Auxiliar para firmar los parámetros ---
-def sign_params(params, secret_key):
-    """
-    Firma los parámetros para la API de Flow usando HMAC-SHA256.
-    """
-    sorted_params = OrderedDict(sorted(params.items()))
-    param_string = "".join([f"{k}{v}" for k, v in sorted_params.items()])
-    signature = hmac.new(
-        secret_key.encode('utf-8'),
-        param_string.encode('utf-8'),
-        hashlib.sha256
-    ).hexdigest()
-    return signature
-
-
 # --- Vistas del API ---
-# payments/views.py
 
-# Asegúrate de tener estas importaciones al principio de tu archivo:
-import os
-import requests
-import hmac
-import hashlib
-from collections import OrderedDict
-from django.conf import settings # Para settings.PUBLIC_URL_BASE
-from rest_framework.views import APIView
-from rest_framework.response import Response
-from rest_framework import status
-from .models import Order # Para interactuar con tu modelo de órdenes
-
-# Si tienes la función sign_params en este mismo archivo, debería estar aquí o antes.
-# Ejemplo:
-# def sign_params(params, secret_key):
-#     sorted_params = OrderedDict(sorted(params.items()))
-#     param_string = "".join([f"{k}{v}" for k, v in sorted_params.items()])
-#     # print(f"--- DEBUG SIGNATURE: String para firmar: '{param_string}' ---") # Mantén este debug si aún lo necesitas
-#     signature = hmac.new(
-#         secret_key.encode('utf-8'),
-#         param_string.encode('utf-8'),
-#         hashlib.sha256
-#     ).hexdigest()
-#     return signature
+
+def flow_unavailable_response(circuit_err):
+    """503 + Retry-After mientras el circuit breaker de Flow está abierto."""
+    return Response(
+        {"error": "Flow no está disponible en este momento. Intenta nuevamente en unos segundos.", "retry_after": circuit_err.retry_after},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={'Retry-After': str(circuit_err.retry_after)},
+    )
 
 
 class CreatePaymentView(APIView):
@@ -76,166 +68,55 @@ class CreatePaymentView(APIView):
     y devuelve la URL de Flow para el pago.
     """
     def post(self, request, *args, **kwargs):
-        # --- 1. Obtener datos del payload JSON ---
-        amount_from_frontend_str = request.data.get('amount') # Este es el MONTO FINAL con descuento y envío
-        commerce_order = request.data.get('commerceOrder')
-        subject = request.data.get('subject')
-        currency = request.data.get('currency', 'CLP')
-        fungigrow_return_url_from_frontend = request.data.get('return_url')
-        shipping_details = request.data.get('shippingDetails', {})
-        customer_email_from_frontend = request.data.get('customer_email')
-        
-        # Datos del descuento (opcionales desde el frontend)
-        discount_code_str_applied = request.data.get('discount_code_applied', None)
-        # El frontend ya calculó el descuento y lo aplicó al 'amount'.
-        # Si el frontend enviara el 'cart_subtotal_products_only', podríamos hacer una revalidación más completa del monto.
-
-        # --- 2. Validación de parámetros básicos requeridos ---
-        required_from_frontend = {
-            "amount": amount_from_frontend_str, 
-            "commerceOrder": commerce_order, 
-            "subject": subject,
-            "return_url": fungigrow_return_url_from_frontend,
-            "customer_email": customer_email_from_frontend,
-            "currency": currency
-        }
-        missing_params = [key for key, value in required_from_frontend.items() if value is None or value == ""] # Chequea None y string vacío
-        if missing_params:
-            return Response(
-                {"error": f"Faltan parámetros requeridos del frontend: {', '.join(missing_params)}"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
+        flow_client = get_flow_client()
+        # Si Flow está caído no creamos una orden que no se podrá pagar
         try:
-            final_amount_to_charge = Decimal(amount_from_frontend_str)
-            if final_amount_to_charge <= 0: # El monto final no puede ser cero o negativo
-                 return Response({"error": "El monto final del pedido no puede ser cero o negativo."}, status=status.HTTP_400_BAD_REQUEST)
-        except Exception:
-            return Response({"error": "El 'amount' debe ser un número válido."}, status=status.HTTP_400_BAD_REQUEST)
+            flow_client.check_available('payment/create')
+        except FlowCircuitOpenError as circuit_err:
+            return flow_unavailable_response(circuit_err)
 
-        # --- 3. Revalidación del Código de Descuento (si se aplicó) ---
-        applied_discount_code_object = None
-        actual_discount_code_to_save = None # Código que se guardará en la orden
-
-        if discount_code_str_applied:
-            try:
-                discount_code_object = DiscountCode.objects.get(code__iexact=discount_code_str_applied)
-                
-                # Para validar min_purchase_amount, necesitaríamos el subtotal de productos ANTES del descuento.
-                # Como el frontend ya hizo esta validación, aquí solo validamos existencia, actividad, fechas y límite de uso.
-                # Si el frontend enviara 'cart_subtotal_products_only', podríamos usar:
-                # cart_subtotal_for_validation = Decimal(request.data.get('cart_subtotal_products_only', 0))
-                # is_valid, message = discount_code_object.is_valid(cart_subtotal=cart_subtotal_for_validation)
-
-                is_valid, message = discount_code_object.is_valid() # Validación básica
-                
-                if is_valid:
-                    applied_discount_code_object = discount_code_object # Para usarlo en FlowConfirmationView
-                    actual_discount_code_to_save = discount_code_object.code # Guardamos el código real
-                    print(f"INFO: Código de descuento '{discount_code_object.code}' re-validado exitosamente para orden {commerce_order}.")
-                    # NOTA: Confiamos en que el 'amount' enviado por el frontend ya tiene el descuento correctamente aplicado.
-                    # Una revalidación completa del monto descontado aquí requeriría el subtotal de productos.
-                else:
-                    # Si el código ya no es válido al momento de crear el pago, se procede sin descuento.
-                    # El frontend debería haber manejado esto, pero es una salvaguarda.
-                    print(f"ADVERTENCIA: Código '{discount_code_str_applied}' ya no es válido al crear pago para orden {commerce_order}. Mensaje: {message}. Se procederá sin descuento.")
-                    # No se asigna applied_discount_code_object, por lo que no se incrementará su uso.
-                    # El 'final_amount_to_charge' ya viene del frontend, así que no lo modificamos aquí.
-                    # El frontend es responsable de enviar el monto correcto si el código falla en su lado.
-            except DiscountCode.DoesNotExist:
-                print(f"ADVERTENCIA: Código de descuento '{discount_code_str_applied}' no encontrado al crear pago para orden {commerce_order}. Se procederá sin descuento.")
-                # No se aplica descuento. El 'final_amount_to_charge' es el que envió el frontend.
-        
-        # --- 4. Crear la Orden en la Base de Datos ---
+        # --- 1 a 4. Validar payload, re-validar descuento y crear la orden PENDING ---
         try:
-            new_order = Order.objects.create(
-                commerce_order=commerce_order,
-                amount=final_amount_to_charge, # Usamos el monto final que ya incluye el descuento (si lo hubo) y envío
-                status='PENDING',
-                fungigrow_return_url=fungigrow_return_url_from_frontend,
-                shipping_name=shipping_details.get('nombreCompleto'),
-                shipping_rut=shipping_details.get('rut'),
-                shipping_address=shipping_details.get('direccion'),
-                shipping_commune=shipping_details.get('comuna'),
-                shipping_region=shipping_details.get('region'),
-                shipping_phone=shipping_details.get('telefono'),
-                customer_email=customer_email_from_frontend,
-                applied_discount_code=actual_discount_code_to_save # Guardamos el código si fue válido
-            )
-        except Exception as e:
-            print(f"ERROR al crear orden {commerce_order} en BD: {e}")
-            return Response(
-                {"error": f"La orden {commerce_order} ya existe o hubo un error al crearla en la BD."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+            new_order = create_pending_order(request.data)
+        except CheckoutError as checkout_err:
+            return Response(checkout_err.payload, status=checkout_err.http_status)
 
         # --- 5. Preparar y Enviar Petición a Flow ---
-        api_key = os.getenv('FLOW_API_KEY')
-        secret_key = os.getenv('FLOW_SECRET_KEY')
-        flow_api_base_url = os.getenv('FLOW_API_URL_PROD')
-        if not flow_api_base_url:
-            print("ERROR CRÍTICO: FLOW_API_URL_PROD no está configurada.")
-            return Response({"error": "Configuración del servidor incompleta."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        flow_payment_create_endpoint_url = f"{flow_api_base_url.rstrip('/')}/payment/create"
-
-        public_backend_url = settings.PUBLIC_URL_BASE
-
-        params_to_flow = {
-            'apiKey': api_key,
-            'commerceOrder': str(commerce_order),
-            'amount': str(int(final_amount_to_charge)), # Flow espera un entero para CLP
-            'subject': subject,
-            'email': customer_email_from_frontend,
-            'currency': currency,
-            'urlConfirmation': f"{public_backend_url.rstrip('/')}/api/confirm-payment/",
-            'urlReturn': f"{public_backend_url.rstrip('/')}/payment/flow-callback/"
-            # 'paymentMethod': 9, # Opcional, Flow usa 9 (todos) por defecto
-        }
-        
-        params_to_flow['s'] = sign_params(params_to_flow, secret_key)
-        
-        print("---------------------------------------------------------")
-        print(f"--- DEBUG: {('PRODUCCIÓN' if 'sandbox' not in flow_api_base_url else 'SANDBOX')} PETICIÓN A FLOW ---")
-        print(f"--- DEBUG: URL Flow: {flow_payment_create_endpoint_url}")
-        params_para_imprimir = params_to_flow.copy(); params_para_imprimir.pop('apiKey', None)
-        print(f"--- DEBUG: Params a Flow (sin apiKey): {params_para_imprimir}")
-        print("---------------------------------------------------------")
+        # apiKey y la firma 's' las agrega el cliente de Flow
+        params_to_flow = build_flow_payment_params(new_order, request.data)
+
+        logger.debug(
+            f"CreatePaymentView: Petición a Flow {'SANDBOX' if flow_client.is_sandbox else 'PRODUCCIÓN'} "
+            f"{flow_client.base_url}/payment/create con params (sin apiKey): {params_to_flow}"
+        )
 
         try:
-            response_from_flow = requests.post(flow_payment_create_endpoint_url, data=params_to_flow)
-            response_from_flow.raise_for_status()
-            flow_json_response = response_from_flow.json()
+            flow_json_response = flow_client.create_payment(params_to_flow)
 
+        except FlowConfigurationError as config_err:
+            set_order_status(new_order, 'ERROR')
+            logger.error(f"CreatePaymentView: {config_err}")
+            return Response({"error": "Configuración del servidor incompleta."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except FlowCircuitOpenError as circuit_err:
+            set_order_status(new_order, 'REJECTED')
+            logger.error(f"CreatePaymentView: {circuit_err}")
+            return flow_unavailable_response(circuit_err)
         except requests.exceptions.HTTPError as http_err:
-            new_order.status = 'REJECTED'; new_order.save()
+            set_order_status(new_order, 'REJECTED')
             error_content = "No se pudo obtener contenido del error de Flow."
             try: error_content = http_err.response.json()
             except ValueError: error_content = http_err.response.text[:500]
-            print(f"ERROR HTTP de Flow: {http_err.response.status_code} - {error_content}")
+            logger.error(f"CreatePaymentView: ERROR HTTP de Flow: {http_err.response.status_code} - {error_content}")
             return Response({"error": f"Error directo de Flow: {http_err.response.status_code}", "flow_response_details": error_content}, status=status.HTTP_502_BAD_GATEWAY)
         except requests.exceptions.RequestException as e:
-            new_order.status = 'REJECTED'; new_order.save()
-            print(f"ERROR de conexión con Flow: {e}")
+            set_order_status(new_order, 'REJECTED')
+            logger.error(f"CreatePaymentView: ERROR de conexión con Flow: {e}")
             return Response({"error": f"Error de conexión al contactar a Flow: {e}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-        
-        if 'code' in flow_json_response: # Error estructurado de Flow
-            new_order.status = 'REJECTED'; new_order.save()
-            return Response({"error": f"Error por parte de Flow: {flow_json_response.get('message')}", "flow_details": flow_json_response}, status=status.HTTP_400_BAD_REQUEST)
-        
-        flow_token = flow_json_response.get('token')
-        if flow_token:
-            new_order.flow_token = flow_token; new_order.save()
-        else:
-            new_order.status = 'REJECTED'; new_order.save()
-            print(f"ERROR GRABE: Respuesta de Flow sin token: {flow_json_response} para orden {commerce_order}")
-            return Response({"error": "Respuesta inesperada de Flow (sin token).", "flow_details": flow_json_response}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        payment_redirect_url = f"{flow_json_response.get('url')}?token={flow_token}"
-        
-        return Response({
-            "redirect_url": payment_redirect_url,
-            "token": flow_token
-        }, status=status.HTTP_201_CREATED)
+        try:
+            return Response(complete_flow_payment(new_order, flow_json_response), status=status.HTTP_201_CREATED)
+        except CheckoutError as checkout_err:
+            return Response(checkout_err.payload, status=checkout_err.http_status)
 
 
 
@@ -368,7 +249,7 @@ class FlowConfirmationView(APIView):
     """
     Webhook endpoint que Flow llama para confirmar el estado de un pago.
     Verifica el estado, actualiza la BD, y si el pago es exitoso,
-    llama a un webhook de n8n para manejar notificaciones y otros flujos.
+    encola la notificación al webhook de n8n (outbox) en la misma transacción.
     """
     def post(self, request, *args, **kwargs):
         # Flow envía los datos como form-data (request.POST) para el webhook de confirmación
@@ -380,30 +261,11 @@ class FlowConfirmationView(APIView):
 
         logger.info(f"FlowConfirmationView: Recibido token de confirmación de Flow: {flow_token}")
 
-        # Variables para la lógica, se inicializan por si algo falla antes de obtenerlas de Flow
-        commerce_order_id = None 
-        order_to_update = None
-
         try:
-            api_key = os.getenv('FLOW_API_KEY')
-            secret_key = os.getenv('FLOW_SECRET_KEY')
-            flow_api_base_url = os.getenv('FLOW_API_URL_PROD', 'https://sandbox.flow.cl/api') # Asegúrate que esta var apunte a sandbox o prod según necesites
-            flow_status_endpoint_url = f"{flow_api_base_url.rstrip('/')}/payment/getStatus"
-            
-            params_to_sign_for_get_status = {'apiKey': api_key, 'token': flow_token}
-            signature_for_get_status = sign_params(params_to_sign_for_get_status, secret_key)
-            
-            params_for_get_status_call = {
-                'apiKey': api_key,
-                'token': flow_token,
-                's': signature_for_get_status
-            }
-
             # Llamada a Flow para obtener el estado REAL y AUTORITATIVO del pago
-            logger.debug(f"FlowConfirmationView: Consultando estado a Flow para token {flow_token} con params: {params_for_get_status_call}")
-            response_flow_status = requests.get(flow_status_endpoint_url, params=params_for_get_status_call, timeout=15) # Añadido timeout
-            response_flow_status.raise_for_status() # Lanza HTTPError para respuestas 4xx/5xx de Flow
-            payment_data_from_flow = response_flow_status.json()
+            # (lanza HTTPError para respuestas 4xx/5xx de Flow). Flow avisa cuando el pago ya se resolvió,
+            # así que no aceptamos un estado pendiente cacheado por el callback del navegador.
+            payment_data_from_flow = get_flow_client().get_status(flow_token, final_only=True)
 
             commerce_order_id = payment_data_from_flow.get('commerceOrder')
             flow_status_code = payment_data_from_flow.get('status') # 1=Pendiente, 2=Pagada, 3=Rechazada, 4=Anulada
@@ -414,80 +276,10 @@ class FlowConfirmationView(APIView):
 
             logger.info(f"FlowConfirmationView: Estado de Flow para orden {commerce_order_id} (token {flow_token}): Código {flow_status_code}")
 
-            with transaction.atomic():
-                try:
-                    order_to_update = Order.objects.select_for_update().get(commerce_order=commerce_order_id)
-                except Order.DoesNotExist:
-                    logger.error(f"FlowConfirmationView: Orden {commerce_order_id} (token {flow_token}) confirmada por Flow NO FUE ENCONTRADA en la BD.")
-                    return Response(status=status.HTTP_200_OK) 
-
-                previous_status = order_to_update.status
+            order_to_update, should_trigger_n8n = apply_flow_confirmation(flow_token, payment_data_from_flow)
 
-                # Guardar/Actualizar el token de Flow en nuestra orden si no lo teníamos
-                if not order_to_update.flow_token or order_to_update.flow_token != flow_token:
-                    order_to_update.flow_token = flow_token
-                
-                should_trigger_n8n = False
-                
-                # Lógica de Idempotencia y actualización
-                if order_to_update.status == 'PAID' and flow_status_code == 2:
-                    logger.info(f"FlowConfirmationView: Orden {commerce_order_id} ya está PAGADA. No se realizan acciones adicionales.")
-                elif order_to_update.status == 'REJECTED' and (flow_status_code == 3 or flow_status_code == 4):
-                    logger.info(f"FlowConfirmationView: Orden {commerce_order_id} ya está RECHAZADA. No se realizan acciones adicionales.")
-                else: # El estado actual no es final o no coincide, procedemos a actualizar.
-                    if flow_status_code == 2: # Pagada
-                        order_to_update.status = 'PAID'
-                        logger.info(f"FlowConfirmationView: ✅ Orden {commerce_order_id} actualizada a PAGADA en BD.")
-                    elif flow_status_code == 3 or flow_status_code == 4: # Rechazada o Anulada
-                        order_to_update.status = 'REJECTED'
-                        logger.info(f"FlowConfirmationView: ❌ Orden {commerce_order_id} actualizada a RECHAZADA en BD.")
-                    elif flow_status_code == 1: # Pendiente
-                        # Si ya estaba PENDING, no hacemos nada. Podrías añadir lógica si es necesario.
-                        logger.info(f"FlowConfirmationView: ⏳ Orden {commerce_order_id} está/sigue PENDIENTE según Flow. Estado actual BD: {previous_status}.")
-                    else:
-                        logger.warning(f"FlowConfirmationView: Estado desconocido {flow_status_code} de Flow para orden {commerce_order_id}. Se marca como ERROR.")
-                        order_to_update.status = 'ERROR'
-
-                    order_to_update.save()
-
-                    # Disparamos n8n si el estado cambió a PAID y no lo estaba antes.
-                    if order_to_update.status == 'PAID' and previous_status != 'PAID':
-                        should_trigger_n8n = True
-                    # Opcional: disparar n8n para otros estados finales si es necesario
-                    # elif order_to_update.status == 'REJECTED' and previous_status == 'PENDING':
-                    #     should_trigger_n8n = True # O un webhook diferente para fallos/rechazos
-
-                if should_trigger_n8n:
-                    n8n_webhook_url = os.getenv('N8N_SALE_WEBHOOK_URL')
-                    if n8n_webhook_url:
-                        payload_to_n8n = {
-                            "commerceOrder": order_to_update.commerce_order,
-                            "amount": str(order_to_update.amount),
-                            "customer_email": order_to_update.customer_email,
-                            "flow_token": order_to_update.flow_token,
-                            "payment_status_flow_code": flow_status_code,
-                            "payment_status_internal": order_to_update.status,
-                            "shipping_details": {
-                                "nombreCompleto": order_to_update.shipping_name,
-                                "rut": order_to_update.shipping_rut,
-                                "direccion": order_to_update.shipping_address,
-                                "comuna": order_to_update.shipping_commune,
-                                "region": order_to_update.shipping_region,
-                                "telefono": order_to_update.shipping_phone,
-                            },
-                            "fungigrow_return_url": order_to_update.fungigrow_return_url,
-                            "order_created_at": order_to_update.created_at.isoformat() if order_to_update.created_at else None,
-                            "order_updated_at": order_to_update.updated_at.isoformat() if order_to_update.updated_at else None,
-                            "store_owner_email_recipient": os.getenv('STORE_OWNER_EMAIL') # Añadido en un paso anterior
-                        }
-                        try:
-                            logger.info(f"FlowConfirmationView: Enviando datos a n8n para orden {commerce_order_id} a URL: {n8n_webhook_url}")
-                            requests.post(n8n_webhook_url, json=payload_to_n8n, timeout=10) 
-                            logger.info(f"FlowConfirmationView: Datos enviados a n8n para orden {commerce_order_id}.")
-                        except requests.exceptions.RequestException as n8n_error:
-                            logger.error(f"FlowConfirmationView: Error al enviar datos a n8n para orden {commerce_order_id}: {n8n_error}")
-                    else:
-                        logger.warning(f"FlowConfirmationView: N8N_SALE_WEBHOOK_URL no configurada. No se notifica a n8n para orden {commerce_order_id}.")
+            if should_trigger_n8n: # La entrega a n8n la hace el dispatcher del outbox (payments/outbox.py)
+                logger.info(f"FlowConfirmationView: Venta de orden {commerce_order_id} encolada para n8n.")
         
         except requests.exceptions.HTTPError as http_err: # Errores 4xx/5xx de la llamada a Flow getStatus
             error_text = http_err.response.text[:200] if http_err.response else str(http_err)
@@ -501,7 +293,15 @@ class FlowConfirmationView(APIView):
         except requests.exceptions.RequestException as e: # Errores de red al llamar a Flow getStatus
             logger.error(f"FlowConfirmationView: RequestException al contactar Flow getStatus (token {flow_token}): {e}")
             return Response({"error": "Error de red comunicándose con Flow"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-        
+
+        except FlowCircuitOpenError as circuit_err: # Flow degradado: que Flow reintente el webhook más tarde
+            logger.warning(f"FlowConfirmationView: {circuit_err} (token {flow_token})")
+            return flow_unavailable_response(circuit_err)
+
+        except FlowError as e: # Cliente de Flow mal configurado
+            logger.critical(f"FlowConfirmationView: No se pudo consultar Flow getStatus (token {flow_token}): {e}")
+            return Response({"error": "Configuración del servidor incompleta."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
         except Exception as e: # Captura cualquier otra excepción inesperada
             logger.critical(f"FlowConfirmationView: Error crítico inesperado procesando confirmación (token {flow_token}): {e}", exc_info=True)
             # Devolver 500 para indicar un error nuestro, pero Flow podría reintentar.
@@ -512,16 +312,80 @@ class FlowConfirmationView(APIView):
         return Response(status=status.HTTP_200_OK)
 
 
+def order_status_response(request, snapshot):
+    """
+    Respuesta {"status"} de una orden con ETag y Last-Modified tomados de
+    updated_at. Si el cliente ya tiene esa versión (If-None-Match /
+    If-Modified-Since) responde 304 sin cuerpo.
+    """
+    etag = snapshot['etag']
+    last_modified = int(snapshot['last_modified']) if snapshot['last_modified'] else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = Response({"status": snapshot['status']})
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # Que los navegadores y proxies revaliden siempre: el estado puede cambiar en cualquier momento
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
 class OrderStatusView(APIView):
     """
     API para consultar el estado de una orden específica (usado por el frontend).
+    Lee de la caché de estados (payments/order_status.py), así que los GET
+    condicionales de quien ya tiene el estado vigente reciben 304 sin tocar la BD.
     """
     def get(self, request, commerce_order, *args, **kwargs):
-        try:
-            order = Order.objects.get(commerce_order=commerce_order)
-            return Response({"status": order.status})
-        except Order.DoesNotExist:
+        snapshot = get_order_status(commerce_order)
+        if snapshot is None:
             return Response({"error": "Orden no encontrada"}, status=status.HTTP_404_NOT_FOUND)
+        return order_status_response(request, snapshot)
+
+
+class BulkOrderStatusView(APIView):
+    """
+    Estado de muchas órdenes en una sola llamada, para el panel de despacho y
+    "mis pedidos". Recibe {"commerce_orders": [...]} o {"flow_tokens": [...]}
+    (hasta ORDER_STATUS_BULK_MAX_ITEMS) y devuelve {"orders": {clave: estado}},
+    con {"found": false} para las que no existen. Lo que no está en la caché
+    de estados se resuelve con una sola consulta IN.
+    """
+    def post(self, request, *args, **kwargs):
+        if 'commerce_orders' in request.data:
+            field, lookup = 'commerce_orders', get_order_statuses
+        elif 'flow_tokens' in request.data:
+            field, lookup = 'flow_tokens', get_order_statuses_by_token
+        else:
+            return Response(
+                {"error": "Debes enviar 'commerce_orders' o 'flow_tokens' (lista)."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        values = request.data.get(field)
+        if not isinstance(values, list) or not all(isinstance(value, str) and value for value in values):
+            return Response({"error": f"'{field}' debe ser una lista de textos no vacíos."}, status=status.HTTP_400_BAD_REQUEST)
+        values = list(dict.fromkeys(values)) # Sin repetidos, en el orden recibido
+        if len(values) > settings.ORDER_STATUS_BULK_MAX_ITEMS:
+            return Response(
+                {"error": f"Máximo {settings.ORDER_STATUS_BULK_MAX_ITEMS} órdenes por consulta (se recibieron {len(values)})."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        orders = {}
+        for value, snapshot in lookup(values).items():
+            if snapshot is None:
+                orders[value] = {"found": False}
+            else:
+                orders[value] = {
+                    "found": True,
+                    "commerce_order": snapshot['commerce_order'],
+                    "status": snapshot['status'],
+                    "final": snapshot['status'] in FINAL_ORDER_STATUSES,
+                    "updated_at": snapshot['updated_at'],
+                }
+        return Response({"orders": orders}, status=status.HTTP_200_OK)
 
 
 # payments/views.py
@@ -554,15 +418,15 @@ def health_check_view(request):
 class GetOrderStatusByTokenView(APIView):
     """
     Permite al frontend consultar el estado de una orden usando el
-    token de Flow, que es devuelto en la URL de retorno.
+    token de Flow, que es devuelto en la URL de retorno. Cacheada y con
+    GET condicional igual que OrderStatusView.
     """
     def get(self, request, flow_token, *args, **kwargs):
-        try:
-            # Buscamos la orden en nuestra base de datos usando el flow_token
-            order = Order.objects.get(flow_token=flow_token)
-            return Response({"status": order.status})
-        except Order.DoesNotExist:
+        # Buscamos la orden por flow_token (caché primero, BD si no está)
+        snapshot = get_order_status_by_token(flow_token)
+        if snapshot is None:
             return Response({"error": "Orden no encontrada con el token proporcionado"}, status=status.HTTP_404_NOT_FOUND)
+        return order_status_response(request, snapshot)
 
 
 
@@ -604,17 +468,6 @@ class FlowReturnHandlerView(View):
             error_url = f"{settings.FUNGIFRESH_STORE_URL}/checkout/confirmation?status=error&reason=missing_token"
             return HttpResponseRedirect(error_url)
 
-        # Consultar el estado del pago en Flow usando el token
-        api_key = os.getenv('FLOW_API_KEY')
-        secret_key = os.getenv('FLOW_SECRET_KEY')
-        flow_api_base_url = os.getenv('FLOW_API_URL_PROD', 'https://flow.cl/api')
-        flow_status_endpoint_url = f"{flow_api_base_url}/payment/getStatus"
-        
-        params_to_sign = {'apiKey': api_key, 'token': flow_token}
-        signature = sign_params(params_to_sign, secret_key)
-        
-        params_for_get_status = {'apiKey': api_key, 'token': flow_token, 's': signature}
-
         order_in_db = None
         try:
             # Intentamos obtener nuestra orden local usando el flow_token para tener el commerceOrder
@@ -625,18 +478,15 @@ class FlowReturnHandlerView(View):
 
         final_redirect_url = ""
         try:
-            response = requests.get(flow_status_endpoint_url, params=params_for_get_status)
-            response.raise_for_status()
-            payment_data = response.json()
+            # Consultar el estado del pago en Flow usando el token
+            payment_data = get_flow_client().get_status(flow_token)
 
             flow_status_code = payment_data.get('status') # 1=Pendiente, 2=Pagada, 3=Rechazada, 4=Anulada
             commerce_order_from_flow = payment_data.get('commerceOrder', 'unknown') # Tomamos el commerceOrder de Flow
 
             # Es buena idea actualizar nuestra BD aquí también, aunque el webhook es el principal
             if order_in_db and order_in_db.status == 'PENDING':
-                if flow_status_code == 2: order_in_db.status = 'PAID'
-                elif flow_status_code == 3 or flow_status_code == 4: order_in_db.status = 'REJECTED'
-                order_in_db.save()
+                update_pending_order_status(order_in_db, flow_status_code)
             
             # Construir la URL de FungiFresh
             fungifresh_base_redirect = f"{settings.FUNGIFRESH_STORE_URL}/checkout/confirmation"
@@ -647,8 +497,8 @@ class FlowReturnHandlerView(View):
             else: # Pendiente u otro estado
                 final_redirect_url = f"{fungifresh_base_redirect}?status=pending&orderId={commerce_order_from_flow}&flowToken={flow_token}"
 
-        except requests.exceptions.RequestException as e:
-            print(f"Error al consultar estado en Flow (ReturnHandler): {e}")
+        except (requests.exceptions.RequestException, FlowError) as e:
+            logger.error(f"FlowReturnHandlerView: Error al consultar estado en Flow: {e}")
             # Si falla la consulta a Flow, redirigir a FungiFresh con un error
             commerce_order_for_error = order_in_db.commerce_order if order_in_db else "unknown_order"
             final_redirect_url = f"{settings.FUNGIFRESH_STORE_URL}/checkout/confirmation?status=error&reason=flow_status_check_failed&orderId={commerce_order_for_error}&flowToken={flow_token}"
@@ -668,12 +518,8 @@ class FlowCallbackView(View): # Renombrada para claridad y usando View base de D
     al usuario al frontend FungiGrow (usando la fungigrow_return_url guardada).
     """
     def handle_callback(self, request):
-        # Nivel de indentación 2 (dentro del método handle_callback)
         flow_token = request.POST.get('token') or request.GET.get('token')
 
-        fungifresh_base_url = settings.FUNGIFRESH_STORE_URL
-        fungifresh_path = "/checkout/confirmation" # Path estándar de FungiGrow
-        
         redirect_params = {
             'orderId': 'desconocido', # Lo actualizaremos si encontramos la orden
             'status': 'error',        # Por defecto, si algo falla
@@ -682,44 +528,25 @@ class FlowCallbackView(View): # Renombrada para claridad y usando View base de D
 
         if not flow_token:
             redirect_params['message'] = 'Token_de_Flow_no_recibido_en_callback'
-            query_string = urllib.parse.urlencode(redirect_params)
-            return HttpResponseRedirect(f"{fungifresh_base_url}{fungifresh_path}?{query_string}")
+            return HttpResponseRedirect(build_fungigrow_redirect_url(redirect_params))
 
         # Intentamos obtener nuestra orden local para tener el commerceOrder
-        # y la fungigrow_return_url específica si se guardó
         order_in_db = Order.objects.filter(flow_token=flow_token).first()
         if order_in_db:
             redirect_params['orderId'] = order_in_db.commerce_order
-            # Si la URL de FungiGrow se guardó por orden, podríamos usarla,
-            # pero el plan actual es usar una URL base y un path fijo.
         else:
             # Si no encontramos la orden por token, es un problema.
             # El webhook /api/confirm-payment/ debería haber guardado el token.
-            print(f"ALERTA: No se encontró orden con flow_token {flow_token} en el callback. Se intentará buscar por commerceOrder si Flow lo devuelve.")
-            # No asignamos un mensaje de error aquí todavía, esperaremos a la respuesta de Flow.
-
-        # Consultar el estado REAL del pago en Flow usando el token
-        api_key = os.getenv('FLOW_API_KEY')
-        secret_key = os.getenv('FLOW_SECRET_KEY')
-        flow_api_base_url = os.getenv('FLOW_API_URL_PROD', 'https://flow.cl/api')
-        flow_status_endpoint_url = f"{flow_api_base_url}/payment/getStatus"
-        
-        params_to_sign = {'apiKey': api_key, 'token': flow_token}
-        # Asegúrate que la función sign_params esté disponible en este scope
-        signature = sign_params(params_to_sign, secret_key) 
-        params_for_get_status = {'apiKey': api_key, 'token': flow_token, 's': signature}
+            logger.warning(f"FlowCallbackView: No se encontró orden con flow_token {flow_token} en el callback. Se intentará buscar por commerceOrder si Flow lo devuelve.")
 
         try:
-            response = requests.get(flow_status_endpoint_url, params=params_for_get_status)
-            response.raise_for_status() # Lanza HTTPError para respuestas 4xx/5xx
-            payment_data = response.json()
+            # Consultar el estado REAL del pago en Flow usando el token
+            # (lanza HTTPError para respuestas 4xx/5xx)
+            payment_data = get_flow_client().get_status(flow_token)
 
             flow_status_code = payment_data.get('status') # 1=Pendiente, 2=Pagada, 3=Rechazada, 4=Anulada
             commerce_order_from_flow = payment_data.get('commerceOrder')
 
-            if commerce_order_from_flow: # Usamos el commerceOrder de Flow como la fuente más fiable
-                 redirect_params['orderId'] = commerce_order_from_flow
-
             # Intentar actualizar nuestra BD
             # Buscamos la orden por commerceOrder devuelto por Flow, ya que es más fiable que el token solo
             order_to_update = None
@@ -727,51 +554,24 @@ class FlowCallbackView(View): # Renombrada para claridad y usando View base de D
                 order_to_update = Order.objects.filter(commerce_order=commerce_order_from_flow).first()
             
             if order_to_update:
-                if not order_to_update.flow_token: # Si no tenía el token, lo guardamos
-                    order_to_update.flow_token = flow_token
-                
                 # Solo actualizamos si está PENDING para no sobrescribir un estado final del webhook
                 if order_to_update.status == 'PENDING':
-                    if flow_status_code == 2:
-                        order_to_update.status = 'PAID'
-                    elif flow_status_code == 3 or flow_status_code == 4:
-                        order_to_update.status = 'REJECTED'
-                    # No cambiamos a PENDING aquí, solo a estados finales.
-                    order_to_update.save()
+                    update_pending_order_status(order_to_update, flow_status_code, flow_token=flow_token)
+                elif not order_to_update.flow_token: # Si no tenía el token, lo guardamos
+                    Order.objects.filter(pk=order_to_update.pk, flow_token__isnull=True).update(flow_token=flow_token)
             else:
-                print(f"ALERTA: No se encontró orden local para commerceOrder {commerce_order_from_flow} devuelto por Flow en callback.")
-
+                logger.warning(f"FlowCallbackView: No se encontró orden local para commerceOrder {commerce_order_from_flow} devuelto por Flow en callback.")
 
             # Definir status y message para FungiGrow
-            if flow_status_code == 2: # Pagada
-                redirect_params['status'] = 'success'
-                redirect_params['message'] = 'Tu pago fue exitoso'
-            elif flow_status_code == 3 or flow_status_code == 4: # Rechazada o Anulada
-                redirect_params['status'] = 'failure'
-                # Usar el mensaje de Flow si está disponible, sino uno genérico
-                flow_payment_message = payment_data.get('paymentData', {}).get('user_message', 'Pago rechazado o anulado')
-                redirect_params['message'] = flow_payment_message if flow_payment_message else 'Pago rechazado o anulado'
-            elif flow_status_code == 1: # Pendiente
-                redirect_params['status'] = 'pending'
-                redirect_params['message'] = 'Tu pago esta pendiente'
-            else: # Otro estado o error en la respuesta de Flow
-                redirect_params['status'] = 'error'
-                # Esta es la línea 442 original, asegúrate que la indentación de este 'else'
-                # y su contenido sea correcta, alineada con el 'if' y 'elif' anteriores.
-                redirect_params['message'] = 'Estado de pago desconocido desde Flow' 
+            apply_callback_status_to_redirect(payment_data, redirect_params)
         
-        except requests.exceptions.RequestException as e:
-            print(f"Error al consultar estado en Flow (FlowCallbackView): {e}")
+        except (requests.exceptions.RequestException, FlowError) as e:
+            logger.error(f"FlowCallbackView: Error al consultar estado en Flow: {e}")
             redirect_params['status'] = 'error'
             redirect_params['message'] = 'Fallo en la verificacion del estado con Flow'
         
-        # Limpiar y codificar espacios en el mensaje para la URL
-        if 'message' in redirect_params and redirect_params['message']:
-            redirect_params['message'] = urllib.parse.quote_plus(str(redirect_params['message']))
-
-        query_string = urllib.parse.urlencode(redirect_params)
-        final_url_to_fungigrow = f"{fungifresh_base_url}{fungifresh_path}?{query_string}"
-        print(f"--- DEBUG CALLBACK: Redirigiendo a FungiGrow: {final_url_to_fungigrow} ---")
+        final_url_to_fungigrow = build_fungigrow_redirect_url(redirect_params)
+        logger.debug(f"FlowCallbackView: Redirigiendo a FungiGrow: {final_url_to_fungigrow}")
         return HttpResponseRedirect(final_url_to_fungigrow)
 
     def get(self, request, *args, **kwargs):
@@ -789,49 +589,55 @@ class QueryOrderStatusView(APIView):
     """
     Permite consultar el estado de una o más órdenes usando
     commerce_order, customer_email o shipping_phone como parámetro query.
+
+    Pagina por cursor: ?limit= órdenes por página (hasta ORDER_QUERY_MAX_PAGE_SIZE)
+    y, si hay más, la URL de la página siguiente viene en el header Link
+    (rel="next") y el cursor en X-Next-Cursor, para pasarlo como ?cursor=.
     """
     def get(self, request, *args, **kwargs):
         commerce_order = request.query_params.get('commerce_order', None)
         email = request.query_params.get('email', None)
         phone = request.query_params.get('phone', None)
 
-        orders_query = None
-
-        if commerce_order:
-            orders_query = Order.objects.filter(commerce_order__iexact=commerce_order)
-        elif email:
-            orders_query = Order.objects.filter(customer_email__iexact=email).order_by('-created_at')
-        elif phone:
-            # Considerar normalizar el 'phone' si los formatos pueden variar mucho.
-            # Por ahora, búsqueda exacta (ignorando mayúsculas/minúsculas si es relevante, aunque para teléfonos no tanto).
-            # Si guardas teléfonos con '+569...' el usuario debe proveerlo así.
-            orders_query = Order.objects.filter(shipping_phone=phone).order_by('-created_at')
-        else:
+        # El teléfono se normaliza a E.164, así que da lo mismo el formato en que lo escriba el usuario
+        orders_query = find_orders(commerce_order=commerce_order, email=email, phone=phone)
+        if orders_query is None:
             return Response(
                 {"error": "Debes proporcionar un parámetro de búsqueda: commerce_order, email, o phone."},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        if not orders_query: # Si el filtro no arrojó nada (aunque el query en sí era válido)
-            return Response([], status=status.HTTP_200_OK) # Devolver lista vacía en lugar de 404
-
-        # Preparamos una lista simplificada de los resultados
-        results = []
-        for order in orders_query:
-            results.append({
-                "commerce_order": order.commerce_order,
-                "status": order.status,
-                "created_at": order.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                "amount": str(order.amount), # Convertir Decimal a string
-                "subject": order.shipping_name # O un resumen de productos si lo tuvieras
-                                               # Por ahora, el nombre del destinatario podría servir
-            })
+        try:
+            limit = int(request.query_params.get('limit', settings.ORDER_QUERY_PAGE_SIZE))
+        except ValueError:
+            return Response({"error": "El parámetro 'limit' debe ser un número entero."}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, settings.ORDER_QUERY_MAX_PAGE_SIZE))
 
-        if not results: # Si después de procesar, la lista sigue vacía (ej. por un error interno no capturado)
-             return Response([], status=status.HTTP_200_OK)
+        try:
+            rows, next_cursor = order_page(orders_query, cursor=request.query_params.get('cursor'), limit=limit)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Preparamos una lista simplificada de los resultados
+        results = [
+            {
+                "commerce_order": row['commerce_order'],
+                "status": row['status'],
+                "created_at": row['created_at'].strftime('%Y-%m-%d %H:%M:%S'),
+                "amount": str(row['amount']), # Convertir Decimal a string
+                "subject": row['shipping_name'], # Por ahora, el nombre del destinatario
+            }
+            for row in rows
+        ]
 
-        return Response(results, status=status.HTTP_200_OK)
+        response = Response(results, status=status.HTTP_200_OK)
+        if next_cursor:
+            params = request.query_params.copy()
+            params['cursor'] = next_cursor
+            params['limit'] = limit
+            response['Link'] = f'<{request.build_absolute_uri(request.path)}?{params.urlencode()}>; rel="next"'
+            response['X-Next-Cursor'] = next_cursor
+        return response
 
 
 
@@ -854,9 +660,8 @@ class ValidateDiscountCodeView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        try:
-            discount_code = DiscountCode.objects.get(code__iexact=code_str) # Búsqueda insensible a mayúsculas
-        except DiscountCode.DoesNotExist:
+        discount_code = get_discount_code(code_str) # Insensible a mayúsculas, desde la caché del worker
+        if discount_code is None:
             return Response(
                 {"isValid": False, "message": "El código de descuento no existe."},
                 status=status.HTTP_404_NOT_FOUND # O 200 con isValid:false según preferencia del frontend
@@ -876,4 +681,117 @@ class ValidateDiscountCodeView(APIView):
             "discountValue": discount_code.discount_value, # Valor nominal (ej. 10 para 10%, o 5000 para $5000)
             "discountAmountCalculated": discount_amount_calculated, # Monto real a descontar
             "message": "¡Descuento aplicado!"
-        }, status=status.HTTP_200_OK)
\ No newline at end of file
+        }, status=status.HTTP_200_OK)
+
+
+class CartQuoteView(APIView):
+    """
+    Cotiza un carrito en el servidor con los mismos cálculos que usa
+    create-payment: {"items": [{"slug", "quantity"}], "discount_code_applied",
+    "shipping_cost"} -> líneas, subtotal, descuento, envío y total.
+    """
+    def post(self, request, *args, **kwargs):
+        try:
+            quote = quote_cart(request.data)
+        except CheckoutError as checkout_err:
+            return Response(checkout_err.payload, status=checkout_err.http_status)
+        return Response(quote.as_dict(), status=status.HTTP_200_OK)
+
+
+class ShippingQuoteView(APIView):
+    """
+    Costo de envío desde la tabla de tarifas en memoria (sin consultas a la
+    BD): {"region", "commune", "weight_grams"}. En vez del peso se pueden
+    mandar los 'items' del carrito, que se pesan con una consulta.
+    """
+    def post(self, request, *args, **kwargs):
+        region = request.data.get('region')
+        commune = request.data.get('commune') or ''
+        if not region:
+            return Response({"error": "Falta el parámetro 'region'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if request.data.get('items') is not None:
+            try:
+                weight = price_cart(request.data['items']).weight
+            except PricingError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            try:
+                weight = int(request.data.get('weight_grams'))
+            except (TypeError, ValueError):
+                return Response({"error": "Envía 'weight_grams' (entero) o los 'items' del carrito."}, status=status.HTTP_400_BAD_REQUEST)
+            if weight < 0:
+                return Response({"error": "'weight_grams' no puede ser negativo."}, status=status.HTTP_400_BAD_REQUEST)
+
+        shipping = quote_shipping(region, commune, weight)
+        if shipping is None:
+            return Response(
+                {"error": f"No hay tarifa de envío para {', '.join(part for part in (commune, region) if part)} con {weight} g."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response({"region": region, "commune": commune, "weight_grams": weight, "shipping": str(shipping)}, status=status.HTTP_200_OK)
+
+
+class BatchValidateDiscountCodesView(APIView):
+    """
+    Valida muchos códigos contra un mismo subtotal con una sola consulta.
+    Recibe {"codes": [...], "cart_subtotal": ...} (hasta
+    DISCOUNT_BATCH_VALIDATION_MAX_CODES) y devuelve {"results": {código: ...}}
+    con la misma forma que validate-discount para cada uno.
+    """
+    def post(self, request, *args, **kwargs):
+        codes = request.data.get('codes')
+        cart_subtotal_str = request.data.get('cart_subtotal')
+
+        if not isinstance(codes, list) or not codes or cart_subtotal_str is None:
+            return Response({"error": "Faltan parámetros: 'codes' (lista) o 'cart_subtotal'."}, status=status.HTTP_400_BAD_REQUEST)
+        if not all(isinstance(code, str) for code in codes):
+            return Response({"error": "'codes' debe ser una lista de textos."}, status=status.HTTP_400_BAD_REQUEST)
+        codes = list(dict.fromkeys(codes))
+        if len(codes) > settings.DISCOUNT_BATCH_VALIDATION_MAX_CODES:
+            return Response(
+                {"error": f"Máximo {settings.DISCOUNT_BATCH_VALIDATION_MAX_CODES} códigos por consulta (se recibieron {len(codes)})."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            cart_subtotal = Decimal(str(cart_subtotal_str))
+        except Exception:
+            return Response({"error": "El 'cart_subtotal' debe ser un número válido."}, status=status.HTTP_400_BAD_REQUEST)
+
+        normalized = {code: normalize_discount_code(code) for code in codes}
+        found = {
+            discount_code.code_normalized: discount_code
+            for discount_code in DiscountCode.objects.filter(code_normalized__in=set(normalized.values()))
+        }
+
+        results = {}
+        for code, code_normalized in normalized.items():
+            discount_code = found.get(code_normalized)
+            if discount_code is None:
+                results[code] = {"isValid": False, "message": "El código de descuento no existe."}
+                continue
+            is_valid, message = discount_code.is_valid(cart_subtotal=cart_subtotal)
+            if not is_valid:
+                results[code] = {"isValid": False, "message": message}
+                continue
+            results[code] = {
+                "isValid": True,
+                "code": discount_code.code,
+                "discountType": discount_code.discount_type,
+                "discountValue": discount_code.discount_value,
+                "discountAmountCalculated": discount_code.calculate_discount(cart_subtotal),
+                "message": "¡Descuento aplicado!"
+            }
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+
+class FlowMetricsView(APIView):
+    """
+    Métricas del cliente de Flow en este worker: estado de cada circuit
+    breaker, veces que se abrió, llamadas rechazadas, tasa de error y
+    latencias de la ventana, y el timeout de lectura vigente. Solo staff.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(breaker_metrics(), status=status.HTTP_200_OK)
@@ -1,6 +1,7 @@
 # products/admin.py (o payments/admin.py)
 from django.contrib import admin
 from .models import Product
+from .search import search_filter
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
@@ -37,4 +38,11 @@ class ProductAdmin(admin.ModelAdmin):
             'fields': ('data_ai_hint_frontend',),
             'classes': ('collapse',) # Para que aparezca colapsado
         }),
-    )
\ No newline at end of file
+    )
+
+    def get_search_results(self, request, queryset, search_term):
+        # Índice FTS5 (products/search.py) en vez de LIKE '%...%' sobre cada columna
+        condition = search_filter(search_term)
+        if condition is None:
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(condition), False
@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    def ready(self):
+        from . import checks, signals # noqa: F401 (registra los checks y los receivers)
+        # Un migrate que reconstruye products_product borra los triggers del índice FTS (ver products/search.py)
+        post_migrate.connect(signals.restore_search_index, sender=self)
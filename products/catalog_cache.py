@@ -0,0 +1,95 @@
+# products/catalog_cache.py
+"""
+Catálogo pre-serializado en la caché de Django.
+
+El catálogo solo cambia cuando alguien edita productos en el admin, pero el
+listado y el detalle se consultan en cada visita a la tienda. Aquí se guarda
+el JSON ya renderizado (bytes) del listado completo y de cada producto bajo
+una versión del catálogo: un acierto no consulta la BD ni pasa por el
+serializer, solo devuelve los bytes.
+
+Cualquier post_save/post_delete de Product incrementa la versión
+(products/signals.py) y las entradas anteriores dejan de usarse (expiran
+solas). Los UPDATE en bloque no disparan señales: quien los haga debe llamar
+a bump_catalog_version().
+
+La versión vive en la caché de Django, así que la invalidación llega a todos
+los workers solo si esa caché es compartida (settings.CACHE_IS_SHARED). Con
+LocMemCache cada worker tiene su propia versión: esta expira a los
+CATALOG_CACHE_TTL segundos (10 por defecto en ese caso) y ese es el retraso
+con que los demás workers ven un cambio.
+
+Protección contra estampidas: tras una invalidación solo el worker que toma
+el lock (cache.add) reconstruye la entrada. Los demás responden con la última
+versión que se alcanzó a construir (unos segundos desactualizada) o, si no
+hay ninguna, esperan un momento a que el primero termine antes de
+reconstruirla ellos mismos.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+CATALOG_VERSION_KEY = 'catalog-version'
+
+
+def _version_timeout():
+    # Con caché compartida la versión no expira; en LocMem expira para que los demás workers no sirvan (ni den 304 de) un catálogo viejo indefinidamente
+    return None if settings.CACHE_IS_SHARED else settings.CATALOG_CACHE_TTL
+
+
+def catalog_version():
+    """Versión vigente del catálogo (se crea si la caché no la tiene)."""
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), _version_timeout())
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    """Invalida todo el catálogo cacheado (en todos los workers si la caché es compartida)."""
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError: # La clave no existe todavía
+        cache.set(CATALOG_VERSION_KEY, time.time_ns(), _version_timeout())
+
+
+def get_or_build(name, build):
+    """
+    Bytes de la entrada `name` (ej. 'list', 'product:<slug>') para la versión
+    vigente. Si no están, los construye `build()` (que puede devolver None, ej.
+    producto inexistente, y eso no se cachea). Devuelve (versión, bytes o None),
+    donde versión es la del catálogo que se sirvió de verdad: mientras otro
+    worker reconstruye puede ser la anterior, y el ETag debe decirlo.
+    """
+    version = catalog_version()
+    key = f"catalog:{version}:{name}"
+    latest_key = f"catalog:latest:{name}" # (versión, bytes) de la última construcción, para servir mientras otro reconstruye
+
+    data = cache.get(key)
+    if data is not None:
+        return version, data
+
+    lock_key = f"catalog:{version}:{name}:lock"
+    if not cache.add(lock_key, 1, settings.CATALOG_CACHE_LOCK_TIMEOUT):
+        # Otro worker está reconstruyendo esta entrada
+        latest = cache.get(latest_key)
+        if latest is not None:
+            return latest
+        deadline = time.monotonic() + settings.CATALOG_CACHE_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            data = cache.get(key)
+            if data is not None:
+                return version, data
+        # No terminó a tiempo: se construye igual (sin guardar) antes que dejar al cliente esperando
+        return version, build()
+
+    try:
+        data = build()
+        if data is not None:
+            cache.set_many({key: data, latest_key: (version, data)}, settings.CATALOG_CACHE_TTL)
+        return version, data
+    finally:
+        cache.delete(lock_key)
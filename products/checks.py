@@ -0,0 +1,19 @@
+# products/checks.py
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """Las cachés versionadas (catálogo, códigos de descuento, tarifas de envío) necesitan una caché compartida entre workers."""
+    if settings.CACHE_IS_SHARED:
+        return []
+    return [Warning(
+        "CACHES['default'] no es compartida entre procesos (LocMemCache).",
+        hint=(
+            "Los cambios al catálogo, a los códigos de descuento y a las tarifas de envío solo invalidan "
+            "la caché del worker que los hizo; los demás los ven al vencer sus TTL. Definir "
+            "DJANGO_CACHE_BACKEND/DJANGO_CACHE_LOCATION (ej. Redis) si se sirve con más de un worker."
+        ),
+        id='products.W001',
+    )]
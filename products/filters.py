@@ -0,0 +1,124 @@
+# products/filters.py
+"""
+Filtros del catálogo y conteos por faceta.
+
+Parámetros (en /api/products/ y /api/products/facets/):
+  ?category=Kits&category=Granos   (se puede repetir: cualquiera de los valores)
+  ?difficulty=Fácil  ?status=...   (igual que category)
+  ?min_price=5000&max_price=20000  (rango inclusivo)
+
+Los conteos de cada faceta aplican todos los filtros salvo el de la propia
+faceta, como en cualquier tienda: con ?category=Kits el bloque de categorías
+sigue mostrando cuántos productos hay en las otras categorías.
+
+Todo sale de una consulta: se agrupa por (categoría, dificultad, estado) y
+en cada grupo se cuentan, con agregación condicional, los productos dentro
+del rango de precio, además del precio mínimo y máximo. Los grupos son pocos
+(combinaciones que existen de verdad), así que repartirlos por faceta en
+Python no depende de cuántos productos haya. El índice product_facets_idx
+cubre esas columnas y la consulta no lee la tabla.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Count, Max, Min, Q
+from rest_framework.exceptions import ValidationError
+
+# Parámetro -> columna de Product
+FACET_FIELDS = {
+    'category': 'category_name',
+    'difficulty': 'difficulty_frontend',
+    'status': 'status_frontend',
+}
+
+
+def _price(query_params, name):
+    value = query_params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValidationError({name: "Debe ser un número."})
+    if not price.is_finite() or price < 0:
+        raise ValidationError({name: "Debe ser un número positivo."})
+    return price
+
+
+def parse_product_filters(query_params):
+    """Filtros pedidos: {'category': [...], ..., 'min_price': Decimal o None, 'max_price': ...}. ValidationError (400) si un precio no es válido."""
+    filters = {param: sorted({value for value in query_params.getlist(param) if value}) for param in FACET_FIELDS}
+    filters['min_price'] = _price(query_params, 'min_price')
+    filters['max_price'] = _price(query_params, 'max_price')
+    return filters
+
+
+def has_filters(filters):
+    return any(filters.values())
+
+
+def filters_key(filters):
+    """Texto canónico de los filtros, para las claves de la caché del catálogo ('' sin filtros)."""
+    parts = [f"{param}={'|'.join(filters[param])}" for param in FACET_FIELDS if filters[param]]
+    parts += [f"{name}={filters[name]}" for name in ('min_price', 'max_price') if filters[name] is not None]
+    return '&'.join(parts)
+
+
+def _price_q(filters):
+    condition = Q()
+    if filters['min_price'] is not None:
+        condition &= Q(price__gte=filters['min_price'])
+    if filters['max_price'] is not None:
+        condition &= Q(price__lte=filters['max_price'])
+    return condition
+
+
+def filter_products(queryset, filters):
+    for param, column in FACET_FIELDS.items():
+        if filters[param]:
+            queryset = queryset.filter(**{f"{column}__in": filters[param]})
+    return queryset.filter(_price_q(filters))
+
+
+def facet_counts(queryset, filters):
+    """
+    {'total', 'facets': {param: [{'value', 'count'}...]}, 'price': {'min', 'max'}}
+    para los productos de `queryset` (ej. los activos). Una consulta.
+    """
+    price_q = _price_q(filters)
+    groups = (
+        queryset.order_by()
+        .values(*FACET_FIELDS.values())
+        .annotate(in_range=Count('id', filter=price_q) if price_q else Count('id'), min_price=Min('price'), max_price=Max('price'))
+    )
+
+    def matches(group, skip=None):
+        return all(
+            group[column] in filters[param]
+            for param, column in FACET_FIELDS.items()
+            if param != skip and filters[param]
+        )
+
+    facets = {param: {} for param in FACET_FIELDS}
+    total, min_price, max_price = 0, None, None
+    for group in groups:
+        for param, column in FACET_FIELDS.items():
+            if group['in_range'] and group[column] is not None and matches(group, skip=param):
+                facets[param][group[column]] = facets[param].get(group[column], 0) + group['in_range']
+        if matches(group):
+            total += group['in_range']
+            # El rango de precios ignora el propio filtro de precio (para dibujar el slider completo)
+            min_price = group['min_price'] if min_price is None else min(min_price, group['min_price'])
+            max_price = group['max_price'] if max_price is None else max(max_price, group['max_price'])
+
+    for param in FACET_FIELDS:
+        for value in filters[param]: # Los valores elegidos se muestran aunque hayan quedado en cero
+            facets[param].setdefault(value, 0)
+
+    return {
+        'total': total,
+        'facets': {
+            param: [{'value': value, 'count': count} for value, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+            for param, counts in facets.items()
+        },
+        'price': {'min': str(min_price) if min_price is not None else None, 'max': str(max_price) if max_price is not None else None}, # Como 'price' en ProductSerializer
+    }
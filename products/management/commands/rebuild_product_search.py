@@ -0,0 +1,20 @@
+# products/management/commands/rebuild_product_search.py
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from products.search import ensure_search_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Recrea la tabla FTS5 y los triggers de la búsqueda de productos si faltan y reindexa todo el catálogo. "
+        "Corre solo tras cada migrate; usarlo a mano si el índice quedó desfasado."
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            self.stderr.write("La búsqueda FTS5 solo existe en SQLite; nada que hacer.")
+            return
+        restored = ensure_search_index(rebuild=True)
+        detail = f" (se recrearon: {', '.join(restored)})" if restored else ""
+        self.stdout.write(self.style.SUCCESS(f"Índice de búsqueda de productos reconstruido{detail}."))
@@ -0,0 +1,65 @@
+# products/migrations/0007_product_search_fts.py
+"""
+Índice FTS5 para la búsqueda de productos (products/search.py).
+
+Tabla virtual de contenido externo sobre products_product: guarda solo el
+índice invertido, los textos se leen de la tabla de productos. Los triggers
+la mantienen al día con cualquier INSERT/UPDATE/DELETE, incluidos los
+UPDATE en bloque y los cambios hechos fuera del ORM. Solo aplica en SQLite.
+"""
+from django.db import migrations
+
+FTS_TABLE = 'products_product_fts'
+FTS_COLUMNS = 'name, description, category_name, data_ai_hint_frontend'
+
+CREATE_SQL = [
+    # remove_diacritics: 'rapida' encuentra 'Rápida'. prefix: índices para las búsquedas por prefijo de 2 y 3 letras
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        {FTS_COLUMNS},
+        content='products_product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    f"""CREATE TRIGGER products_product_fts_ai AFTER INSERT ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, {FTS_COLUMNS})
+        VALUES (new.id, new.name, new.description, new.category_name, new.data_ai_hint_frontend);
+    END""",
+    f"""CREATE TRIGGER products_product_fts_ad AFTER DELETE ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {FTS_COLUMNS})
+        VALUES ('delete', old.id, old.name, old.description, old.category_name, old.data_ai_hint_frontend);
+    END""",
+    # Solo si cambió alguna columna indexada (los cambios de stock o precio no tocan el índice)
+    f"""CREATE TRIGGER products_product_fts_au AFTER UPDATE OF {FTS_COLUMNS} ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {FTS_COLUMNS})
+        VALUES ('delete', old.id, old.name, old.description, old.category_name, old.data_ai_hint_frontend);
+        INSERT INTO {FTS_TABLE}(rowid, {FTS_COLUMNS})
+        VALUES (new.id, new.name, new.description, new.category_name, new.data_ai_hint_frontend);
+    END""",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')", # Indexa los productos existentes
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS products_product_fts_ai",
+    "DROP TRIGGER IF EXISTS products_product_fts_ad",
+    "DROP TRIGGER IF EXISTS products_product_fts_au",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+
+def run_on_sqlite(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0006_product_active_name_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_sqlite(CREATE_SQL), run_on_sqlite(DROP_SQL)),
+    ]
@@ -82,6 +82,13 @@ class Product(models.Model):
         verbose_name = "Producto"
         verbose_name_plural = "Productos"
         ordering = ['name']
+        indexes = [
+            # Listado del catálogo (solo activos, por nombre) y su paginación por cursor
+            models.Index(fields=['is_active', 'name', 'id'], name='product_active_name_idx'),
+            # Filtros por faceta (products/filters.py): cubre la consulta de conteos, que no lee la tabla
+            models.Index(fields=['is_active', 'category_name', 'difficulty_frontend', 'status_frontend', 'price'], name='product_facets_idx'),
+            models.Index(fields=['is_active', 'price'], name='product_active_price_idx'),
+        ]
 
     def __str__(self):
         return self.name
\ No newline at end of file
@@ -0,0 +1,28 @@
+# products/pagination.py
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class ProductCursorPagination(CursorPagination):
+    """
+    Paginación por cursor (keyset sobre name, id), opcional: solo se activa si
+    la petición trae ?cursor= o ?limit=; sin ellos la lista sale completa como
+    siempre. Cada página es un rango del índice (is_active, name, id) y no se
+    hace COUNT(*): la respuesta trae los enlaces next/previous y los resultados.
+    """
+    ordering = ('name', 'id')
+    page_size_query_param = 'limit'
+
+    def __init__(self):
+        # La vista crea un paginador por petición: los tamaños se leen de settings en ese momento
+        self.page_size = settings.PRODUCT_PAGE_SIZE
+        self.max_page_size = settings.PRODUCT_MAX_PAGE_SIZE
+
+    def is_requested(self, request):
+        """True si la petición pidió paginar (?cursor= o ?limit=)."""
+        return self.cursor_query_param in request.query_params or self.page_size_query_param in request.query_params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_requested(request):
+            return None
+        return super().paginate_queryset(queryset, request, view=view)
@@ -0,0 +1,156 @@
+# products/search.py
+"""
+Búsqueda de productos sobre el índice FTS5 products_product_fts (ver la
+migración 0007_product_search_fts). Busca en nombre, descripción, categoría
+y palabras clave (data_ai_hint_frontend).
+
+- Todas las palabras deben aparecer; la última se busca como prefijo
+  ('kit ost' encuentra 'Kit Ostra'), para buscar mientras se escribe. Sin
+  distinguir mayúsculas ni tildes.
+- Orden por bm25, con más peso para el nombre que para la descripción.
+- Cada resultado trae el nombre resaltado y un fragmento del texto donde
+  coincidió, con <mark>...</mark> alrededor de lo encontrado (el resto del
+  texto va escapado como HTML).
+
+El índice usa SQLite; en otra BD search_products() cae a un icontains sobre
+el nombre, sin ranking ni fragmentos.
+
+IMPORTANTE: el índice se mantiene con triggers de SQLite sobre
+products_product, que Django no conoce. Una migración que altere Product
+(AlterField, RemoveField...) hace que el schema editor de SQLite reconstruya
+la tabla y los triggers desaparecen sin error, dejando el índice desfasado.
+Por eso ensure_search_index() corre después de cada `migrate` (post_migrate,
+ver products/apps.py): recrea lo que falte y reindexa. También se puede
+correr a mano con `manage.py rebuild_product_search`. Si cambian las
+columnas indexadas, actualizar SEARCH_INDEX_SQL aquí y en una migración.
+"""
+import html
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Product
+
+FTS_TABLE = 'products_product_fts'
+FTS_COLUMNS = 'name, description, category_name, data_ai_hint_frontend'
+FTS_TRIGGERS = ('products_product_fts_ai', 'products_product_fts_ad', 'products_product_fts_au')
+# Igual que la migración 0007_product_search_fts, con IF NOT EXISTS para poder repetirlo
+SEARCH_INDEX_SQL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        {FTS_COLUMNS},
+        content='products_product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_product_fts_ai AFTER INSERT ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, {FTS_COLUMNS})
+        VALUES (new.id, new.name, new.description, new.category_name, new.data_ai_hint_frontend);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_product_fts_ad AFTER DELETE ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {FTS_COLUMNS})
+        VALUES ('delete', old.id, old.name, old.description, old.category_name, old.data_ai_hint_frontend);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_product_fts_au AFTER UPDATE OF {FTS_COLUMNS} ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {FTS_COLUMNS})
+        VALUES ('delete', old.id, old.name, old.description, old.category_name, old.data_ai_hint_frontend);
+        INSERT INTO {FTS_TABLE}(rowid, {FTS_COLUMNS})
+        VALUES (new.id, new.name, new.description, new.category_name, new.data_ai_hint_frontend);
+    END""",
+]
+# Pesos de bm25 por columna: name, description, category_name, data_ai_hint_frontend
+FTS_WEIGHTS = (10.0, 1.0, 4.0, 2.0)
+MAX_QUERY_TERMS = 8
+SNIPPET_TOKENS = 16
+# Marcadores que no aparecen en los textos, para escapar el HTML y después poner <mark>
+_MARK_OPEN, _MARK_CLOSE = '\x02', '\x03'
+SEARCH_RESULT_FIELDS = ('id', 'name', 'slug', 'price', 'stock', 'image_url')
+
+
+def build_match_query(text):
+    """'kit Ostra ros' -> '"kit" "ostra" "ros"*' (sintaxis de MATCH de FTS5), o None si no hay palabras."""
+    terms = re.findall(r'\w+', (text or '').lower())[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    # Solo la última palabra se busca como prefijo: es la que se está escribiendo, y los prefijos cortos calzan con muchos términos
+    return ' '.join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+
+
+def _highlighted(text):
+    return html.escape(text or '').replace(_MARK_OPEN, '<mark>').replace(_MARK_CLOSE, '</mark>')
+
+
+def search_products(text, limit=20, active_only=True):
+    """
+    Productos que coinciden con `text`, del más al menos relevante (máximo
+    `limit`). Cada uno trae search_rank, name_highlighted y snippet. Una consulta.
+    """
+    match = build_match_query(text)
+    if match is None:
+        return []
+    if connection.vendor != 'sqlite':
+        queryset = Product.objects.filter(name__icontains=text.strip())
+        if active_only:
+            queryset = queryset.filter(is_active=True)
+        products = list(queryset.only(*SEARCH_RESULT_FIELDS)[:limit])
+        for product in products:
+            product.search_rank, product.name_highlighted, product.snippet = None, html.escape(product.name), ''
+        return products
+
+    columns = ', '.join(f'p.{field}' for field in SEARCH_RESULT_FIELDS)
+    weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+    products = list(Product.objects.raw(
+        f"""
+        SELECT {columns},
+               bm25({FTS_TABLE}, {weights}) AS search_rank,
+               highlight({FTS_TABLE}, 0, %s, %s) AS name_highlighted,
+               snippet({FTS_TABLE}, -1, %s, %s, '…', {SNIPPET_TOKENS}) AS snippet
+        FROM {FTS_TABLE}
+        JOIN products_product p ON p.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH %s {'AND p.is_active' if active_only else ''}
+        ORDER BY search_rank
+        LIMIT %s
+        """,
+        [_MARK_OPEN, _MARK_CLOSE, _MARK_OPEN, _MARK_CLOSE, match, limit],
+    ))
+    for product in products:
+        product.name_highlighted = _highlighted(product.name_highlighted)
+        product.snippet = _highlighted(product.snippet)
+    return products
+
+
+def search_filter(text):
+    """Q que deja solo los productos que coinciden con `text` (para el admin u otros querysets), o None si no hay palabras."""
+    match = build_match_query(text)
+    if match is None:
+        return None
+    if connection.vendor != 'sqlite':
+        return Q(name__icontains=text.strip())
+    return Q(id__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", (match,)))
+
+
+def missing_search_objects(using=None):
+    """Nombres de la tabla FTS y los triggers que no existen en la BD (vacío si todo está)."""
+    conn = connections[using or DEFAULT_DB_ALIAS]
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name IN (%s, %s, %s, %s)", [FTS_TABLE, *FTS_TRIGGERS])
+        existing = {row[0] for row in cursor.fetchall()}
+    return [name for name in (FTS_TABLE, *FTS_TRIGGERS) if name not in existing]
+
+
+def ensure_search_index(using=None, rebuild=False):
+    """
+    Recrea la tabla FTS y los triggers que falten y, si faltaba algo (o con
+    rebuild=True), reindexa todos los productos. Devuelve lo que se recreó.
+    No hace nada fuera de SQLite.
+    """
+    conn = connections[using or DEFAULT_DB_ALIAS]
+    if conn.vendor != 'sqlite':
+        return []
+    missing = missing_search_objects(using)
+    if missing or rebuild:
+        with conn.cursor() as cursor:
+            for statement in SEARCH_INDEX_SQL:
+                cursor.execute(statement)
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    return missing
@@ -1,8 +1,11 @@
 # products/serializers.py (o payments/serializers.py)
 from rest_framework import serializers
+
+from flow_project.fieldsets import SparseFieldsetSerializer
+
 from .models import Product # O from payments.models import Product
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsetSerializer):
     class Meta:
         model = Product
         fields = [
@@ -20,4 +23,20 @@ class ProductSerializer(serializers.ModelSerializer):
             'data_ai_hint_frontend',
             'additional_image_urls',
             'video_urls'
-        ]
\ No newline at end of file
+        ]
+
+# Presets de ?fields= (ver flow_project/fieldsets.py)
+PRODUCT_FIELD_PRESETS = {
+    'card': ['id', 'name', 'slug', 'price', 'stock', 'image_url'], # Grilla de la tienda
+    'full': ProductSerializer.Meta.fields,
+}
+
+
+class ProductSearchSerializer(serializers.ModelSerializer):
+    """Resultado de /api/products/search/: datos de la tarjeta más lo resaltado (HTML con <mark>)."""
+    name_highlighted = serializers.CharField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = Product
+        fields = PRODUCT_FIELD_PRESETS['card'] + ['name_highlighted', 'snippet']
@@ -0,0 +1,30 @@
+# products/signals.py
+import logging
+
+from django.db import connections, transaction
+from django.db.migrations.recorder import MigrationRecorder
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .catalog_cache import bump_catalog_version
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def bump_catalog_on_change(sender, instance, **kwargs):
+    # Al hacer commit, para que quien reconstruya el catálogo ya lea el cambio
+    transaction.on_commit(bump_catalog_version)
+
+
+def restore_search_index(sender, using=None, plan=None, **kwargs):
+    """post_migrate: recrea los triggers del índice de búsqueda si una migración de Product los borró."""
+    from .search import ensure_search_index
+    # La migración 0007 es la que crea el índice: antes de aplicarla no hay nada que restaurar
+    if not MigrationRecorder(connections[using]).migration_qs.filter(app='products', name='0007_product_search_fts').exists():
+        return
+    restored = ensure_search_index(using=using)
+    if restored:
+        logger.warning(f"Índice de búsqueda de productos recreado tras migrate (faltaba: {', '.join(restored)}).")
@@ -1,3 +1,226 @@
-from django.test import TestCase
+import io
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from .catalog_cache import bump_catalog_version, catalog_version, get_or_build
+from .filters import facet_counts, parse_product_filters
+from .models import Product
+from .search import missing_search_objects
+
+
+class ProductListPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(7):
+            Product.objects.create(name=f"Kit {i % 3}", slug=f"kit-{i}", price=1000)
+        Product.objects.create(name="Inactivo", slug='inactivo', price=1000, is_active=False)
+
+    def test_without_params_returns_full_list(self):
+        response = self.client.get('/api/products/')
+        self.assertEqual(len(response.json()), 7)
+
+    def test_cursor_pages_cover_catalog_without_count(self):
+        slugs = []
+        url = '/api/products/?limit=3'
+        while url:
+            with self.assertNumQueries(1): # Sin COUNT(*)
+                body = self.client.get(url).json()
+            self.assertLessEqual(len(body['results']), 3)
+            slugs += [product['slug'] for product in body['results']]
+            url = body['next']
+        expected = list(Product.objects.filter(is_active=True).order_by('name', 'id').values_list('slug', flat=True))
+        self.assertEqual(slugs, expected)
+
+    @override_settings(PRODUCT_MAX_PAGE_SIZE=2)
+    def test_page_size_is_capped(self):
+        response = self.client.get('/api/products/?limit=100000')
+        self.assertEqual(len(response.json()['results']), 2)
+
+
+class CatalogCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(name="Kit Ostra", slug='kit-ostra', price=12990)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_hits_cost_no_queries_and_saves_invalidate(self):
+        self.assertEqual(self.client.get('/api/products/').json()[0]['price'], '12990')
+        self.assertEqual(self.client.get('/api/products/kit-ostra/').json()['slug'], 'kit-ostra')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/products/').json()[0]['slug'], 'kit-ostra')
+            self.client.get('/api/products/kit-ostra/')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 9990
+            self.product.save()
+        self.assertEqual(self.client.get('/api/products/').json()[0]['price'], '9990')
+        self.assertEqual(self.client.get('/api/products/kit-ostra/').json()['price'], '9990')
+
+    @override_settings(CACHE_IS_SHARED=False, CATALOG_CACHE_TTL=10)
+    def test_version_expires_without_shared_cache(self):
+        # Con LocMem otro worker no recibe el bump: su versión (y su ETag) debe vencer sola
+        version = catalog_version()
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=time.time() + 11):
+            self.assertNotEqual(catalog_version(), version)
+
+    def test_unknown_slug_is_404(self):
+        self.assertEqual(self.client.get('/api/products/no-existe/').status_code, 404)
+
+    def test_only_one_worker_rebuilds_after_invalidation(self):
+        builds = []
+        get_or_build('list', lambda: builds.append(1) or b'[1]')
+        bump_catalog_version()
+        cache.add(f"catalog:{catalog_version()}:list:lock", 1) # Otro worker está reconstruyendo
+        self.assertEqual(get_or_build('list', lambda: builds.append(2) or b'[2]')[1], b'[1]') # Sirve la versión anterior
+        self.assertEqual(builds, [1])
+
+    def test_conditional_get_uses_catalog_version(self):
+        for url in ('/api/products/', '/api/products/kit-ostra/', '/api/products/?limit=5'):
+            etag = self.client.get(url).headers['ETag']
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertEqual(self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_stale_copy_during_rebuild_keeps_old_etag(self):
+        old = self.client.get('/api/products/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 9990
+            self.product.save()
+        cache.add(f"catalog:{catalog_version()}:list:lock", 1) # Otro worker está reconstruyendo el listado
+
+        stale = self.client.get('/api/products/')
+        self.assertEqual(stale.json()[0]['price'], '12990')
+        self.assertEqual(stale.headers['ETag'], old.headers['ETag']) # No el de la versión nueva
+        # Al revalidar con ese ETag no hay 304: el cliente recibe el catálogo nuevo cuando esté listo
+        cache.delete(f"catalog:{catalog_version()}:list:lock")
+        fresh = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=stale.headers['ETag'])
+        self.assertEqual(fresh.status_code, 200)
+        self.assertEqual(fresh.json()[0]['price'], '9990')
+        self.assertEqual(fresh.headers['ETag'], f'"catalog-{catalog_version()}"')
+
+
+class ProductSparseFieldsetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.create(name="Kit Ostra", slug='kit-ostra', price=12990, description="Larga " * 200, video_urls=['https://v/1'])
+
+    def setUp(self):
+        cache.clear()
+
+    def test_card_preset_trims_payload_and_query(self):
+        full = self.client.get('/api/products/').json()[0]
+        with CaptureQueriesContext(connection) as queries:
+            card = self.client.get('/api/products/?fields=card').json()[0]
+        self.assertEqual(list(card), ['id', 'name', 'slug', 'price', 'stock', 'image_url'])
+        self.assertNotIn('description', queries[0]['sql'])
+        self.assertIn('description', full) # La entrada completa de la caché no se mezcla con la recortada
+
+        detail = self.client.get('/api/products/kit-ostra/?fields=card,description').json()
+        self.assertEqual(set(detail), {'id', 'name', 'slug', 'price', 'stock', 'image_url', 'description'})
+        page = self.client.get('/api/products/?limit=1&fields=slug').json()
+        self.assertEqual(page['results'], [{'slug': 'kit-ostra'}])
+
+    def test_unknown_field_is_400(self):
+        self.assertEqual(self.client.get('/api/products/?fields=card,secreto').status_code, 400)
+
+
+@skipUnless(connection.vendor == 'sqlite', "La búsqueda usa FTS5 de SQLite.")
+class ProductSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ostra = Product.objects.create(name="Kit Ostra Rosada", slug='kit-ostra', price=12990, description="Cosecha rápida <en casa>.")
+        Product.objects.create(name="Kit Melena", slug='kit-melena', price=14990, description="Crece junto a la ostra.", category_name="Kits")
+        Product.objects.create(name="Ostra oculta", slug='ostra-oculta', price=1000, is_active=False)
+
+    def test_ranked_prefix_search_with_highlights(self):
+        with self.assertNumQueries(1):
+            results = self.client.get('/api/products/search/?q=OST').json()
+        self.assertEqual([result['slug'] for result in results], ['kit-ostra', 'kit-melena']) # Nombre pesa más; inactivo fuera
+        self.assertEqual(results[0]['name_highlighted'], "Kit <mark>Ostra</mark> Rosada")
+
+        snippet = self.client.get('/api/products/search/?q=rapida casa').json()[0]['snippet']
+        self.assertEqual(snippet, "Cosecha <mark>rápida</mark> &lt;en <mark>casa</mark>&gt;.")
+        self.assertEqual(self.client.get('/api/products/search/?q=').status_code, 400)
+
+    def test_index_follows_updates_and_deletes(self):
+        self.ostra.name = "Kit Shiitake"
+        self.ostra.save()
+        self.assertEqual([r['slug'] for r in self.client.get('/api/products/search/?q=shiitake').json()], ['kit-ostra'])
+        self.ostra.delete()
+        self.assertEqual(self.client.get('/api/products/search/?q=shiitake').json(), [])
+
+    def test_index_objects_exist_after_migrations(self):
+        # Falla si una migración de Product reconstruyó la tabla y se perdieron los triggers
+        self.assertEqual(missing_search_objects(), [])
+
+    def test_lost_triggers_are_restored_and_index_rebuilt(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER products_product_fts_au") # Como tras un AlterField en SQLite
+        Product.objects.filter(pk=self.ostra.pk).update(name="Kit Shiitake") # No llega al índice
+        self.assertEqual(self.client.get('/api/products/search/?q=shiitake').json(), [])
+
+        stdout = io.StringIO()
+        call_command('rebuild_product_search', stdout=stdout)
+        self.assertIn("Índice de búsqueda de productos reconstruido", stdout.getvalue())
+        self.assertEqual(missing_search_objects(), [])
+        self.assertEqual([r['slug'] for r in self.client.get('/api/products/search/?q=shiitake').json()], ['kit-ostra'])
+
+    def test_admin_search_uses_index(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'x'))
+        response = self.client.get('/admin/products/product/', {'q': 'melen'})
+        self.assertEqual([product.slug for product in response.context['cl'].result_list], ['kit-melena'])
+
+
+class ProductFacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for slug, category, difficulty, price in [
+            ('ostra', 'Kits', 'Fácil', 10000), ('melena', 'Kits', 'Medio', 15000),
+            ('reishi', 'Kits', 'Avanzado', 25000), ('grano', 'Sustratos', 'Fácil', 5000),
+        ]:
+            Product.objects.create(name=slug.title(), slug=slug, category_name=category, difficulty_frontend=difficulty, price=price)
+        Product.objects.create(name="Oculto", slug='oculto', category_name='Kits', price=1, is_active=False)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_list_filters(self):
+        slugs = [p['slug'] for p in self.client.get('/api/products/?category=Kits&max_price=15000').json()]
+        self.assertEqual(slugs, ['melena', 'ostra'])
+        page = self.client.get('/api/products/?limit=5&difficulty=Fácil&difficulty=Medio&min_price=6000').json()
+        self.assertEqual([p['slug'] for p in page['results']], ['melena', 'ostra'])
+        self.assertEqual(self.client.get('/api/products/?min_price=barato').status_code, 400)
+
+    def test_facet_counts_exclude_own_filter(self):
+        with self.assertNumQueries(1):
+            body = self.client.get('/api/products/facets/?category=Kits&max_price=15000').json()
+        self.assertEqual(body['total'], 2)
+        # Categorías: sin su propio filtro, pero con el de precio
+        self.assertEqual(body['facets']['category'], [{'value': 'Kits', 'count': 2}, {'value': 'Sustratos', 'count': 1}])
+        self.assertEqual(body['facets']['difficulty'], [{'value': 'Fácil', 'count': 1}, {'value': 'Medio', 'count': 1}])
+        self.assertEqual(body['price'], {'min': '10000', 'max': '25000'}) # Sin el filtro de precio
+        with self.assertNumQueries(0):
+            self.client.get('/api/products/facets/?category=Kits&max_price=15000')
+
+    @skipUnless(connection.vendor == 'sqlite', "Plan de consulta de SQLite.")
+    def test_facet_query_uses_covering_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            facet_counts(Product.objects.filter(is_active=True), parse_product_filters(QueryDict('max_price=100')))
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {queries[0]['sql']}")
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('COVERING INDEX product_facets_idx', plan)
@@ -1,10 +1,12 @@
 # products/urls.py
 from django.urls import path
-from .views import ProductListView, ProductDetailView
+from .views import ProductListView, ProductDetailView, ProductFacetsView, ProductSearchView
 
 app_name = 'products' # Buena práctica para nombrar las URLs de la app
 
 urlpatterns = [
     path('', ProductListView.as_view(), name='product-list'),
+    path('search/', ProductSearchView.as_view(), name='product-search'), # Antes del detalle: 'search' también calza como slug
+    path('facets/', ProductFacetsView.as_view(), name='product-facets'),
     path('<slug:slug>/', ProductDetailView.as_view(), name='product-detail'),
 ]
\ No newline at end of file
@@ -1,24 +1,136 @@
 # products/views.py
+from django.conf import settings
+from django.http import HttpResponse, Http404
 from rest_framework import generics
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.renderers import JSONRenderer
+
+from flow_project.conditional import ConditionalGetMixin
+from flow_project.fieldsets import SparseFieldsetsMixin
+
+from .catalog_cache import catalog_version, get_or_build
+from .filters import facet_counts, filter_products, filters_key, parse_product_filters
 from .models import Product # O from payments.models import Product
-from .serializers import ProductSerializer
+from .pagination import ProductCursorPagination
+from .search import search_products
+from .serializers import PRODUCT_FIELD_PRESETS, ProductSearchSerializer, ProductSerializer
+
+
+def catalog_etag(version):
+    return f'"catalog-{version}"'
+
+
+def json_bytes_response(cached):
+    """Respuesta con el (versión, bytes) de get_or_build y el ETag de esa versión (puede ser anterior a la vigente)."""
+    version, data = cached
+    response = HttpResponse(data, content_type='application/json')
+    response.headers['ETag'] = catalog_etag(version)
+    return response
+
+
+def catalog_entry_name(name, fields=None, filters=None):
+    """Nombre de la entrada en la caché del catálogo para ese recorte de ?fields= (None = completo) y esos filtros."""
+    if fields:
+        name = f"{name}:fields={','.join(fields)}"
+    if filters and filters_key(filters):
+        name = f"{name}:{filters_key(filters)}"
+    return name
 
-class ProductListView(generics.ListAPIView):
+
+class CatalogValidatorsMixin(ConditionalGetMixin):
+    """ETag = versión del catálogo: cambia con cualquier producto guardado o borrado, sin consultar la BD."""
+    def get_validators(self, request, *args, **kwargs):
+        return catalog_etag(catalog_version()), None
+
+
+class ProductListView(CatalogValidatorsMixin, SparseFieldsetsMixin, generics.ListAPIView):
     """
     Vista para listar todos los productos activos.
-    Permite peticiones GET.
+    Permite peticiones GET. Con ?limit= o ?cursor= pagina por cursor
+    (ver products/pagination.py); sin ellos devuelve la lista completa,
+    ya serializada desde la caché del catálogo (products/catalog_cache.py).
+    Responde 304 si el cliente ya tiene la versión vigente del catálogo.
+    ?fields=card (o una lista de campos) recorta la respuesta para la grilla.
+    Filtros por categoría, dificultad, estado y precio: ver products/filters.py.
     """
-    queryset = Product.objects.filter(is_active=True).order_by('name')
+    queryset = Product.objects.filter(is_active=True).order_by('name', 'id')
     serializer_class = ProductSerializer
-    # Aquí podrías añadir clases de paginación, filtros, etc. en el futuro
+    pagination_class = ProductCursorPagination
+    field_presets = PRODUCT_FIELD_PRESETS
+    sparse_required_fields = ('name',) # El cursor se arma con name e id
+
+    def get_filters(self):
+        if not hasattr(self, '_filters'):
+            self._filters = parse_product_filters(self.request.query_params)
+        return self._filters
+
+    def get_queryset(self):
+        return filter_products(super().get_queryset(), self.get_filters())
+
+    def list(self, request, *args, **kwargs):
+        if self.paginator.is_requested(request):
+            return super().list(request, *args, **kwargs)
+
+        def build():
+            return JSONRenderer().render(self.get_serializer(self.get_queryset(), many=True).data)
+        return json_bytes_response(get_or_build(catalog_entry_name('list', self.get_requested_fields(), self.get_filters()), build))
 
 
-class ProductDetailView(generics.RetrieveAPIView):
+class ProductDetailView(CatalogValidatorsMixin, SparseFieldsetsMixin, generics.RetrieveAPIView):
     """
     Vista para obtener los detalles de un solo producto activo, usando su slug.
-    Permite peticiones GET.
+    Permite peticiones GET. El JSON de cada producto sale de la caché del catálogo
+    (304 si el catálogo no cambió). Acepta ?fields= como el listado.
     """
     queryset = Product.objects.filter(is_active=True)
     serializer_class = ProductSerializer
+    field_presets = PRODUCT_FIELD_PRESETS
     lookup_field = 'slug' # Usaremos el slug para buscar el producto en la URL
-                          # ej: /api/products/kit-cultivo-ostra-rosado/
\ No newline at end of file
+                          # ej: /api/products/kit-cultivo-ostra-rosado/
+
+    def retrieve(self, request, *args, **kwargs):
+        def build():
+            product = self.get_queryset().filter(slug=kwargs['slug']).first()
+            return JSONRenderer().render(self.get_serializer(product).data) if product is not None else None
+
+        cached = get_or_build(catalog_entry_name(f"product:{kwargs['slug']}", self.get_requested_fields()), build)
+        if cached[1] is None:
+            raise Http404
+        return json_bytes_response(cached)
+
+
+class ProductSearchView(CatalogValidatorsMixin, generics.GenericAPIView):
+    """
+    Búsqueda de texto en el catálogo: GET /api/products/search/?q=ostra&limit=10.
+    Resultados por relevancia (FTS5, ver products/search.py), con el nombre
+    resaltado y un fragmento del texto donde coincidió.
+    """
+    serializer_class = ProductSearchSerializer
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': "Indica qué buscar."})
+        try:
+            limit = int(request.query_params.get('limit', settings.PRODUCT_PAGE_SIZE))
+        except ValueError:
+            raise ValidationError({'limit': "Debe ser un número."})
+        limit = max(1, min(limit, settings.PRODUCT_MAX_PAGE_SIZE))
+        return Response(self.get_serializer(search_products(query, limit=limit), many=True).data)
+
+
+class ProductFacetsView(CatalogValidatorsMixin, generics.GenericAPIView):
+    """
+    Conteos por faceta del catálogo activo para los mismos filtros del listado:
+    GET /api/products/facets/?category=Kits&max_price=20000. Una consulta por
+    combinación de filtros y versión del catálogo; después sale de la caché.
+    """
+    queryset = Product.objects.filter(is_active=True)
+
+    def get(self, request, *args, **kwargs):
+        filters = parse_product_filters(request.query_params)
+
+        def build():
+            return JSONRenderer().render(facet_counts(self.get_queryset(), filters))
+        return json_bytes_response(get_or_build(catalog_entry_name('facets', filters=filters), build))